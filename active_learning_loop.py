@@ -7,189 +7,173 @@ import database
 import numpy as np
 import copy
 import json
+from active_learning_utils import abs_cosine_similarity, greedy_representative_subset, PoolEmbedding, GrayView
+from image_pool import ImagePoolFile
+from ensemble_inference import ensemble_uncertainty, parallel_ensemble_uncertainty, build_fgbg_model
+import argparse
+import os
+import time
 
 K = 100
 k = 50
 
-db = database.Database() # Database parser. Looks for a JSON file in the working directory
-
-pool_name = "pool3" # Change or get user input if you have a different pool
-loop_tag = "activeloop3"
-(X, metadata) = db.load_image_pool(pool_name)
-
-print(len(metadata['images']))
-
-# Convert to grayscale (is this needed??? How much faster does it really make things?)
-red = X[:, :, :, 0]                                                                                                                
-green = X[:, :, :, 1]                                                                                                              
-blue = X[:, :, :, 2]                                                                                                               
-
-gray = (                                                                                                                  
-    0.299 * red                                                                                                                    
-    + 0.587 * green                                                                                                                
-    + 0.114 * blue)                                                                                                                
-
-X_color = X.copy()
-X = np.expand_dims(gray, axis=-1)
-num_imgs = X.shape[0]
-
-# ### Run PCA on images
-# First we need to reshape our images, then we will run PCA and transform the
-# images down to the 95% explained variance point. This `d` dimensional vector
-# will give a good way to compare images once we need to measure similarity.
-
-# Flatten images
-from functools import reduce
-import operator
-
-X_newshape = (X.shape[0], reduce(operator.mul, X.shape[1:], 1))
-X_flat = np.reshape(X, X_newshape)
-
-print('New shape for flattened pool:', X_flat.shape)
-
-from sklearn.decomposition import PCA
-import time
+SIM_MAX_BYTES = 256 * 1024**2 # memory cap for the similarity temporaries
+SIM_THREADS = None # number of BLAS threads for similarities, None to leave as is
+PREDICT_BATCH_SIZE = 32 # images per model.predict call
+UNCERTAINTY_STATE_DIR = None # directory for the memmapped variance accumulators, None for a temporary one
+UNCERTAINTY_CHUNK_SIZE = None # images per in-RAM chunk instead (reloads every model per chunk), None for memmapped
+EMBED_CHUNK_SIZE = 1024 # images per incremental PCA step
+POOLS_DIR = 'pools' # memmapped image pools, see image_pool.py
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Suggest images for annotation")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes for ensemble inference (1 runs in this process)")
+    parser.add_argument("--worker-mode", choices=["shard", "member"], default="shard",
+                        help="split the image pool (shard) or the ensemble members (member) across workers")
+    parser.add_argument("--threads-per-worker", type=int, default=1,
+                        help="BLAS/TF threads per inference worker")
+    parser.add_argument("--compact", action="store_true",
+                        help="rewrite the pool without its removed images before starting")
+    parser.add_argument("--refit-embedding", action="store_true",
+                        help="refit the PCA projection even if a saved one exists")
+    parser.add_argument("--max-components", type=int, default=256,
+                        help="PCA components fitted before picking the 95%% variance dimension")
+    return parser.parse_args()
+
+def main(args):
+    db = database.Database() # Database parser. Looks for a JSON file in the working directory
+
+    pool_name = "pool3" # Change or get user input if you have a different pool
+    loop_tag = "activeloop3"
+
+    # The pool lives on disk as a read-only memmap; removed images are only
+    # tombstoned. The first run converts the legacy pool once.
+    pool_dir = os.path.join(POOLS_DIR, pool_name)
+    if not ImagePoolFile.exists(pool_dir):
+        print('Converting legacy pool', pool_name, 'to', pool_dir)
+        (X, metadata) = db.load_image_pool(pool_name)
+        ImagePoolFile.create(pool_dir, X, metadata['images'])
+        del X, metadata
+    pool = ImagePoolFile(pool_dir)
+    if args.compact:
+        print('Compacting', pool.num_removed, 'removed images out of', pool_dir)
+        pool.compact()
+    X = pool.view()
+
+    print(len(pool))
+
+    # ### Embed images with PCA
+    # Images are converted to grayscale and flattened one chunk at a time, and
+    # PCA is fit incrementally, so the dense flattened pool never exists. The
+    # `d` dimensional projection at the 95% explained variance point gives a
+    # good way to compare images once we need to measure similarity. The fitted
+    # projection is saved, and so are the projected images (next to the pool),
+    # so later rounds only transform images that have not been projected yet.
+    embedding_path = 'embedding_' + pool_name + '.npz'
+    t1 = time.perf_counter()
+    if os.path.exists(embedding_path) and not args.refit_embedding:
+        print('Loading PCA projection from', embedding_path)
+        embedding = PoolEmbedding.load(embedding_path)
+    else:
+        print('Starting incremental PCA on images...')
+        embedding = PoolEmbedding.fit(X, variance=0.95, max_components=args.max_components,
+                                      chunk_size=EMBED_CHUNK_SIZE)
+        embedding.save(embedding_path)
+    X_proj = pool.project(embedding, EMBED_CHUNK_SIZE)
+    t2 = time.perf_counter()
+    print(f'PCA embedding took {t2 - t1:0.4f} seconds')
+
+    # Convert to grayscale (is this needed??? How much faster does it really make things?)
+    # Conversion happens lazily, one batch at a time
+    X_color = X
+    X = GrayView(X)
+    num_imgs = X.shape[0]
+
+    print('95% explained variance dimension:', X_proj.shape[1])
+
+
+    # ### Predict Annotations
+    # Now that we have a representation of images for similarity metrics, the next step is to run the images through all of the models. 
+
+    # Load and run each model on the images. Save just the predicted annotation
+    models_dir = '../training/data/models/active_s1'
+    model_names = os.listdir(models_dir)
+
+    # TODO: This assumes something about the structure of the network... Is there a way to save the network structure?
+    model_names = list(filter(lambda x: True if '.h5' in x else False, model_names)) # get just the names that are h5 weight archives
+
+    # Each model is loaded once and swept over the whole pool; the variance across
+    # models is accumulated online so the M x N x H x W x 2 predictions never exist.
+    # The accumulators are memmapped (in UNCERTAINTY_STATE_DIR, or a temporary
+    # directory). Setting UNCERTAINTY_CHUNK_SIZE keeps them in RAM for that many
+    # images at a time instead, but then every model is reloaded once per chunk.
+    weight_paths = [os.path.join(models_dir, mp) for mp in model_names]
+    t1 = time.perf_counter()
+    if args.workers > 1:
+        # CPU nodes: split the pool (or the ensemble) across worker processes
+        imagewise_uncertainty, _ = parallel_ensemble_uncertainty(weight_paths,
+                                                                 X,
+                                                                 args.workers,
+                                                                 build_model=build_fgbg_model,
+                                                                 mode=args.worker_mode,
+                                                                 batch_size=PREDICT_BATCH_SIZE,
+                                                                 pixelwise=False,
+                                                                 threads_per_worker=args.threads_per_worker)
+    else:
+        # We'll use this same model for all iterations, just with swapped weights
+        fgbg_model = build_fgbg_model(X.shape[1:])
+        imagewise_uncertainty, _ = ensemble_uncertainty(fgbg_model,
+                                                        weight_paths,
+                                                        X,
+                                                        batch_size=PREDICT_BATCH_SIZE,
+                                                        pixelwise=False,
+                                                        state_dir=UNCERTAINTY_STATE_DIR,
+                                                        chunk_size=UNCERTAINTY_CHUNK_SIZE)
+    t2 = time.perf_counter()
+    print('Ensemble uncertainty for', X.shape[0], f'images computed in {t2 - t1:0.2f} seconds')
+
+    # ### Suggest Annotations
+    # Annotation Suggestion, once the uncertainties are calculated, takes three steps:
+    # 1. Find the K most uncertain images
+    # 2. Calculate the pairwise similarities of those K images with all images in the pool
+    # 3. Use those similarities to greedily approximate a k-subset of the K images that is most representative of the pool
+
+    # Find the top K most uncertain images
+    Sc = [] # Candidate set
+    tmp = imagewise_uncertainty.copy()
+    for i in range(K):
+        idx = np.argmax(tmp)
+        Sc.append(idx)
+        tmp[idx] = 0
+
+    # Compute all of the image cross similarities 
+    t1 = time.perf_counter()
+    sims = abs_cosine_similarity(X_proj[Sc], X_proj, max_bytes=SIM_MAX_BYTES, n_threads=SIM_THREADS) # K x num_imgs array
+    t2 = time.perf_counter()
+    print(K, f"sets of cross similarities computed in {t2 - t1:0.4f} seconds...")
 
-# WARNING: You may need to use the incremental PCA class from sklearn if you run out of memory
+    # Find a k-subset (k < K) of K_uncertain that 
+    # is the most representative of the full image pool
+    t1 = time.perf_counter()
+    Sa = greedy_representative_subset(sims, k) # Suggested Annotation set, as indices of Sc
+    t2 = time.perf_counter()
+    print("Found representative subset of", k, f"images in {t2 - t1:0.2f} seconds")
+    Sa = [Sc[i] for i in Sa] # Change Sa from indicies of Sc to indices of Su
 
-print('Starting PCA on images...')
-t1 = time.perf_counter()
-color_pca = PCA(n_components=0.95)
-X_proj = color_pca.fit_transform(X_flat)
-t2 = time.perf_counter()
-print(f'PCA on images took {t2 - t1:0.4f} seconds')
-print('95% explained variance dimension:', X_proj.shape[1])
 
+    # ### Save results
+    # Remove the suggested annotations from the pool, then save the new pool and the suggested images.
 
-# ### Predict Annotations
-# Now that we have a representation of images for similarity metrics, the next step is to run the images through all of the models. 
+    # Remove suggested annotations from pool, then save the suggested images.
+    # Removal only appends the indices to the pool's tombstone file.
+    order = sorted(Sa, reverse=True)
+    sanns = X_color[order]
+    sanns_data = copy.deepcopy(pool.get_metadata(order))
+    pool.remove(Sa)
+    db.add_blank_annotations(sanns_data, tag=loop_tag)
+    db.save()
 
-# Load and run each model on the images. Save just the predicted annotation
-import os
-from tensorflow import keras
-from deepcell import model_zoo
-
-models_dir = '../training/data/models/active_s1'
-model_names = os.listdir(models_dir)
-
-# TODO: This assumes something about the structure of the network... Is there a way to save the network structure?
-model_names = list(filter(lambda x: True if '.h5' in x else False, model_names)) # get just the names that are h5 weight archives
-
-receptive_field = 127
-n_skips = 3
-
-# We'll use this same model for all iterations, just with swapped weights
-fgbg_model = model_zoo.bn_feature_net_skip_2D(
-    n_features=2, # foreground, background (i.e. cell, not cell)
-    receptive_field=receptive_field,
-    n_skips=n_skips,
-    n_conv_filters=64,
-    n_dense_filters=128,
-    input_shape=tuple(X.shape[1:]),
-    last_only=False
-)
-
-pixelwise_uncertainty = np.zeros(X.shape[:-1])
-gran = 10
-
-t1 = time.perf_counter()
-for n in range(0, X.shape[0], gran):
-    images = X[n:n+gran] if n + gran <= X.shape[0] else X[n:]
-    predictions = np.zeros(tuple([len(model_names)]) + images.shape[:-1] + tuple([2]))
-    for i, mp in enumerate(model_names):
-        fgbg_model.load_weights(os.path.join(models_dir, mp))
-        predictions[i] = fgbg_model.predict(images)[-1] 
-    uncertainty = np.sum(np.var(predictions, axis=0), axis=-1) # calculate variance across all classes and sum
-    if n + 10 <= X.shape[0]:
-        pixelwise_uncertainty[n:n+gran] = uncertainty.copy()
-    else:
-        pixelwise_uncertainty[n:] = uncertainty.copy()
-    
-    t2 = time.perf_counter()
-    print(gran + n, 'of', X.shape[0], f'images done in {t2 - t1:0.2f} seconds...')
-
-
-# Per image uncertainty is the mean uncertainty of all pixels in the image
-mean_newshape = (pixelwise_uncertainty.shape[0], reduce(operator.mul, pixelwise_uncertainty.shape[1:], 1))
-imagewise_uncertainty = np.mean(np.reshape(pixelwise_uncertainty, mean_newshape), axis=1)
-
-# ### Suggest Annotations
-# Annotation Suggestion, once the uncertainties are calculated, takes three steps:
-# 1. Find the K most uncertain images
-# 2. Calculate the pairwise similarities of those K images with all images in the pool
-# 3. Use those similarities to greedily approximate a k-subset of the K images that is most representative of the pool
-
-# Find the top K most uncertain images
-Sc = [] # Candidate set
-tmp = imagewise_uncertainty.copy()
-for i in range(K):
-    idx = np.argmax(tmp)
-    Sc.append(idx)
-    tmp[idx] = 0
-
-from sklearn.metrics.pairwise import cosine_similarity
-
-# Compute all of the image cross similarities 
-t1 = time.perf_counter()
-sims = np.zeros((K, X_proj.shape[0])) # K x num_imgs array
-for i in range(K):
-    I_Sc = np.expand_dims(X_proj[Sc[i]], 0)
-    
-    for j in range(X_proj.shape[0]):
-        I_Sa = np.expand_dims(X_proj[j], 0)
-        sims[i][j] = abs(cosine_similarity(I_Sc, I_Sa)[0][0])
-        
-t2 = time.perf_counter()
-print(K, f"sets of cross similarities computed in {t2 - t1:0.4f} seconds...")
-
-# Assumes that sims is |Sc| x |Su| array of cosine similarities.
-def F_presims(Sa, sims):
-    rep = 0
-    for x in range(sims.shape[1]):
-        rep = rep + max([sims[i][x] for i in Sa])
-    return rep
-
-# Find a k-subset (k < K) of K_uncertain that 
-# is the most representative of the full image pool
-Sa = [] # Suggested Annotation set
-Sc_idxs = list(range(len(Sc)))
-t1 = time.perf_counter()
-for i in range(k):
-    max_rep = 0
-    max_rep_idx = 0
-    
-    # Find the maximum marginal representativeness by adding the 
-    # remaining images to the set one at a time
-    for idx in Sc_idxs: 
-        Sa_tmp = Sa + [idx]
-        rep_tmp = F_presims(Sa_tmp, sims)
-        if rep_tmp >= max_rep:
-            max_rep = rep_tmp
-            max_rep_idx = idx
-    
-    Sc_idxs.remove(max_rep_idx)
-    Sa.append(max_rep_idx)
-
-t2 = time.perf_counter()
-print("Found representative subset of", k, f"images in {t2 - t1:0.2f} seconds")
-Sa = [Sc[i] for i in Sa] # Change Sa from indicies of Sc to indices of Su
-
-
-# ### Save results
-# Remove the suggested annotations from the pool, then save the new pool and the suggested images.
-
-# Remove suggested annotations from pool, then save the two new sets
-#X_color = imgs['X']
-image_data = metadata['images']
-
-sanns = np.zeros(tuple([len(Sa)]) + X_color.shape[1:])
-sanns_data = []
-for i, idx in enumerate(sorted(Sa, reverse=True)):
-    sanns[i] = X_color[idx]
-    sanns_data.append(copy.deepcopy(image_data[idx]))
-    del(image_data[idx])    
-
-X_color = np.delete(X_color, Sa, axis=0)
-db.save_image_pool(pool_name, X_color, image_data)
-db.add_blank_annotations(sanns_data, tag=loop_tag)
-db.save()
+# Workers are spawned and re-import this module, so keep the work behind main
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,172 @@
+import heapq
+import hashlib
+import numpy as np
+
+# Numerical building blocks for annotation suggestion in
+# active_learning_loop.py
+
+def blas_threads(n_threads):
+    # Limits (or raises) the number of BLAS threads used inside a `with`
+    # block. threadpoolctl ships with scikit-learn, but fall back to a no-op
+    # context if it is missing
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        import contextlib
+        return contextlib.suppress()
+    return threadpool_limits(limits=n_threads, user_api='blas')
+
+def normalize_rows(X, dtype=np.float32):
+    X = np.asarray(X, dtype=dtype)
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    norms[norms == 0] = 1 # zero vectors have zero similarity, like sklearn
+    return X / norms
+
+# |cosine similarity| between every row of A (K x d) and every row of B
+# (N x d), returned as a K x N array. The rows of A are normalized once and B
+# is processed in column blocks sized so the temporaries stay under
+# `max_bytes`, each block being a single GEMM.
+def abs_cosine_similarity(A, B, max_bytes=256 * 1024**2, dtype=np.float32, n_threads=None):
+    A_n = normalize_rows(A, dtype)
+    K, d = A_n.shape
+    N = B.shape[0]
+    itemsize = np.dtype(dtype).itemsize
+
+    block = max(1, int(max_bytes // (itemsize * (2 * d + K))))
+    sims = np.empty((K, N), dtype=dtype)
+
+    with blas_threads(n_threads):
+        for s in range(0, N, block):
+            e = min(s + block, N)
+            B_n = normalize_rows(B[s:e], dtype)
+            sims[:, s:e] = np.abs(np.dot(A_n, B_n.T))
+
+    return sims
+
+# Greedily picks k rows of `sims` (K x N) maximizing the representativeness
+# F(S) = sum_x max_{i in S} sims[i][x]. F is monotone submodular, so a
+# candidate's gain from an earlier round is an upper bound on its gain now
+# (lazy greedy): only candidates whose stale bound reaches the top of the heap
+# get re-evaluated. The running per-pool-image coverage makes each evaluation
+# a single O(N) NumPy pass. Ties go to the larger candidate index, matching
+# the original `>=` scan. Returns row indices of `sims` in selection order.
+def greedy_representative_subset(sims, k):
+    K = sims.shape[0]
+    k = min(k, K)
+    coverage = np.zeros(sims.shape[1], dtype=sims.dtype)
+
+    def gain(i):
+        return float(np.sum(np.maximum(sims[i] - coverage, 0), dtype=np.float64))
+
+    # Heap entries are (-gain bound, -index, round the bound was computed in)
+    heap = [(-gain(i), -i, 0) for i in range(K)]
+    heapq.heapify(heap)
+
+    selected = []
+    for rnd in range(k):
+        while True:
+            neg_bound, neg_i, stamp = heapq.heappop(heap)
+            i = -neg_i
+            if stamp == rnd:
+                break
+            heapq.heappush(heap, (-gain(i), neg_i, rnd))
+
+        selected.append(i)
+        np.maximum(coverage, sims[i], out=coverage)
+
+    return selected
+
+#### POOL EMBEDDING ####
+
+def to_gray(X):
+    # N x H x W x 3 -> N x H x W x 1, in float32 to halve memory
+    X = X.astype(np.float32, copy=False)
+    gray = 0.299 * X[..., 0] + 0.587 * X[..., 1] + 0.114 * X[..., 2]
+    return np.expand_dims(gray, axis=-1)
+
+# Grayscale view over a color pool that converts only the rows that are
+# indexed, so the loop never holds a grayscale copy of the whole pool
+class GrayView(object):
+
+    def __init__(self, X):
+        self.X = X
+        self.shape = tuple(X.shape[:-1]) + (1,)
+        self.dtype = np.dtype(np.float32)
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        return to_gray(np.asarray(self.X[idx]))
+
+def chunk_bounds(N, chunk_size):
+    # A short last chunk is folded into the previous one, since
+    # IncrementalPCA needs at least n_components rows per call
+    bounds = list(range(0, N, chunk_size)) + [N]
+    if len(bounds) > 2 and bounds[-1] - bounds[-2] < chunk_size:
+        del bounds[-2]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def gray_chunks(X, chunk_size):
+    for s, e in chunk_bounds(X.shape[0], chunk_size):
+        chunk = to_gray(X[s:e])
+        yield np.reshape(chunk, (chunk.shape[0], -1))
+
+# PCA projection of (grayscale, flattened) pool images, fitted out of core
+# with IncrementalPCA. The dimension is the smallest one reaching `variance`
+# explained variance, picked after fitting `max_components`. The projection is
+# saved to an .npz so later rounds only transform images instead of refitting.
+class PoolEmbedding(object):
+
+    def __init__(self, mean, components, explained_variance_ratio, variance=0.95):
+        self.mean = mean
+        self.components = components
+        self.explained_variance_ratio = explained_variance_ratio
+        self.variance = variance
+        cumulative = np.cumsum(explained_variance_ratio)
+        self.d = int(min(np.searchsorted(cumulative, variance) + 1, len(cumulative)))
+
+    @classmethod
+    def fit(cls, X, variance=0.95, max_components=256, chunk_size=1024, verbose=True):
+        from sklearn.decomposition import IncrementalPCA
+
+        N = X.shape[0]
+        D = int(np.prod(X.shape[1:-1]))
+        n_components = min(max_components, D, N, chunk_size)
+        pca = IncrementalPCA(n_components=n_components)
+        for chunk in gray_chunks(X, max(chunk_size, n_components)):
+            pca.partial_fit(chunk)
+
+        emb = cls(pca.mean_.astype(np.float32), pca.components_.astype(np.float32),
+                  pca.explained_variance_ratio_, variance)
+        if verbose and np.sum(pca.explained_variance_ratio_) < variance:
+            print('WARNING:', n_components, 'components only explain',
+                  f'{np.sum(pca.explained_variance_ratio_):0.3f} of the variance; raise max_components')
+        return emb
+
+    def transform(self, X_flat):
+        return np.dot(X_flat - self.mean, self.components[:self.d].T)
+
+    # Identifies the projection, so stored projections of pool images can be
+    # told apart from those of an earlier fit
+    def fingerprint(self):
+        digest = hashlib.sha1(self.mean.tobytes())
+        digest.update(self.components[:self.d].tobytes())
+        return digest.hexdigest()
+
+    def transform_pool(self, X, chunk_size=1024):
+        X_proj = np.zeros((X.shape[0], self.d), dtype=np.float32)
+        for (s, e), chunk in zip(chunk_bounds(X.shape[0], chunk_size), gray_chunks(X, chunk_size)):
+            X_proj[s:e] = self.transform(chunk)
+        return X_proj
+
+    def save(self, path):
+        np.savez(path, mean=self.mean, components=self.components,
+                 explained_variance_ratio=self.explained_variance_ratio,
+                 variance=self.variance)
+
+    @classmethod
+    def load(cls, path):
+        f = np.load(path)
+        return cls(f['mean'], f['components'], f['explained_variance_ratio'], float(f['variance']))
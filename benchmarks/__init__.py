@@ -0,0 +1,7 @@
+# Benchmarks for the database and the heavy commands. Every benchmark runs
+# against a scratch database given with --url and seeds it with synthetic
+# data (see synthetic.py), so no real experiment data is needed.
+#
+#   queries.py   the queries behind the CLI commands, with and without indexes
+#   pipeline.py  CLI, import, do-ann and active learning stages end to end,
+#                with JSON results to compare between commits
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+
+# End to end benchmark of the CLI, migration and active learning stages
+# against synthetic data: schema migrations, the legacy import of
+# port_custom_db_to_ormarpg.py, list-anns, the pixel preparation behind do-ann
+# (from an empty cache, a warm cache and a tiled source), and the similarity
+# and subset selection steps of active_learning_loop.py. S3 is the in-memory
+# stub of s3_stub.py unless --s3-endpoint points at a local S3 (minio, moto
+# server).
+#
+#   python -m benchmarks.pipeline --url sqlite:////tmp/bench.db --json base.json
+#   python -m benchmarks.pipeline --url sqlite:////tmp/bench.db --compare base.json
+#
+# The results are written as JSON together with the commit and machine they
+# were measured on; --compare prints them next to an earlier file and exits
+# with status 1 if a stage got slower than --threshold allows. The database
+# at --url is wiped.
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.queries import summarize
+from benchmarks.synthetic import SyntheticSizes, add_size_args, reset, seed, legacy_dict, source_pixels
+
+# (name, description), in the order the stages run
+STAGES = [
+          ("migrate", "schema migrations on an empty database"),
+          ("port-import", "legacy JSON database import"),
+          ("list-anns", "list-anns over every annotation"),
+          ("list-anns-pool", "list-anns of one labeled pool"),
+          ("do-ann-cold", "do-ann pixels, empty cache"),
+          ("do-ann-warm", "do-ann pixels, cached source image"),
+          ("do-ann-tiled", "do-ann pixels, tiled source image"),
+          ("similarity", "|cosine| similarity of labeled and pool embeddings"),
+          ("selection", "greedy representative subset selection"),
+         ]
+
+BUCKET = "bench"
+
+def timed(times):
+    @contextlib.contextmanager
+    def timer():
+        t1 = time.perf_counter()
+        yield
+        times.append(time.perf_counter() - t1)
+    return timer()
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"],
+                                        stderr=subprocess.DEVNULL).decode().strip() != ""
+        return commit, dirty
+    except Exception:
+        return None, None
+
+def machine_info():
+    import numpy as np
+    return {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "numpy": np.__version__,
+           }
+
+#### STAGES ####
+
+async def bench_migrate(database_handle, engine, metadata, repeat):
+    import migrations
+    times = []
+    for r in range(repeat):
+        reset(engine, metadata)
+        with timed(times):
+            await migrations.migrate(database_handle, verbose=False)
+    return summarize(times)
+
+async def bench_port_import(database_handle, engine, metadata, sizes, chunk_size):
+    import migrations
+    from port_custom_db_to_ormarpg import import_legacy
+
+    db_dict = legacy_dict(sizes)
+    reset(engine, metadata)
+    await migrations.migrate(database_handle, verbose=False)
+    times = []
+    with timed(times):
+        db_exps, totals = await import_legacy(db_dict, chunk_size, min_images=0, verbose=False)
+
+    result = summarize(times)
+    result["images"], result["annotations"], result["pool_links"] = totals
+    result["annotations_per_s"] = totals[1] / times[0]
+    return result
+
+async def bench_list_anns(db, repeat, count, **args):
+    times = []
+    for r in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()), timed(times):
+            await db.cmd_handler_list_anns(**args)
+    result = summarize(times)
+    result["annotations"] = count
+    result["us_per_ann"] = result["median_ms"] * 1000 / max(count, 1)
+    return result
+
+# Annotations spread evenly over the table, so each one is on its own
+# source image
+async def pick_annotations(n):
+    from database_models import ImageAnnotation
+    count = await ImageAnnotation.objects.count()
+    ids = sorted(set([1 + (i * count) // n for i in range(n)]))
+    return await ImageAnnotation.objects.select_related("source_image").filter(id__in=ids).order_by("id").all()
+
+# Uploads the objects do-ann reads for these source images: the PNG, its tiled
+# copy, and every seeded sample image that has a key (seeding only writes rows)
+def upload_sources(s3, images, samples):
+    from database_remote_commands import encode_png, crop_image
+    from tiled_images import encode_tiled, tiled_key
+    tiled = {}
+    for image in images:
+        X = source_pixels(image.name, (image.image_resy, image.image_resx, image.num_channels))
+        s3.put_object(Bucket=image.s3_bucket, Key=image.s3_key, Body=encode_png(X))
+        tiled[image.name] = tiled_key(image.s3_key)
+        s3.put_object(Bucket=image.s3_bucket, Key=tiled[image.name], Body=encode_tiled(X))
+        for sample in samples.get(image.name, []):
+            s3.put_object(Bucket=sample.s3_bucket, Key=sample.s3_key,
+                          Body=encode_png(crop_image(X, sample.get_source_offset())))
+    return tiled
+
+async def bench_load_pixels(db, s3, anns, repeat, clear_cache=False):
+    times = []
+    bytes_out = getattr(s3, "bytes_out", None)
+    for r in range(repeat):
+        for ann in anns:
+            if clear_cache:
+                db.cache.clear()
+            with timed(times):
+                await db.load_ann_pixels(ann)
+    result = summarize(times)
+    if bytes_out is not None:
+        result["s3_kb_per_ann"] = (s3.bytes_out - bytes_out) / 1024 / len(times)
+    return result
+
+async def bench_do_ann(db, s3, n, repeat):
+    from database_models import SourceImage, SampleImage
+    from sample_materializer import SAMPLE_PREFIX
+
+    anns = await pick_annotations(n)
+    names = list(set([a.source_image.name for a in anns]))
+    images = await SourceImage.objects.filter(name__in=names).all()
+    samples = {}
+    for sample in await SampleImage.objects.filter(source_image__name__in=names, s3_key__startswith=SAMPLE_PREFIX).all():
+        samples.setdefault(sample.source_image.name, []).append(sample)
+    tiled = upload_sources(s3, images, samples)
+
+    results = {}
+    results["do-ann-cold"] = await bench_load_pixels(db, s3, anns, repeat, clear_cache=True)
+    results["do-ann-warm"] = await bench_load_pixels(db, s3, anns, repeat)
+
+    table = SourceImage.Meta.table
+    for name, key in tiled.items():
+        await db.database_handle.execute(table.update().where(table.c.name == name).values(tiled_s3_key=key))
+    results["do-ann-tiled"] = await bench_load_pixels(db, s3, anns, repeat)
+    return results
+
+def embeddings(pool_size, labeled, dims, seed):
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    return rng.standard_normal((labeled, dims), dtype=np.float32), \
+           rng.standard_normal((pool_size, dims), dtype=np.float32)
+
+def bench_similarity(A, B, repeat):
+    from active_learning_utils import abs_cosine_similarity
+    times = []
+    sims = None
+    for r in range(repeat):
+        with timed(times):
+            sims = abs_cosine_similarity(A, B)
+    result = summarize(times)
+    result["shape"] = list(sims.shape)
+    return result, sims
+
+def bench_selection(sims, k, repeat):
+    from active_learning_utils import greedy_representative_subset
+    times = []
+    for r in range(repeat):
+        with timed(times):
+            greedy_representative_subset(sims, k)
+    result = summarize(times)
+    result["k"] = k
+    return result
+
+#### REPORTING ####
+
+def compare(results, previous, threshold):
+    regressions = []
+    for name, description in STAGES:
+        if name in results and name in previous:
+            ratio = results[name]["median_ms"] / max(previous[name]["median_ms"], 1e-9)
+            if ratio > threshold:
+                regressions.append(name)
+    return regressions
+
+def print_table(results, previous=None, regressions=[]):
+    header = "{:<16} {:>11} {:>11}".format("stage", "median ms", "p95 ms")
+    if previous is not None:
+        header = header + " {:>11} {:>8}".format("before ms", "change")
+    print(header)
+    for name, description in STAGES:
+        if name not in results:
+            continue
+        r = results[name]
+        line = "{:<16} {:>11.3f} {:>11.3f}".format(name, r["median_ms"], r["p95_ms"])
+        if previous is not None and name in previous:
+            before = previous[name]["median_ms"]
+            line = line + " {:>11.3f} {:>+7.1f}%".format(before, 100 * (r["median_ms"] / max(before, 1e-9) - 1))
+            if name in regressions:
+                line = line + "  SLOWER"
+        print(line)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the CLI, migration and active learning stages")
+    parser.add_argument("--url", required=True, help="scratch database to seed (it is wiped)")
+    add_size_args(parser)
+    parser.add_argument("--stages", help="comma separated stages to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per stage")
+    parser.add_argument("--chunk-size", type=int, default=500, help="source images per import transaction")
+    parser.add_argument("--do-ann", type=int, default=8, help="annotations whose pixels are prepared")
+    parser.add_argument("--s3-endpoint", help="use this S3 endpoint instead of the in-memory stub")
+    parser.add_argument("--s3-latency", type=float, default=0.0, help="seconds added to every stub request")
+    parser.add_argument("--pool-size", type=int, default=10000, help="pool embeddings for similarity")
+    parser.add_argument("--labeled", type=int, default=1000, help="labeled embeddings for similarity")
+    parser.add_argument("--dims", type=int, default=256, help="embedding dimensions")
+    parser.add_argument("--select", type=int, default=100, help="subset size for selection")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="a stage this many times slower than before counts as a regression")
+    return parser.parse_args()
+
+def make_s3(args):
+    if args.s3_endpoint is None:
+        from benchmarks.s3_stub import LocalS3
+        return LocalS3(args.s3_latency)
+
+    from s3_transfer import make_s3_client
+    s3 = make_s3_client(args.s3_endpoint)
+    try:
+        s3.create_bucket(Bucket=BUCKET)
+    except Exception:
+        pass # already there
+    return s3
+
+async def run(args, sizes, stages):
+    # Before the models are imported, so they bind to the scratch database
+    os.environ["DATABASE_URL"] = args.url
+    from database_models import database_handle, metadata, engine, ImageAnnotation
+    from database_remote_commands import Database
+    import migrations
+
+    results = {}
+    await database_handle.connect()
+    try:
+        if "migrate" in stages:
+            print("Timing migrate...")
+            results["migrate"] = await bench_migrate(database_handle, engine, metadata, args.repeat)
+        if "port-import" in stages:
+            print("Timing port-import...")
+            results["port-import"] = await bench_port_import(database_handle, engine, metadata,
+                                                             sizes, args.chunk_size)
+
+        cli_stages = [s for s in stages if s.startswith("list-anns") or s.startswith("do-ann")]
+        if len(cli_stages) > 0:
+            reset(engine, metadata)
+            await migrations.migrate(database_handle, verbose=False)
+            await seed(database_handle, sizes)
+
+            with tempfile.TemporaryDirectory() as cache_dir:
+                db = Database(database_handle, metadata, engine, bucket=BUCKET, cache_dir=cache_dir)
+                s3 = make_s3(args)
+                db.helpers["s3_handle"] = s3
+                count = await ImageAnnotation.objects.count()
+
+                if "list-anns" in stages:
+                    print("Timing list-anns...")
+                    results["list-anns"] = await bench_list_anns(db, args.repeat, count)
+                if "list-anns-pool" in stages:
+                    print("Timing list-anns-pool...")
+                    pool_count = await ImageAnnotation.objects.filter(memberships__name="pool0").count()
+                    results["list-anns-pool"] = await bench_list_anns(db, args.repeat, pool_count, pool="pool0")
+                if any([s.startswith("do-ann") for s in stages]):
+                    print("Timing do-ann...")
+                    do_ann = await bench_do_ann(db, s3, args.do_ann, args.repeat)
+                    results.update([(s, r) for s, r in do_ann.items() if s in stages])
+    finally:
+        await database_handle.disconnect()
+
+    if "similarity" in stages or "selection" in stages:
+        print("Timing similarity and selection...")
+        A, B = embeddings(args.pool_size, args.labeled, args.dims, sizes.seed)
+        similarity, sims = bench_similarity(A, B, args.repeat if "similarity" in stages else 1)
+        if "similarity" in stages:
+            results["similarity"] = similarity
+        if "selection" in stages:
+            results["selection"] = bench_selection(sims, args.select, args.repeat)
+
+    return results, engine.dialect.name
+
+def main(args):
+    sizes = SyntheticSizes.from_args(args)
+    names = [name for name, description in STAGES]
+    stages = names if args.stages is None else args.stages.split(",")
+    unknown = [s for s in stages if s not in names]
+    if len(unknown) > 0:
+        raise SystemExit("Unknown stages: " + ", ".join(unknown) + " (choose from " + ", ".join(names) + ")")
+
+    results, dialect = asyncio.run(run(args, sizes, stages))
+
+    previous = None
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            before = json.load(f)
+        previous = before["results"]
+        regressions = compare(results, previous, args.threshold)
+        print("Compared against " + str(before.get("commit")) + " from " + str(before.get("created")))
+
+    print(str(sizes) + ", " + str(args.repeat) + " runs per stage, " + dialect)
+    print_table(results, previous, regressions)
+
+    if args.json:
+        commit, dirty = git_commit()
+        with open(args.json, "w") as f:
+            json.dump({
+                       "benchmark": "pipeline",
+                       "commit": commit,
+                       "dirty": dirty,
+                       "created": datetime.datetime.now().isoformat(),
+                       "machine": machine_info(),
+                       "dialect": dialect,
+                       "s3": args.s3_endpoint or "stub",
+                       "sizes": vars(sizes),
+                       "options": {"repeat": args.repeat, "chunk_size": args.chunk_size, "do_ann": args.do_ann,
+                                   "pool_size": args.pool_size, "labeled": args.labeled, "dims": args.dims,
+                                   "select": args.select},
+                       "results": results,
+                      }, f, indent=1)
+
+    if len(regressions) > 0:
+        print("Slower than before: " + ", ".join(regressions))
+        sys.exit(1)
+    return results
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+# Query benchmark for the schema. Seeds a scratch database with synthetic data
+# of the requested size and times the queries behind the CLI commands. With
+# --compare the same queries are timed again with the secondary indexes
+# dropped, so every index can be justified by a measurement.
+#
+#   python -m benchmarks.queries --url sqlite:///bench.db --images 2000
+#   python -m benchmarks.queries --url postgresql:///bench --compare --json out.json
+#
+# The database at --url is wiped.
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+from benchmarks.synthetic import SyntheticSizes, add_size_args, reset, seed, \
+                                 experiment_name, image_name, pool_name
+
+# (name, description) of every timed query; the queries themselves are in
+# run_query so the benchmark runs them exactly as the commands do
+QUERIES = [
+           ("list-invalid", "first page of unfinished annotations with pools"),
+           ("list-anns-deep", "keyset page deep into all annotations"),
+           ("list-anns-pool", "first page of one labeled pool"),
+           ("next-ann-peek", "next claimable annotation"),
+           ("next-ann-peek-pool", "next claimable annotation in one pool"),
+           ("anns-of-image", "annotations of one source image"),
+           ("do-ann-sample", "materialized sample for an annotation"),
+           ("frames", "frames of an experiment in a time range"),
+           ("materialize-todo", "sample images without an object"),
+           ("pool-samples", "first page of one image pool"),
+          ]
+
+async def run_query(name, ctx):
+    from database_models import ImageAnnotation, SampleImage, get_experiment_frames, \
+                                get_materialized_sample, database_handle
+    import work_queue
+
+    anns = ImageAnnotation.objects.select_related(["source_image", "memberships"]).order_by("id")
+    if name == "list-invalid":
+        return await anns.filter(finished=False).limit(500).all()
+    if name == "list-anns-deep":
+        return await anns.filter(id__gt=ctx["deep_id"]).limit(500).all()
+    if name == "list-anns-pool":
+        return await anns.filter(memberships__name=ctx["pool"]).limit(500).all()
+    if name == "next-ann-peek":
+        return await work_queue.peek_next(database_handle)
+    if name == "next-ann-peek-pool":
+        return await work_queue.peek_next(database_handle, pool=ctx["pool"])
+    if name == "anns-of-image":
+        return await ImageAnnotation.objects.filter(source_image__name=ctx["image"]).all()
+    if name == "do-ann-sample":
+        return await get_materialized_sample(ctx["image"], ctx["crop"])
+    if name == "frames":
+        return await get_experiment_frames(ctx["experiment"], ctx["t0"], ctx["t1"])
+    if name == "materialize-todo":
+        return await SampleImage.objects.select_related("source_image").filter(s3_key="") \
+                                        .order_by("id").limit(1000).all()
+    if name == "pool-samples":
+        return await SampleImage.objects.filter(memberships__name=ctx["pool"]).order_by("id").limit(500).all()
+    raise ValueError("Unknown query " + name)
+
+def summarize(times):
+    times = sorted(times)
+    return {
+            "median_ms": statistics.median(times) * 1000,
+            "p95_ms": times[min(len(times) - 1, int(round(0.95 * (len(times) - 1))))] * 1000,
+            "min_ms": times[0] * 1000,
+            "runs": len(times),
+           }
+
+async def time_queries(ctx, repeat, names=None):
+    results = {}
+    for name, description in QUERIES:
+        if names is not None and name not in names:
+            continue
+        await run_query(name, ctx) # warm up caches and the connection
+        times = []
+        for r in range(repeat):
+            t1 = time.perf_counter()
+            await run_query(name, ctx)
+            times.append(time.perf_counter() - t1)
+        results[name] = summarize(times)
+    return results
+
+def drop_indexes(engine, names):
+    with engine.begin() as conn:
+        for name in names:
+            conn.execute("DROP INDEX IF EXISTS " + name)
+        conn.execute("ANALYZE")
+
+def recreate_indexes(engine, names):
+    import migrations
+    with engine.begin() as conn:
+        migrations.create_indexes(conn, names)
+        conn.execute("ANALYZE")
+
+def context(sizes, annotation):
+    e = sizes.experiments // 2
+    return {
+            "deep_id": int(sizes.experiments * sizes.images * sizes.anns_per_image * 0.9),
+            "pool": pool_name(0),
+            "image": annotation.source_image.name if annotation is not None else image_name(e, 0),
+            "crop": annotation.get_source_offset() if annotation is not None else ((0, 0), (256, 256)),
+            "experiment": experiment_name(e),
+            "t0": sizes.images * 0.25 * 0.4,
+            "t1": sizes.images * 0.25 * 0.6,
+           }
+
+def print_table(results, baseline=None):
+    header = "{:<20} {:>11} {:>11}".format("query", "median ms", "p95 ms")
+    if baseline is not None:
+        header = header + " {:>14} {:>9}".format("no-index ms", "speedup")
+    print(header)
+    for name, description in QUERIES:
+        if name not in results:
+            continue
+        r = results[name]
+        line = "{:<20} {:>11.3f} {:>11.3f}".format(name, r["median_ms"], r["p95_ms"])
+        if baseline is not None:
+            b = baseline[name]
+            line = line + " {:>14.3f} {:>8.1f}x".format(b["median_ms"], b["median_ms"] / max(r["median_ms"], 1e-9))
+        print(line)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Time the database queries against synthetic data")
+    parser.add_argument("--url", required=True, help="scratch database to seed (it is wiped)")
+    add_size_args(parser)
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs per query")
+    parser.add_argument("--compare", action="store_true", help="also time without the secondary indexes")
+    parser.add_argument("--reuse", action="store_true", help="reuse an already seeded database")
+    parser.add_argument("--json", help="write the results to this file")
+    return parser.parse_args()
+
+async def main(args):
+    # Before the models are imported, so they bind to the scratch database
+    os.environ["DATABASE_URL"] = args.url
+    from database_models import database_handle, metadata, engine, ImageAnnotation, SECONDARY_INDEXES
+    import migrations
+
+    sizes = SyntheticSizes.from_args(args)
+    if not args.reuse:
+        reset(engine, metadata)
+    await database_handle.connect()
+    try:
+        await migrations.migrate(database_handle, verbose=False)
+        if not args.reuse:
+            t1 = time.perf_counter()
+            await seed(database_handle, sizes)
+            print("Seeding took {:0.2f} s".format(time.perf_counter() - t1))
+
+        annotation = await ImageAnnotation.objects.select_related("source_image").order_by("id").limit(1).all()
+        ctx = context(sizes, annotation[0] if len(annotation) > 0 else None)
+
+        results = await time_queries(ctx, args.repeat)
+        baseline = None
+        if args.compare:
+            drop_indexes(engine, SECONDARY_INDEXES)
+            try:
+                baseline = await time_queries(ctx, args.repeat)
+            finally:
+                recreate_indexes(engine, SECONDARY_INDEXES)
+    finally:
+        await database_handle.disconnect()
+
+    print(str(sizes) + ", " + str(args.repeat) + " runs per query")
+    print_table(results, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"benchmark": "queries", "dialect": engine.dialect.name, "sizes": vars(sizes),
+                       "results": results, "no_indexes": baseline}, f, indent=1)
+    return results
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,80 @@
+import hashlib
+import io
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+# In-memory stand-in for the parts of the boto3 S3 client the commands use
+# (head/get/put_object with ranged GETs, download_fileobj, download_file and
+# upload_file), so the benchmarks time our own code and not the network.
+# `latency` adds a fixed delay to every request to model a remote bucket.
+# Thread safe, like the real client.
+
+class LocalS3(object):
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.objects = {} # (bucket, key) -> (bytes, etag)
+        self.requests = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.lock = threading.Lock()
+
+    def request(self, nbytes_out=0, nbytes_in=0):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests = self.requests + 1
+            self.bytes_out = self.bytes_out + nbytes_out
+            self.bytes_in = self.bytes_in + nbytes_in
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes_out = 0
+            self.bytes_in = 0
+
+    # Missing keys raise the same 404 ClientError as the real client
+    def lookup(self, bucket, key, operation="GetObject"):
+        try:
+            return self.objects[(bucket, key)]
+        except KeyError:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": "No such key: s3://" + bucket + "/" + key},
+                               "ResponseMetadata": {"HTTPStatusCode": 404}}, operation)
+
+    def put_object(self, Bucket, Key, Body):
+        data = Body if isinstance(Body, bytes) else Body.read()
+        self.request(nbytes_in=len(data))
+        with self.lock:
+            self.objects[(Bucket, Key)] = (data, hashlib.md5(data).hexdigest())
+        return {"ETag": '"' + self.objects[(Bucket, Key)][1] + '"'}
+
+    def head_object(self, Bucket, Key):
+        data, etag = self.lookup(Bucket, Key, "HeadObject")
+        self.request()
+        return {"ETag": '"' + etag + '"', "ContentLength": len(data)}
+
+    def get_object(self, Bucket, Key, Range=None):
+        data, etag = self.lookup(Bucket, Key)
+        if Range is not None:
+            start, end = Range[len("bytes="):].split("-")
+            data = data[int(start):int(end) + 1]
+        self.request(nbytes_out=len(data))
+        return {"Body": io.BytesIO(data), "ETag": '"' + etag + '"', "ContentLength": len(data)}
+
+    def download_fileobj(self, Bucket, Key, Fileobj, Config=None):
+        data, etag = self.lookup(Bucket, Key)
+        self.request(nbytes_out=len(data))
+        Fileobj.write(data)
+
+    def download_file(self, Bucket, Key, Filename, Config=None):
+        with open(Filename, "wb") as f:
+            self.download_fileobj(Bucket, Key, f)
+
+    def upload_file(self, Filename, Bucket, Key, Config=None):
+        with open(Filename, "rb") as f:
+            self.put_object(Bucket=Bucket, Key=Key, Body=f.read())
+
+    def size(self):
+        return sum([len(data) for data, etag in self.objects.values()])
@@ -0,0 +1,169 @@
+import datetime
+import random
+
+# Synthetic database contents for the benchmarks: experiments of time ordered
+# source images, annotations and sample images on every image, and labeled
+# and image pools holding them. Everything is derived from `seed`, so two
+# runs with the same sizes produce the same database.
+
+class SyntheticSizes(object):
+
+    def __init__(self, experiments=4, images=500, anns_per_image=8, samples_per_image=8,
+                 pools=4, unfinished=0.1, unmaterialized=0.2, seed=0):
+        self.experiments = experiments
+        self.images = images # per experiment
+        self.anns_per_image = anns_per_image
+        self.samples_per_image = samples_per_image
+        self.pools = pools
+        self.unfinished = unfinished
+        self.unmaterialized = unmaterialized
+        self.seed = seed
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.experiments, args.images, args.anns_per_image, args.samples_per_image,
+                   args.pools, args.unfinished, args.unmaterialized, args.seed)
+
+    def __str__(self):
+        return "{} experiments x {} images, {} annotations and {} samples per image, {} pools".format(
+               self.experiments, self.images, self.anns_per_image, self.samples_per_image, self.pools)
+
+def add_size_args(parser):
+    parser.add_argument("--experiments", type=int, default=4)
+    parser.add_argument("--images", type=int, default=500, help="source images per experiment")
+    parser.add_argument("--anns-per-image", type=int, default=8)
+    parser.add_argument("--samples-per-image", type=int, default=8)
+    parser.add_argument("--pools", type=int, default=4)
+    parser.add_argument("--unfinished", type=float, default=0.1, help="fraction of unfinished annotations")
+    parser.add_argument("--unmaterialized", type=float, default=0.2, help="fraction of samples without an object")
+    parser.add_argument("--seed", type=int, default=0)
+
+def experiment_name(e):
+    return "exp{:03d}".format(e)
+
+def image_name(e, i):
+    return "exp{:03d}_im{:06d}".format(e, i)
+
+def pool_name(p):
+    return "pool{}".format(p)
+
+# Drops everything, including the pool statistics view and the schema
+# version, so the next migrate() starts from an empty database
+def reset(engine, metadata):
+    import migrations
+    import pool_stats
+    with engine.begin() as conn:
+        if pool_stats.is_postgres(conn.dialect):
+            conn.execute("DROP MATERIALIZED VIEW IF EXISTS " + pool_stats.VIEW)
+        else:
+            conn.execute("DROP TABLE IF EXISTS " + pool_stats.VIEW)
+    metadata.drop_all(engine)
+    migrations.schema_version.drop(engine, checkfirst=True)
+
+# Multi-row INSERTs, kept under the bind parameter limits of sqlite and asyncpg
+async def insert_chunked(database_handle, table, rows, chunk_size):
+    chunk_size = max(1, min(chunk_size, 30000 // len(rows[0])))
+    for c in range(0, len(rows), chunk_size):
+        await database_handle.execute(table.insert().values(rows[c:c+chunk_size]))
+
+async def seed(database_handle, sizes, chunk_size=5000, verbose=True):
+    from database_models import Experiment, SourceImage, ImageAnnotation, SampleImage, \
+                                LabeledPool, ImagePool, through_table
+
+    rng = random.Random(sizes.seed)
+    now = datetime.datetime(2021, 1, 1)
+    ann_links, ann_col, labeled_col = through_table(ImageAnnotation, "memberships")
+    sample_links, sample_col, pool_col = through_table(SampleImage, "memberships")
+
+    experiments = [{"name": experiment_name(e), "chip": "rev-1", "cell_line": "synthetic",
+                    "duration": float(sizes.images)} for e in range(sizes.experiments)]
+    images = []
+    annotations = []
+    samples = []
+    ann_pool_links = []
+    sample_pool_links = []
+    for e in range(sizes.experiments):
+        for i in range(sizes.images):
+            name = image_name(e, i)
+            images.append({"name": name, "s3_key": "db/exps/" + experiment_name(e) + "/images/" + name + ".png",
+                           "s3_bucket": "bench", "time": i * 0.25, "num_channels": 3,
+                           "image_resx": 2048, "image_resy": 2048, "experiment": experiment_name(e)})
+            for a in range(sizes.anns_per_image):
+                ann_id = len(annotations) + 1
+                x, y = rng.randrange(0, 1792, 256), rng.randrange(0, 1792, 256)
+                finished = rng.random() >= sizes.unfinished
+                annotations.append({"id": ann_id, "s3_key": "db/anns/{0}/y_{0}.mask".format(ann_id) if finished else "",
+                                    "s3_bucket": "bench", "in_progress": False, "finished": finished,
+                                    "created_by": "bench", "created_on": now, "updated_by": "bench",
+                                    "updated_on": now, "started_at": now, "finished_at": now,
+                                    "source_x1": x, "source_y1": y, "source_x2": x + 256, "source_y2": y + 256,
+                                    "cell_count": 0, "cell_morphology": "balled", "source_image": name})
+                ann_pool_links.append({ann_col: ann_id, labeled_col: pool_name(rng.randrange(sizes.pools))})
+            for s in range(sizes.samples_per_image):
+                sample_id = len(samples) + 1
+                x, y = rng.randrange(0, 1792, 256), rng.randrange(0, 1792, 256)
+                materialized = rng.random() >= sizes.unmaterialized
+                samples.append({"id": sample_id, "s3_key": "db/samples/{0}/X_{0}.png".format(sample_id) if materialized else "",
+                                "s3_bucket": "bench", "num_channels": 3,
+                                "source_x1": x, "source_y1": y, "source_x2": x + 256, "source_y2": y + 256,
+                                "source_image": name})
+                sample_pool_links.append({sample_col: sample_id, pool_col: pool_name(rng.randrange(sizes.pools))})
+
+    labeled_counts = {}
+    for l in ann_pool_links:
+        labeled_counts[l[labeled_col]] = labeled_counts.get(l[labeled_col], 0) + 1
+    sample_counts = {}
+    for l in sample_pool_links:
+        sample_counts[l[pool_col]] = sample_counts.get(l[pool_col], 0) + 1
+    pool_names = [pool_name(p) for p in range(sizes.pools)]
+
+    for table, rows in [(Experiment.Meta.table, experiments),
+                        (LabeledPool.Meta.table, [{"name": p, "num_images": labeled_counts.get(p, 0)} for p in pool_names]),
+                        (ImagePool.Meta.table, [{"name": p, "num_images": sample_counts.get(p, 0)} for p in pool_names]),
+                        (SourceImage.Meta.table, images),
+                        (ImageAnnotation.Meta.table, annotations),
+                        (SampleImage.Meta.table, samples),
+                        (ann_links, ann_pool_links),
+                        (sample_links, sample_pool_links)]:
+        if len(rows) > 0:
+            await insert_chunked(database_handle, table, rows, chunk_size)
+
+    # Fresh statistics, or the planner has nothing to choose indexes with
+    await database_handle.execute("ANALYZE")
+    if verbose:
+        print("Seeded {} images, {} annotations, {} sample images".format(
+              len(images), len(annotations), len(samples)))
+    return {"images": len(images), "annotations": len(annotations), "samples": len(samples)}
+
+# The same layout in the legacy JSON database format read by
+# port_custom_db_to_ormarpg.py (legacy annotation ids start at 0)
+def legacy_dict(sizes):
+    rng = random.Random(sizes.seed)
+    experiments = {}
+    ann_list = []
+    for e in range(sizes.experiments):
+        image_array = []
+        for i in range(sizes.images):
+            annotations = []
+            for a in range(sizes.anns_per_image):
+                ann_id = len(ann_list)
+                x, y = rng.randrange(0, 1792, 256), rng.randrange(0, 1792, 256)
+                finished = rng.random() >= sizes.unfinished
+                annotations.append((ann_id, (x, y), (x + 256, y + 256)))
+                ann_list.append({"ann_id": ann_id, "valid": finished, "y": {"path": ""},
+                                 "tags": [pool_name(rng.randrange(sizes.pools))]})
+            image_array.append({"name": image_name(e, i), "path": "", "time": i * 0.25,
+                                "resolution": [2048, 2048], "annotations": annotations})
+        experiments[experiment_name(e)] = {"duration": float(sizes.images),
+                                           "images": {"num_images": sizes.images, "image_array": image_array}}
+    return {"annotations": {"ann_list": ann_list}, "data": {"experiments": experiments}}
+
+# Pixels of a synthetic source image: blocky low frequency structure plus
+# noise, so it compresses about as badly as a real frame. Seeded by name.
+def source_pixels(name, shape=(2048, 2048, 3)):
+    import zlib
+    import numpy as np
+    rng = np.random.default_rng(zlib.crc32(name.encode("utf-8")))
+    blocks = rng.integers(0, 240, (shape[0] // 64 + 1, shape[1] // 64 + 1) + tuple(shape[2:]), dtype=np.uint8)
+    im = np.repeat(np.repeat(blocks, 64, axis=0), 64, axis=1)[:shape[0], :shape[1]]
+    return im + rng.integers(0, 16, im.shape, dtype=np.uint8)
@@ -1,15 +1,18 @@
 from typing import Optional, List
+import os
 import datetime
 import databases
 import pydantic
 import ormar
 import sqlalchemy
 
-DATABASE_URL = "postgresql:///laboncmos"
+# DATABASE_URL in the environment points everything at another database
+# (e.g. a scratch one for benchmarks)
+DATABASE_URL = os.environ.get("DATABASE_URL", "postgresql:///laboncmos")
 database_handle = databases.Database(DATABASE_URL)
 metadata = sqlalchemy.MetaData()
 engine = sqlalchemy.create_engine(DATABASE_URL)
-metadata.drop_all(engine)
+# Tables are created and upgraded by migrations.py, never at import
 
 #### DATA GROUPINGS ####
 
@@ -79,6 +82,9 @@ class SourceImage(ormar.Model):
     image_resx: int = ormar.Integer(minimum=0)
     image_resy: int = ormar.Integer(minimum=0)
 
+    # Optional tiled copy of the image (see tiled_images.py) for cheap crops
+    tiled_s3_key: Optional[str] = ormar.String(max_length=1000, nullable=True)
+
     experiment: Optional[Experiment] = ormar.ForeignKey(Experiment)
 
 class ImageAnnotation(ormar.Model):
@@ -114,6 +120,10 @@ class ImageAnnotation(ormar.Model):
     cell_count: int = ormar.Integer(minimum=0)
     cell_morphology: str = ormar.String(max_length=100) # "balled", "intermediate", "adhered"?
 
+    # Work queue lease, see work_queue.py
+    leased_by: Optional[str] = ormar.String(max_length=200, nullable=True)
+    lease_expires_at: Optional[datetime.datetime] = ormar.DateTime(nullable=True)
+
     source_image: Optional[SourceImage] = ormar.ForeignKey(SourceImage)
     memberships: Optional[List[LabeledPool]] = ormar.ManyToMany(LabeledPool)
 
@@ -149,3 +159,81 @@ class SampleImage(ormar.Model):
 
     def get_source_offset(self):
         return ((self.source_x1, self.source_y1), (self.source_x2, self.source_y2))
+
+# Source images of one experiment ordered by time, optionally sliced to
+# [start_time, end_time] hours. Served by ix_images_experiment_time.
+async def get_experiment_frames(experiment, start_time=None, end_time=None):
+    query = SourceImage.objects.filter(experiment__name=experiment)
+    if start_time is not None:
+        query = query.filter(time__gte=start_time)
+    if end_time is not None:
+        query = query.filter(time__lte=end_time)
+    return await query.order_by("time").all()
+
+# The materialized sample image (if any) holding exactly the crop
+# ((x1, y1), (x2, y2)) of a source image, or None. Served by
+# ix_sample_images_source_crop.
+async def get_materialized_sample(source_image, crop):
+    from sample_materializer import SAMPLE_PREFIX
+    (x1, y1), (x2, y2) = crop
+    samples = await SampleImage.objects.filter(source_image__name=source_image,
+                                               source_x1=x1, source_y1=y1,
+                                               source_x2=x2, source_y2=y2,
+                                               s3_key__startswith=SAMPLE_PREFIX) \
+                                       .limit(1).all()
+    return samples[0] if len(samples) > 0 else None
+
+# Returns the many-to-many link table behind `model.field_name` along with the
+# names of its (source, target) foreign key columns, so bulk jobs can insert
+# links directly instead of one `.add()` round trip per link
+def through_table(model, field_name):
+    field = model.Meta.model_fields[field_name]
+    through = field.through
+    src = through.get_column_alias(field.default_source_field_name())
+    tgt = through.get_column_alias(field.default_target_field_name())
+    return through.Meta.table, src, tgt
+
+#### INDEXES ####
+
+# Secondary indexes for the hot access paths. Postgres does not index foreign
+# keys by itself, and the many-to-many link tables only have their surrogate
+# primary key. Adding one here also needs a migration (see migrations.py);
+# benchmarks/queries.py measures what they buy.
+def declare_indexes():
+    images = SourceImage.Meta.table
+    annotations = ImageAnnotation.Meta.table
+    samples = SampleImage.Meta.table
+    ann_links, ann_link_ann, ann_link_pool = through_table(ImageAnnotation, "memberships")
+    sample_links, sample_link_sample, sample_link_pool = through_table(SampleImage, "memberships")
+
+    # Frames of one experiment in time order (sequencer, sequence generation)
+    sqlalchemy.Index("ix_images_experiment_time", images.c.experiment, images.c.time)
+
+    # Unfinished annotations by id (list-invalid, the next-ann work queue).
+    # Partial, so it stays small however many annotations are finished.
+    sqlalchemy.Index("ix_annotations_unfinished", annotations.c.id,
+                     postgresql_where=annotations.c.finished == False,
+                     sqlite_where=annotations.c.finished == False)
+
+    # Annotations and samples of one source image (joins, export, do-ann lookups)
+    sqlalchemy.Index("ix_annotations_source_image", annotations.c.source_image)
+    sqlalchemy.Index("ix_sample_images_source_crop", samples.c.source_image,
+                     samples.c.source_x1, samples.c.source_y1)
+
+    # Sample images still waiting for materialize-samples
+    sqlalchemy.Index("ix_sample_images_unmaterialized", samples.c.id,
+                     postgresql_where=samples.c.s3_key == "",
+                     sqlite_where=samples.c.s3_key == "")
+
+    # Pool -> members and member -> pools
+    sqlalchemy.Index("ix_ann_links_pool", ann_links.c[ann_link_pool], ann_links.c[ann_link_ann])
+    sqlalchemy.Index("ix_ann_links_ann", ann_links.c[ann_link_ann])
+    sqlalchemy.Index("ix_sample_links_pool", sample_links.c[sample_link_pool], sample_links.c[sample_link_sample])
+    sqlalchemy.Index("ix_sample_links_sample", sample_links.c[sample_link_sample])
+
+declare_indexes()
+
+SECONDARY_INDEXES = ["ix_annotations_unfinished", "ix_annotations_source_image",
+                     "ix_sample_images_source_crop", "ix_sample_images_unmaterialized",
+                     "ix_ann_links_pool", "ix_ann_links_ann",
+                     "ix_sample_links_pool", "ix_sample_links_sample"]
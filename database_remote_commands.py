@@ -1,12 +1,22 @@
-from PIL import Image
-import numpy as np
-from datetime import datetime
+import datetime
 from subprocess import Popen, DEVNULL, run
+import io
 import os
+import time
 
 from database_models import * 
 import asyncio
-import boto3
+import contextvars
+import functools
+import sqlalchemy
+import work_queue
+import migrations
+import pool_stats
+import instrumentation
+import getpass
+
+# numpy, PIL, boto3 and the modules built on them are imported by the
+# commands that need them, so the prompt comes up without paying for them
 
 # TODO: Extract to image utils
 def crop_image(im, crop):
@@ -16,25 +26,74 @@ def crop_image(im, crop):
     return im[crop[0][0]:crop[1][0], crop[0][1]:crop[1][1]]
 
 def load_image(infilename):
+    from PIL import Image
+    import numpy as np
     img = Image.open(infilename)
     img.load()
     data = np.asarray(img)
     return data
 
 def save_image(im, outfilename, grayscale=False):
+    from PIL import Image
     if grayscale is True:
         Image.fromarray(im).convert("L").save(outfilename)
     else:
         Image.fromarray(im).save(outfilename)
 
+def encode_png(im, grayscale=False):
+    from PIL import Image
+    buf = io.BytesIO()
+    if grayscale is True:
+        Image.fromarray(im).convert("L").save(buf, format="PNG")
+    else:
+        Image.fromarray(im).save(buf, format="PNG")
+    return buf.getvalue()
+
 def get_yes_no(question):
     result = input(question + " [y/n]: ")
     result = True if result.lower() == 'y' else False
     return result
 
+# input() without blocking the event loop
+async def ainput(prompt=""):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, input, prompt)
+
+async def aget_yes_no(question):
+    result = await ainput(question + " [y/n]: ")
+    return True if result.lower() == 'y' else False
+
+def parse_bool(val):
+    if isinstance(val, bool):
+        return val
+    return str(val).lower() in ('1', 'y', 'yes', 't', 'true')
+
+# CLI argument name -> (ormar filter key, value parser). These let the filtering
+# happen in SQL instead of pulling every annotation into Python first
+ANN_FILTERS = {
+               'id':          ('id', int),
+               'finished':    ('finished', parse_bool),
+               'in_progress': ('in_progress', parse_bool),
+               'created_by':  ('created_by', str),
+               'image':       ('source_image__name', str),
+               'experiment':  ('source_image__experiment__name', str),
+               'pool':        ('memberships__name', str),
+              }
+
+def parse_ann_filters(args):
+    filters = {}
+    for key, val in args.items():
+        if key not in ANN_FILTERS:
+            continue
+        field, parser = ANN_FILTERS[key]
+        filters[field] = parser(val)
+    return filters
+
 class Database(object):
 
-    def __init__(self, database_handle, metadata, engine, bucket='laboncmosdata'):
+    def __init__(self, database_handle, metadata, engine, bucket='laboncmosdata',
+                 cache_dir='.cache/s3/', cache_max_bytes=4 * 1024**3, transfer_workers=16,
+                 lease_seconds=work_queue.LEASE_SECONDS, stats_refresh_seconds=300):
 
         self.database_handle = database_handle
         self.metadata = metadata
@@ -45,104 +104,701 @@ class Database(object):
                              'list-invalid': self.cmd_handler_list_invalid_anns,
                              'list-anns':    self.cmd_handler_list_anns,
                              'do-ann':       self.cmd_handler_do_annotation,
+                             'next-ann':     self.cmd_handler_next_annotation,
+                             'cache':        self.cmd_handler_cache,
+                             'tile-images':  self.cmd_handler_tile_images,
+                             'prefetch':     self.cmd_handler_prefetch,
+                             'push-finished': self.cmd_handler_push_finished,
+                             'export-training-set': self.cmd_handler_export_training_set,
+                             'materialize-samples': self.cmd_handler_materialize_samples,
+                             'pool-stats':   self.cmd_handler_pool_stats,
+                             'stats':        self.cmd_handler_stats,
+                             'jobs':         self.cmd_handler_jobs,
+                             'wait':         self.cmd_handler_wait,
+                             'cancel':       self.cmd_handler_cancel,
                             }
+        # Commands that read from the terminal; they can not run in the
+        # background, where they would race the prompt for input lines
+        self.interactive_cmds = set(['exit', 'do-ann', 'next-ann'])
+        self.jobs = {} # job id -> (command line, task)
+        self.next_job_id = 1
+        # Who holds the leases taken by this session
+        self.annotator = os.environ.get("ANNOTATOR", getpass.getuser())
+        self.lease_seconds = lease_seconds
+        self.prefetch_task = None
+        self.stats_refresh_seconds = stats_refresh_seconds
         # Make sure all of our directories are made
         if not os.path.exists('.tmp.anns/'):
             os.mkdir('.tmp.anns/')
 
-        try:
-            self.s3_handle = boto3.client('s3') 
-        except:
-            print("Could not connect to the S3 bucket. Are your AWS credentials configured correctly?")
-            exit()
+        self.bucket = bucket
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self.transfer_workers = transfer_workers
+        self.helpers = {} # S3 client and friends, made on first use
+        self.startup_times = []
 
-        self.bucket = 'laboncmosdata'
+        # Per-command DB, S3 and decode timings, see instrumentation.py.
+        # Off unless DB_STATS is set or `stats on` is run.
+        self.stats = instrumentation.Recorder()
+        if parse_bool(os.environ.get("DB_STATS", False)):
+            self.stats.enable(database_handle)
 
+    #### S3 ####
+
+    def get_helper(self, name, make):
+        if name not in self.helpers:
+            self.helpers[name] = make()
+        return self.helpers[name]
+
+    @property
+    def s3_handle(self):
+        def make():
+            from s3_transfer import make_s3_client
+            try:
+                return instrumentation.InstrumentedS3(make_s3_client(), self.stats)
+            except Exception:
+                print("Could not connect to the S3 bucket. Are your AWS credentials configured correctly?")
+                raise
+        return self.get_helper("s3_handle", make)
+
+    @property
+    def cache(self):
+        from s3_cache import S3Cache
+        return self.get_helper("cache", lambda: S3Cache(self.s3_handle, self.cache_dir, self.cache_max_bytes))
+
+    @property
+    def tile_reader(self):
+        from tiled_images import TiledImageReader
+        return self.get_helper("tile_reader", lambda: TiledImageReader(self.s3_handle))
+
+    @property
+    def transfer(self):
+        from s3_transfer import S3TransferEngine
+        return self.get_helper("transfer", lambda: S3TransferEngine(self.s3_handle, max_workers=self.transfer_workers))
+
+    @property
+    def outbox(self):
+        from s3_transfer import Outbox
+        return self.get_helper("outbox", lambda: Outbox('.outbox/'))
+
+    # Runs fn(*args) on the default executor, in a copy of the current
+    # context so the work is attributed to the command that started it
+    def run_in_thread(self, fn, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(None, functools.partial(contextvars.copy_context().run, fn, *args))
 
     def start_db(self):
         asyncio.run(self.connect_to_db(self.database_handle))
 
+    # Connects and brings the schema up to date (see migrations.py) before
+    # handing over to the prompt. Prints how long each step took.
     async def connect_to_db(self, handle):
+        t1 = time.perf_counter()
         await handle.connect()
-        metadata.create_all(engine)
-        await self.start_command_CLI()
+        t2 = time.perf_counter()
+        old, new = await migrations.migrate(handle)
+        t3 = time.perf_counter()
+
+        self.startup_times = self.startup_times + [("connect", t2 - t1), ("schema", t3 - t2)]
+        schema = "schema v" + str(new) + (", migrated from v" + str(old) if old != new else "")
+        print("Ready in {:0.2f} s ({}; {})".format(sum([t for n, t in self.startup_times]), schema,
+              ", ".join(["{} {:0.2f} s".format(n, t) for n, t in self.startup_times])))
+
+        refresher = asyncio.ensure_future(self.refresh_pool_stats())
+        try:
+            await self.start_command_CLI()
+        finally:
+            refresher.cancel()
+
+    # Keeps the pool statistics view fresh while the CLI is open. Runs in the
+    # background, so the first refresh does not hold up the prompt, and skips
+    # the refresh when another session has just done it (see pool_stats.py).
+    async def refresh_pool_stats(self):
+        while True:
+            try:
+                await pool_stats.refresh(self.database_handle, max_age=self.stats_refresh_seconds)
+            except Exception as e:
+                print("\n    Refreshing the pool statistics failed (" + str(e) + ")")
+            await asyncio.sleep(self.stats_refresh_seconds)
 
     async def leave_db(self, **args):
         print("Goodbye!")
 
+    # Yields annotations page by page, with their source image and labeled
+    # pool memberships joined in. Pages are keyed on the (indexed) primary key
+    # so each page is one query no matter how deep into the table we are.
+    async def iterate_anns(self, filters={}, limit=None, offset=0, page_size=500):
+        query = ImageAnnotation.objects.select_related(["source_image", "memberships"])
+        query = query.filter(**filters).order_by("id")
+
+        last_id = None
+        remaining = limit
+        while remaining is None or remaining > 0:
+            n = page_size if remaining is None else min(page_size, remaining)
+            if last_id is None:
+                page = query.offset(offset) if offset > 0 else query
+            else:
+                page = query.filter(id__gt=last_id)
+            anns = await page.limit(n).all()
+
+            for a in anns:
+                yield a
+
+            if len(anns) < n:
+                break
+            last_id = anns[-1].id
+            if remaining is not None:
+                remaining = remaining - len(anns)
+
     async def cmd_handler_list_invalid_anns(self, **args):
-        invalid_anns = {'finished': False}
-        await self.cmd_handler_list_anns(**invalid_anns)
+        args['finished'] = False
+        await self.cmd_handler_list_anns(**args)
 
     async def cmd_handler_list_anns(self, **args):
-        anns = await ImageAnnotation.objects.all(**args)
-        for a in anns:
-            ms = await a.memberships.all()
-            print(str(a.id) + ":", a.source_image.name + ",", ms[0].name)
+        filters = parse_ann_filters(args)
+        limit = int(args["limit"]) if "limit" in args else None
+        offset = int(args.get("offset", 0))
+        page_size = int(args.get("page_size", 500))
+
+        count = 0
+        async for a in self.iterate_anns(filters, limit, offset, page_size):
+            pools = ", ".join([m.name for m in a.memberships]) if a.memberships else "<no pool>"
+            print(str(a.id) + ":", a.source_image.name + ",", pools, flush=(count % page_size == 0))
+            count = count + 1
+
+        print("Found " + str(count) + " annotations matching the given criteria.")
+
+    # (bucket, key, is_sample) of the smallest object holding the pixels of
+    # `ann`: a sample of the same rectangle cut by materialize-samples if
+    # there is one, else the source image. None if the crop is read from a
+    # tiled source instead. Sample keys from elsewhere (e.g. the legacy
+    # import) are not trusted, they may not exist or be lossy JPEGs.
+    async def ann_pixel_object(self, ann):
+        sample = await get_materialized_sample(ann.source_image.name, ann.get_source_offset())
+        if sample is not None:
+            return sample.s3_bucket, sample.s3_key, True
+        return await self.source_pixel_object(ann)
+
+    async def source_pixel_object(self, ann):
+        source_image = await SourceImage.objects.get(name=ann.source_image.name)
+        if source_image.tiled_s3_key:
+            return None
+        return source_image.s3_bucket, source_image.s3_key, False
+
+    # Decodes a cached S3 image. The entry is pinned while it is read, so a
+    # concurrent eviction can not remove it in between.
+    def read_image(self, bucket, key):
+        with self.cache.pinned(bucket, key) as path:
+            with self.stats.timer("decode"):
+                return load_image(path)
+
+    # Decodes a stored label mask (either format, see label_masks.py)
+    def read_mask(self, bucket, key):
+        from label_masks import read_label_mask
+        with self.cache.pinned(bucket, key) as path:
+            return read_label_mask(path)
+
+    # read(bucket, key) of the pixel object of `ann` and whether it is a
+    # sample, or None for a tiled source. A sample object that has gone
+    # missing from S3 falls back to the source image.
+    async def read_pixel_object(self, ann, read):
+        from s3_transfer import is_not_found
+        obj = await self.ann_pixel_object(ann)
+        if obj is not None and obj[2]:
+            try:
+                return await self.run_in_thread(read, obj[0], obj[1]), True
+            except Exception as e:
+                if not is_not_found(e):
+                    raise
+            obj = await self.source_pixel_object(ann)
+        if obj is None:
+            return None
+        return await self.run_in_thread(read, obj[0], obj[1]), False
+
+    async def load_ann_pixels(self, ann):
+        loaded = await self.read_pixel_object(ann, self.read_image)
+        if loaded is None:
+            source_image = await SourceImage.objects.get(name=ann.source_image.name)
+            with self.stats.timer("tile-read"):
+                return await self.run_in_thread(self.tile_reader.read_crop, source_image.s3_bucket,
+                                                source_image.tiled_s3_key, ann.get_source_offset())
 
-        print("Found " + str(len(anns)) + " annotations matching the given criteria.")
+        X, is_sample = loaded
+        if is_sample:
+            return X
+        with self.stats.timer("crop"):
+            return crop_image(X, ann.get_source_offset())
 
-    # Args is a list of tags
+    # Warms the cache with the pixels of an annotation someone is likely to
+    # open next. Best effort, a failure here only means a slower next-ann.
+    async def prefetch_ann(self, ann_id):
+        try:
+            ann = await ImageAnnotation.objects.select_related("source_image").get(id=ann_id)
+            await self.read_pixel_object(ann, self.cache.get_path)
+        except Exception as e:
+            print("\n    Prefetch of annotation " + str(ann_id) + " failed (" + str(e) + ")")
+
+    # Keeps a lease alive until cancelled
+    async def heartbeat(self, ann_id):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            if not await work_queue.renew(self.database_handle, ann_id, self.annotator, self.lease_seconds):
+                print("\n    Lost the lease on annotation " + str(ann_id) + ", someone else may take it")
+                return
+
+    # Opens one annotation in the annotation tool. The annotation is leased
+    # while the tool is open, so nobody else gets it from next-ann.
+    # Usage: do-ann id=<id> [force=true]
     async def cmd_handler_do_annotation(self, **args):
         # First, we make sure we got an id
         if "id" not in args.keys():
             print("    Must provide named argument \"id\" with do_annotation")
-        
-        ann = await ImageAnnotation.objects.get(id=int(args["id"]))
-        key = ""
-        if ann.s3_key == "":
-            key = "db/anns/" + str(args["id"]) + "/y_" + str(args["id"]) + ".png"
-            print("    Annotation is blank. Creating new annotation")
+            return
+        return await self.open_annotation(int(args["id"]), force=parse_bool(args.get("force", False)))
 
-            source_image = await SourceImage.objects.get(name=ann.source_image.name)
-            size = ann.get_image_size() 
-            crop = ann.get_source_offset()
+    # `claimed` is for callers that already hold the lease (next-ann); it is
+    # not reachable from the prompt. `force` takes the lease over.
+    async def open_annotation(self, ann_id, *, claimed=False, force=False):
+        if not claimed:
+            if not await work_queue.claim(self.database_handle, ann_id, self.annotator, self.lease_seconds, force):
+                print("    Annotation " + str(ann_id) + " is leased by someone else. Use force=true to take it anyway")
+                return
+            if force:
+                print("    Leased annotation " + str(ann_id) + " (forced, any other holder loses it)")
 
-            tmp_filename = '.tmp.anns/src.png'
-            print("    Fetching source image...")
-            with open(tmp_filename, 'wb') as f:
-                self.s3_handle.download_fileobj(self.bucket, source_image.s3_key, f)
-            print("    Source image downloaded. Opening annotation tool")
-            im = load_image(tmp_filename)
-            X = np.expand_dims(crop_image(im, crop), axis=0)
-            y = np.expand_dims(np.expand_dims(np.zeros(size), axis=-1), axis=0)
-            print(y.shape)
-            np.savez('.tmp.npz', X=X, y=y)
+        heartbeat = asyncio.ensure_future(self.heartbeat(ann_id))
+        finished = False
+        try:
+            finished = await self.annotate(ann_id)
+        finally:
+            heartbeat.cancel()
+            if not finished:
+                await work_queue.release(self.database_handle, ann_id, self.annotator)
+        return finished
+
+    # Claims the next unfinished annotation (optionally from one labeled
+    # pool) and opens it. The pixels of the one after it are prefetched in
+    # the background meanwhile.
+    # Usage: next-ann [pool=<name>]
+    async def cmd_handler_next_annotation(self, **args):
+        pool = args.get("pool")
+        ann_id = await work_queue.claim_next(self.database_handle, self.annotator, self.lease_seconds, pool)
+        if ann_id is None:
+            print("    No unclaimed annotations left" + (" in " + pool if pool else ""))
+            return
+        print("    Claimed annotation " + str(ann_id))
 
+        next_id = await work_queue.peek_next(self.database_handle, ann_id, pool)
+        if next_id is not None:
+            self.prefetch_task = asyncio.ensure_future(self.prefetch_ann(next_id))
+        return await self.open_annotation(ann_id, claimed=True)
+
+    # Returns True if the annotation was finished and uploaded
+    async def annotate(self, ann_id):
+        import numpy as np
+        from label_masks import encode_mask, mask_key
+
+        ann = await ImageAnnotation.objects.select_related("source_image").get(id=ann_id)
+        # Masks are always written in the label mask format, under a key of
+        # their own, so an update never replaces the object of another upload
+        version = datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
+        key = mask_key(ann.id, version)
+        if ann.s3_key == "":
+            print("    Annotation is blank. Creating new annotation")
+            print("    Fetching source image...")
+            X = await self.load_ann_pixels(ann)
+            y = np.zeros(ann.get_image_size())
         else:
-            key = ann.s3_key
-            print("    Annotation exists in database. Update? [y/n]: ")
+            if not await aget_yes_no("    Annotation exists in database. Update?"):
+                return False
+            print("    Fetching source image and labels...")
+            X = await self.load_ann_pixels(ann)
+            y = await self.run_in_thread(self.read_mask, ann.s3_bucket, ann.s3_key)
+
+        # The tool takes a batch of one image with a channel axis on the labels.
+        # Its save file is removed first: one left over from the previous
+        # annotation must never be uploaded as this one.
+        print("    Source image ready. Opening annotation tool")
+        if os.path.exists('.tmp_save_version_0.npz'):
+            os.remove('.tmp_save_version_0.npz')
+        np.savez('.tmp.npz', X=np.expand_dims(X, axis=0), y=np.expand_dims(np.expand_dims(y, axis=-1), axis=0))
 
-            with open('.tmp.anns/ann.png', 'wb') as f:
-                self.s3_handle.download_fileobj(self.bucket, ann.s3_key, f)
-    
-        caliban_proc = Popen(['python3', 'deepcell-label/desktop/caliban.py', '-rgb', 'RGB', '.tmp.npz'])
+        # From starting the annotation tool until the annotator answers
+        with self.stats.timer("caliban"):
+            caliban_proc = Popen(['python3', 'deepcell-label/desktop/caliban.py', '-rgb', 'RGB', '.tmp.npz'])
+            completed = await aget_yes_no("Did you complete the annotation?")
 
-        if get_yes_no("Did you complete the annotation?") and os.path.isfile('.tmp_save_version_0.npz'):
+        if completed and os.path.isfile('.tmp_save_version_0.npz'):
             finished_ann = np.load('.tmp_save_version_0.npz')
-            save_image(np.squeeze(finished_ann['y']), ".tmp.upload.png", grayscale=True)
-            self.s3_handle.upload_file(".tmp.upload.png", self.bucket, key)
+            with self.stats.timer("encode"):
+                data = encode_mask(np.squeeze(finished_ann['y']))
+
+            # Encoded in memory and sent straight to S3. Only a failed upload
+            # is staged in the outbox, to be retried later with push-finished
+            try:
+                await self.run_in_thread(self.transfer.put_one, self.bucket, key, data)
+            except Exception as e:
+                self.outbox.add(key.rsplit("/", 1)[-1], data, self.bucket, key, ann_id=ann.id,
+                                annotator=self.annotator)
+                print("    Upload failed (" + str(e) + "), kept in the outbox. Retry with push-finished")
+                return False
+            if not await self.mark_ann_finished(ann.id, self.bucket, key):
+                # Someone else holds the annotation now; keep this version
+                # locally instead of finishing over their work
+                kept = "lost_ann_" + str(ann.id) + "_" + version + ".npz"
+                os.replace('.tmp_save_version_0.npz', kept)
+                print("    Lost the lease on annotation " + str(ann.id) + " to someone else; it was not " +
+                      "marked finished. Your labels are kept in " + kept)
+                return False
+            print("    Uploaded " + str(len(data)) + " bytes to " + key)
+            return True
+        return False
+
+    async def cmd_handler_cache(self, **args):
+        if parse_bool(args.get("clear", False)):
+            await self.run_in_thread(self.cache.clear)
+            print("    Cleared the S3 cache at " + self.cache.cache_dir)
+
+        stats = self.cache.stats()
+        print("    hits: {}, misses: {}, hit rate: {:.1%}, evictions: {}".format(
+              stats['hits'], stats['misses'], stats['hit_rate'], stats['evictions']))
+        print("    size: {:.1f} MB of {:.1f} MB".format(stats['size_bytes'] / 1024**2,
+                                                     stats['max_bytes'] / 1024**2))
+
+    # Downloads, decodes, tiles and uploads one source image. Blocking, run
+    # it through run_in_thread. Returns the key of the tiled object.
+    def tile_image(self, bucket, key, tile_size):
+        from tiled_images import encode_tiled, tiled_key
+        im = self.read_image(bucket, key)
+        tiled = tiled_key(key)
+        self.s3_handle.put_object(Bucket=bucket, Key=tiled, Body=encode_tiled(im, tile_size))
+        self.tile_reader.forget(bucket, tiled)
+        return tiled
+
+    # Converts source images to the tiled format so crops can be fetched with
+    # ranged GETs. Usage: tile-images [experiment=<name>] [tile=256] [force=true]
+    async def cmd_handler_tile_images(self, **args):
+        tile_size = int(args.get("tile", 256))
+        force = parse_bool(args.get("force", False))
+
+        query = SourceImage.objects
+        if "experiment" in args:
+            query = query.filter(experiment__name=args["experiment"])
+        if not force:
+            query = query.filter(tiled_s3_key__isnull=True)
+        images = await query.all()
+
+        print("    Tiling " + str(len(images)) + " source images...")
+        for i, source_image in enumerate(images):
+            key = await self.run_in_thread(self.tile_image, source_image.s3_bucket, source_image.s3_key, tile_size)
+            await source_image.update(tiled_s3_key=key)
+            print("    " + str(i + 1) + "/" + str(len(images)) + ": " + source_image.name + " -> " + key)
+
+    # (bucket, key) pairs of the S3 objects a prefetch request refers to
+    async def prefetch_items(self, args):
+        items = set()
+        if "pool" in args:
+            samples = await SampleImage.objects.select_related("source_image") \
+                                               .filter(memberships__name=args["pool"]).all()
+            for smp in samples:
+                items.add((smp.source_image.s3_bucket, smp.source_image.s3_key))
+                if smp.s3_key != "":
+                    items.add((smp.s3_bucket, smp.s3_key))
+        if "labeled" in args:
+            async for a in self.iterate_anns({"memberships__name": args["labeled"]}):
+                items.add((a.source_image.s3_bucket, a.source_image.s3_key))
+                if a.s3_key != "":
+                    items.add((a.s3_bucket, a.s3_key))
+        if "experiment" in args:
+            images = await SourceImage.objects.filter(experiment__name=args["experiment"]).all()
+            for im in images:
+                items.add((im.s3_bucket, im.s3_key))
+        return sorted(items)
+
+    # Pulls every object behind an image pool, labeled pool or experiment into
+    # the local cache in parallel.
+    # Usage: prefetch pool=<name> | labeled=<name> | experiment=<name>
+    async def cmd_handler_prefetch(self, **args):
+        if not any([k in args for k in ["pool", "labeled", "experiment"]]):
+            print("    Must provide one of pool=, labeled= or experiment= with prefetch")
+            return
+
+        items = await self.prefetch_items(args)
+        print("    Prefetching " + str(len(items)) + " objects...")
+        report = await self.run_in_thread(self.transfer.prefetch, self.cache, items)
+        for item, e in report.failures[:10]:
+            print("    Failed: " + item[1] + " (" + str(e) + ")")
+
+    # Finishes an annotation this session holds (see work_queue.finish).
+    # Returns False if the lease went to someone else.
+    async def mark_ann_finished(self, ann_id, bucket, key, now=None, annotator=None, released_ok=False):
+        return await work_queue.finish(self.database_handle, ann_id, annotator or self.annotator,
+                                       bucket, key, now, released_ok)
+
+    # Uploads everything waiting in the outbox in parallel and marks the
+    # matching annotations finished
+    async def cmd_handler_push_finished(self, **args):
+        entries = self.outbox.entries()
+        if len(entries) == 0:
+            print("    Nothing to push.")
+            return
+
+        items = [(path, info["bucket"], info["key"]) for path, info in entries]
+        report = await self.run_in_thread(self.transfer.upload_many, items)
+        failed = set([item[0] for item, e in report.failures])
+
+        # The lease was given back when the upload failed, so the annotation
+        # is finished as long as nobody else took or finished it since
+        now = datetime.datetime.now()
+        for path, info in entries:
+            if path in failed:
+                continue
+            if "ann_id" in info and not await self.mark_ann_finished(info["ann_id"], info["bucket"], info["key"],
+                                                                     now, info.get("annotator"), released_ok=True):
+                print("    Annotation " + str(info["ann_id"]) + " was taken or finished by someone else, " +
+                      "not marked finished. Its labels stay in " + path)
+                continue
+            self.outbox.remove(path)
+
+        for item, e in report.failures:
+            print("    Failed to push " + item[2] + " (" + str(e) + "), kept in the outbox")
+
+    # Cuts finished annotations into (X, y) training tiles, see training_export.py.
+    # Accepts the list-anns filters (pool=, experiment=, ...).
+    # Usage: export-training-set out=<dir> [tile=256] [shard_size=4096] [workers=N] [labels=16|32]
+    async def cmd_handler_export_training_set(self, **args):
+        import numpy as np
+        from training_export import export_training_set
+
+        if "out" not in args:
+            print("    Must provide named argument \"out\" with export-training-set")
+            return
+
+        filters = parse_ann_filters(args)
+        filters["finished"] = True
+
+        # Group by source image so each one is downloaded and decoded once
+        groups = {}
+        async for a in self.iterate_anns(filters):
+            if a.s3_key == "":
+                continue
+            src = (a.source_image.s3_bucket, a.source_image.s3_key)
+            groups.setdefault(src, []).append({"id": a.id, "bucket": a.s3_bucket, "key": a.s3_key,
+                                               "crop": a.get_source_offset()})
+        groups = [(bucket, key, anns) for (bucket, key), anns in groups.items()]
+        print("    Found " + str(sum([len(g[2]) for g in groups])) + " finished annotations on " +
+              str(len(groups)) + " source images")
+
+        workers = int(args["workers"]) if "workers" in args else None
+        await self.run_in_thread(lambda: export_training_set(
+                                 groups, args["out"], self.cache, self.transfer,
+                                 tile=int(args.get("tile", 256)),
+                                 shard_size=int(args.get("shard_size", 4096)),
+                                 workers=workers,
+                                 label_dtype=np.uint32 if str(args.get("labels", 16)) == "32" else np.uint16))
 
+    # Cuts and uploads the S3 objects of sample images that do not have one
+    # yet (e.g. made by generate_sequences.py), one source image at a time.
+    # Usage: materialize-samples [pool=<name>] [experiment=<name>] [limit=N] [batch=16]
+    async def cmd_handler_materialize_samples(self, **args):
+        from sample_materializer import materialize_batch
+
+        query = SampleImage.objects.select_related("source_image").filter(s3_key="")
+        if "pool" in args:
+            query = query.filter(memberships__name=args["pool"])
+        if "experiment" in args:
+            query = query.filter(source_image__experiment__name=args["experiment"])
+        query = query.order_by("id")
+        if "limit" in args:
+            query = query.limit(int(args["limit"]))
+        samples = await query.all()
+
+        groups = {}
+        for smp in samples:
+            src = (smp.source_image.s3_bucket, smp.source_image.s3_key)
+            groups.setdefault(src, []).append((smp.id, smp.s3_bucket, smp.get_source_offset()))
+        groups = [(bucket, key, smps) for (bucket, key), smps in groups.items()]
+        print("    Materializing " + str(len(samples)) + " sample images from " +
+              str(len(groups)) + " source images...")
+
+        # Keys are written per batch, so an interrupted run picks up where it stopped
+        sample_table = SampleImage.Meta.table
+        batch_size = int(args.get("batch", 16))
+        total = 0
+        for b in range(0, len(groups), batch_size):
+            done, failures = await self.run_in_thread(materialize_batch,
+                                                      groups[b:b+batch_size], self.cache, self.transfer)
+            if len(done) > 0:
+                # One UPDATE ... CASE per batch instead of a statement per sample
+                keys = dict(done)
+                await self.database_handle.execute(
+                        sample_table.update()
+                                    .where(sample_table.c.id.in_(list(keys.keys())))
+                                    .values(s3_key=sqlalchemy.case(keys, value=sample_table.c.id)))
+            total = total + len(done)
+            for key, e in failures[:10]:
+                print("    Failed: " + key + " (" + str(e) + ")")
+        print("    " + str(total) + " of " + str(len(samples)) + " sample images materialized.")
+
+    # Pool sizes and progress from the pool statistics view (see pool_stats.py).
+    # Usage: pool-stats [pool=<name>] [experiments=true] [refresh=true]
+    async def cmd_handler_pool_stats(self, **args):
+        if parse_bool(args.get("refresh", False)):
+            if not await pool_stats.refresh(self.database_handle):
+                print("    Another session is refreshing the pool statistics, showing the last refresh.")
+        rows = await pool_stats.read(self.database_handle, args.get("pool"))
+        if len(rows) == 0:
+            print("    No pool statistics" + (" for " + args["pool"] if "pool" in args else "") +
+                  ". Refresh them with refresh=true")
+            return
+
+        per_experiment = parse_bool(args.get("experiments", "pool" in args))
+        totals = {}
+        for r in rows:
+            key = (r["kind"], r["pool"])
+            t = totals.setdefault(key, [0, 0, 0])
+            totals[key] = [t[0] + r["num_images"], t[1] + r["finished"], t[2] + r["in_progress"]]
+
+        print("    {:<8} {:<24} {:>8} {:>9} {:>12} {:>11}".format(
+              "kind", "pool", "images", "finished", "in progress", "unfinished"))
+        for (kind, pool), (n, finished, in_progress) in sorted(totals.items()):
+            print("    {:<8} {:<24} {:>8} {:>9} {:>12} {:>11}".format(
+                  kind, pool, n, finished, in_progress, n - finished))
+            if per_experiment:
+                for r in rows:
+                    if r["kind"] == kind and r["pool"] == pool:
+                        print("      {:<30} {:>8} {:>9} {:>12} {:>11}".format(
+                              r["experiment"] or "<none>", r["num_images"], r["finished"],
+                              r["in_progress"], r["num_images"] - r["finished"]))
+        print("    As of " + str(rows[0]["refreshed_at"]))
+
+    # stats [on|off] [reset] [command=<name>] [trace=<file.json>]
+    # Turns the per-command instrumentation on or off, prints its histograms
+    # and writes the recorded calls as a Chrome trace
+    async def cmd_handler_stats(self, **args):
+        if parse_bool(args.get("on", False)):
+            self.stats.enable(self.database_handle)
+            print("    Instrumentation on")
+        if parse_bool(args.get("off", False)):
+            self.stats.disable()
+            print("    Instrumentation off")
+        if parse_bool(args.get("reset", False)):
+            self.stats.reset()
+            print("    Cleared the recorded statistics")
+        if "trace" in args:
+            n = self.stats.export_trace(args["trace"])
+            print("    Wrote " + str(n) + " trace events to " + args["trace"] +
+                  " (open in chrome://tracing or ui.perfetto.dev)")
+            return
+        if any([k in args for k in ["on", "off", "reset"]]):
+            return
+
+        if len(self.stats.commands()) == 0:
+            print("    Nothing recorded" + ("" if self.stats.enabled else ", turn the instrumentation on with \"stats on\""))
+            return
+        self.stats.print_report(args.get("command"))
+
+    #### JOBS ####
+
+    def start_job(self, line, coro):
+        job_id = self.next_job_id
+        self.next_job_id = self.next_job_id + 1
+        task = asyncio.ensure_future(coro)
+        self.jobs[job_id] = (line, task)
+
+        def report(t):
+            if t.cancelled():
+                print("\n[" + str(job_id) + "] cancelled: " + line)
+            elif t.exception() is not None:
+                print("\n[" + str(job_id) + "] failed: " + line + " (" + repr(t.exception()) + ")")
+            else:
+                print("\n[" + str(job_id) + "] done: " + line)
+
+        task.add_done_callback(report)
+        print("[" + str(job_id) + "] started in the background")
+        return job_id
+
+    def get_job(self, args):
+        if "id" not in args or int(args["id"]) not in self.jobs:
+            print("    Must provide the id of a known job, see \"jobs\"")
+            return None
+        return self.jobs[int(args["id"])][1]
+
+    async def cmd_handler_jobs(self, **args):
+        for job_id, (line, task) in sorted(self.jobs.items()):
+            state = "running" if not task.done() else ("cancelled" if task.cancelled() else "done")
+            print("    [" + str(job_id) + "] " + state + ": " + line)
+        # Forget finished jobs once they have been listed
+        for job_id in [j for j, (l, t) in self.jobs.items() if t.done()]:
+            del self.jobs[job_id]
+
+    async def cmd_handler_wait(self, **args):
+        tasks = [t for l, t in self.jobs.values()] if "id" not in args else [self.get_job(args)]
+        tasks = [t for t in tasks if t is not None]
+        if len(tasks) > 0:
+            await asyncio.wait(tasks)
+
+    async def cmd_handler_cancel(self, **args):
+        task = self.get_job(args)
+        if task is not None:
+            task.cancel()
+
+    # Runs a command inside its own instrumentation span
+    async def run_command(self, cmd, kv):
+        with self.stats.command(cmd):
+            return await self.cmd_handlers[cmd](**kv)
+
+    def print_help(self):
+        print("Here's a list of available commands: ")
+        cmds = list(self.cmd_handlers.keys())
+        cmds.sort()
+        for cmd in cmds: 
+            print("    " + cmd)
+        print("End a command with \"&\" to run it in the background (not " +
+              ", ".join(sorted(self.interactive_cmds)) + ").")
 
     # WARNING: This hands over control from the main program to the object 
+    # Input is read in an executor thread so background jobs (transfers,
+    # prefetches, DB keepalives) keep running while the prompt waits.
     async def start_command_CLI(self):
         cmd = ""
 
         while cmd != "exit":
-            cmd = input(self.prompt) 
-            cmd = cmd.split(' ')
+            line = (await ainput(self.prompt)).strip()
+            background = line.endswith('&')
+            if background:
+                line = line[:-1].strip()
+
+            cmd = line.split()
+            if len(cmd) == 0:
+                continue
             cmd, args = cmd[0], cmd[1:]
-            kv = dict([tuple(a.split('=')) for a in args])
-            try:
-                await self.cmd_handlers[cmd](**kv)
-            except KeyError:
+            kv = dict([tuple(a.split('=', 1)) if '=' in a else (a, True) for a in args])
+
+            if cmd not in self.cmd_handlers:
                 if cmd.lower() != 'help':
                     print("Command not found.")
-                print("Here's a list of available commands: ")
-                cmds = list(self.cmd_handlers.keys())
-                cmds.sort()
-                for cmd in cmds: 
-                    print("    " + cmd)
+                self.print_help()
+                continue
+
+            if background:
+                if cmd in self.interactive_cmds:
+                    print("    " + cmd + " asks for input and can not run in the background.")
+                    continue
+                self.start_job(line, self.run_command(cmd, kv))
+                continue
+
+            try:
+                await self.run_command(cmd, kv)
             except KeyboardInterrupt:
                 print("\n\nCommand aborted.\n")
+            except Exception as e:
+                print("    " + cmd + " failed: " + repr(e))
 
+        running = [t for l, t in self.jobs.values() if not t.done()]
+        if len(running) > 0:
+            print("Cancelling " + str(len(running)) + " background jobs.")
+            for t in running:
+                t.cancel()
+            await asyncio.wait(running)
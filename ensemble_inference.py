@@ -0,0 +1,257 @@
+import os
+import time
+import shutil
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+
+# Ensemble uncertainty for active learning. Inference runs model major: each
+# member's weights are loaded once and the whole pool is swept in batches,
+# while the per-pixel variance across members is accumulated online with
+# Welford's algorithm. Only the running mean and sum of squared deviations
+# are kept, so memory does not grow with the ensemble size. They cover the
+# whole pool in memory-mapped files (in `state_dir`, or a temporary directory),
+# so each member's weights are loaded once. Passing `chunk_size` instead keeps
+# them in RAM for one super-chunk of the pool at a time, at the price of
+# reloading every member once per chunk.
+#
+# With 2 classes the softmax outputs are p and 1 - p, which have the same
+# variance, so only the first channel is accumulated and counted twice.
+
+def state_channels(n_classes):
+    return 1 if n_classes == 2 else n_classes
+
+def welford_state(shape, state_dir=None, dtype=np.float32):
+    if state_dir is None:
+        return np.zeros(shape, dtype=dtype), np.zeros(shape, dtype=dtype)
+
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+    mean = np.lib.format.open_memmap(os.path.join(state_dir, 'mean.npy'), mode='w+', dtype=dtype, shape=shape)
+    m2 = np.lib.format.open_memmap(os.path.join(state_dir, 'm2.npy'), mode='w+', dtype=dtype, shape=shape)
+    mean[:] = 0
+    m2[:] = 0
+    return mean, m2
+
+def welford_update(mean, m2, x, n):
+    # n is the number of samples including x
+    delta = x - mean
+    mean += delta / n
+    m2 += delta * (x - mean)
+
+# Reduces the Welford state of `num_models` members to uncertainties: the
+# variance across members summed over `n_classes` classes. Always returns the
+# per-image mean uncertainty, and the per-pixel map too if `pixelwise` is set.
+def reduce_uncertainty(m2, num_models, batch_size=32, pixelwise=True, n_classes=2):
+    N = m2.shape[0]
+    scale = n_classes / m2.shape[-1] # 2 when only one of 2 classes is kept
+    imagewise = np.zeros(N)
+    pixel_map = np.zeros(m2.shape[:-1], dtype=m2.dtype) if pixelwise else None
+
+    for n in range(0, N, batch_size):
+        uncertainty = np.sum(m2[n:n+batch_size] * (scale / num_models), axis=-1)
+        imagewise[n:n+batch_size] = np.mean(np.reshape(uncertainty, (uncertainty.shape[0], -1)), axis=1)
+        if pixelwise:
+            pixel_map[n:n+batch_size] = uncertainty
+
+    return imagewise, pixel_map
+
+# Merges the Welford state (n_b, mean_b, m2_b) into (n_a, mean_a, m2_a) in
+# place (Chan et al. parallel variance), one batch of images at a time
+def welford_merge(n_a, mean_a, m2_a, n_b, mean_b, m2_b, batch_size=32):
+    n = n_a + n_b
+    for i in range(0, mean_a.shape[0], batch_size):
+        delta = mean_b[i:i+batch_size] - mean_a[i:i+batch_size]
+        mean_a[i:i+batch_size] += delta * (n_b / n)
+        m2_a[i:i+batch_size] += m2_b[i:i+batch_size] + delta**2 * (n_a * n_b / n)
+    return n
+
+def predict_output(model, images):
+    return model.predict(images)[-1] # last_only=False models return every skip output
+
+# The network used by the active learning loop. Lives here (not in the
+# script) so worker processes can build it themselves.
+def build_fgbg_model(input_shape, receptive_field=127, n_skips=3):
+    from deepcell import model_zoo
+    return model_zoo.bn_feature_net_skip_2D(
+        n_features=2, # foreground, background (i.e. cell, not cell)
+        receptive_field=receptive_field,
+        n_skips=n_skips,
+        n_conv_filters=64,
+        n_dense_filters=128,
+        input_shape=tuple(input_shape),
+        last_only=False
+    )
+
+def accumulate_members(model, weight_paths, X, mean, m2, batch_size=32, verbose=True):
+    N = X.shape[0]
+    channels = mean.shape[-1]
+    t1 = time.perf_counter()
+    for i, path in enumerate(weight_paths):
+        model.load_weights(path)
+        for n in range(0, N, batch_size):
+            pred = predict_output(model, X[n:n+batch_size])[..., :channels]
+            welford_update(mean[n:n+batch_size], m2[n:n+batch_size], pred, i + 1)
+
+        if verbose:
+            t2 = time.perf_counter()
+            print('Model', i + 1, 'of', len(weight_paths), f'swept {N} images, {t2 - t1:0.2f} seconds elapsed...')
+
+# Sweeps `X` (N x H x W x C) through every member in `weight_paths` using a
+# single `model` whose weights are swapped once per member. The accumulators
+# are memmapped in `state_dir`, or in a temporary directory if it is None,
+# unless `chunk_size` asks for the chunked in-RAM sweep (see above). Returns
+# (imagewise, pixelwise); pixelwise is None unless requested.
+def ensemble_uncertainty(model, weight_paths, X, batch_size=32, n_classes=2,
+                         pixelwise=True, state_dir=None, chunk_size=None, verbose=True):
+    N = X.shape[0]
+    channels = state_channels(n_classes)
+    if chunk_size is None:
+        with tempfile.TemporaryDirectory(prefix='.tmp.ensemble.', dir='.') as tmp_dir:
+            mean, m2 = welford_state(X.shape[:-1] + (channels,), state_dir or tmp_dir)
+            accumulate_members(model, weight_paths, X, mean, m2, batch_size, verbose)
+            result = reduce_uncertainty(m2, len(weight_paths), batch_size, pixelwise, n_classes)
+            del mean, m2
+        return result
+
+    imagewise = np.zeros(N)
+    pixel_map = np.zeros(X.shape[:-1], dtype=np.float32) if pixelwise else None
+    for start in range(0, N, chunk_size):
+        X_chunk = X[start:start+chunk_size]
+        if verbose and N > chunk_size:
+            print(f'Images {start} to {start + X_chunk.shape[0]} of {N}:')
+        mean, m2 = welford_state(X_chunk.shape[:-1] + (channels,))
+        accumulate_members(model, weight_paths, X_chunk, mean, m2, batch_size, verbose)
+        chunk_imagewise, chunk_pixel_map = reduce_uncertainty(m2, len(weight_paths), batch_size,
+                                                              pixelwise, n_classes)
+        imagewise[start:start+chunk_size] = chunk_imagewise
+        if pixelwise:
+            pixel_map[start:start+chunk_size] = chunk_pixel_map
+    return imagewise, pixel_map
+
+#### MULTI-PROCESS INFERENCE ####
+
+# CPU nodes have many cores but a single predict call does not use them all.
+# Each worker process builds the model once and either takes a contiguous
+# shard of the pool (mode='shard', every member) or a subset of the members
+# (mode='member', whole pool). Images are shared through a read-only .npy
+# memmap rather than pickled to every worker.
+
+def limit_threads(threads):
+    if threads is None:
+        return
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS']:
+        os.environ[var] = str(threads)
+
+def shard_worker(job):
+    wid, build_model, weight_paths, X_path, start, stop, batch_size, pixel_path, threads = job
+    limit_threads(threads)
+    t1 = time.perf_counter()
+
+    X = np.load(X_path, mmap_mode='r')
+    model = build_model(X.shape[1:])
+    imagewise, pixel_map = ensemble_uncertainty(model, weight_paths, X[start:stop], batch_size,
+                                                pixelwise=pixel_path is not None, verbose=False)
+    if pixel_path is not None:
+        out = np.load(pixel_path, mmap_mode='r+')
+        out[start:stop] = pixel_map
+        out.flush()
+
+    return wid, stop - start, len(weight_paths), imagewise, time.perf_counter() - t1
+
+def member_worker(job):
+    wid, build_model, weight_paths, X_path, batch_size, n_classes, state_dir, threads = job
+    limit_threads(threads)
+    t1 = time.perf_counter()
+
+    X = np.load(X_path, mmap_mode='r')
+    model = build_model(X.shape[1:])
+    mean, m2 = welford_state(X.shape[:-1] + (state_channels(n_classes),), state_dir)
+    accumulate_members(model, weight_paths, X, mean, m2, batch_size, verbose=False)
+    mean.flush()
+    m2.flush()
+
+    return wid, X.shape[0], len(weight_paths), None, time.perf_counter() - t1
+
+def as_npy_file(X, tmp_dir):
+    if isinstance(X, np.memmap) and X.filename is not None and X.filename.endswith('.npy'):
+        return X.filename
+    path = os.path.join(tmp_dir, 'X.npy')
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=X.dtype, shape=X.shape)
+    for s in range(0, X.shape[0], 1024): # X may be a lazy view, copy in chunks
+        out[s:s+1024] = X[s:s+1024]
+    out.flush()
+    del out
+    return path
+
+# Same result as ensemble_uncertainty, computed by `workers` processes.
+# `build_model(input_shape)` must be picklable (a module level function or a
+# functools.partial of one).
+def parallel_ensemble_uncertainty(weight_paths, X, workers, build_model=build_fgbg_model,
+                                  mode='shard', batch_size=32, n_classes=2, pixelwise=True,
+                                  threads_per_worker=1, tmp_dir=None, verbose=True):
+    assert mode in ('shard', 'member')
+    N = X.shape[0]
+    own_tmp = tmp_dir is None
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp.ensemble.', dir='.') if own_tmp else tmp_dir
+    if not os.path.exists(tmp_dir):
+        os.makedirs(tmp_dir)
+
+    try:
+        X_path = as_npy_file(X, tmp_dir)
+
+        if mode == 'shard':
+            workers = min(workers, N)
+            bounds = np.linspace(0, N, workers + 1).astype(int)
+            pixel_path = None
+            if pixelwise:
+                pixel_path = os.path.join(tmp_dir, 'pixelwise.npy')
+                np.lib.format.open_memmap(pixel_path, mode='w+', dtype=np.float32, shape=X.shape[:-1])
+            jobs = [(w, build_model, weight_paths, X_path, bounds[w], bounds[w+1],
+                     batch_size, pixel_path, threads_per_worker) for w in range(workers)]
+            worker = shard_worker
+        else:
+            workers = min(workers, len(weight_paths))
+            member_sets = [weight_paths[w::workers] for w in range(workers)]
+            state_dirs = [os.path.join(tmp_dir, 'worker_' + str(w)) for w in range(workers)]
+            jobs = [(w, build_model, member_sets[w], X_path, batch_size, n_classes,
+                     state_dirs[w], threads_per_worker) for w in range(workers)]
+            worker = member_worker
+
+        # spawn, since forking a process that has touched tensorflow is unsafe.
+        # If a worker dies (e.g. killed for running out of memory) the pool
+        # breaks and result() raises BrokenProcessPool rather than hanging.
+        ctx = multiprocessing.get_context('spawn')
+        t1 = time.perf_counter()
+        results = []
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+            for fut in as_completed([pool.submit(worker, job) for job in jobs]):
+                res = fut.result()
+                results.append(res)
+                if verbose:
+                    wid, n_imgs, n_models, _, elapsed = res
+                    print(f'Worker {wid}: {n_imgs} images x {n_models} models in {elapsed:0.2f} seconds '
+                          f'({n_imgs * n_models / elapsed:0.1f} image-models/s)')
+        if verbose:
+            print(f'{workers} workers finished in {time.perf_counter() - t1:0.2f} seconds')
+
+        if mode == 'shard':
+            imagewise = np.zeros(N)
+            for wid, _, _, shard_imagewise, _ in results:
+                imagewise[bounds[wid]:bounds[wid+1]] = shard_imagewise
+            pixel_map = np.array(np.load(pixel_path, mmap_mode='r')) if pixelwise else None
+            return imagewise, pixel_map
+
+        # Merge every worker's partial Welford state into worker 0's
+        counts = dict([(r[0], r[2]) for r in results])
+        n = counts[0]
+        mean, m2 = [np.load(os.path.join(state_dirs[0], f), mmap_mode='r+') for f in ('mean.npy', 'm2.npy')]
+        for w in range(1, workers):
+            mean_b, m2_b = [np.load(os.path.join(state_dirs[w], f), mmap_mode='r') for f in ('mean.npy', 'm2.npy')]
+            n = welford_merge(n, mean, m2, counts[w], mean_b, m2_b, batch_size)
+        return reduce_uncertainty(m2, n, batch_size, pixelwise, n_classes)
+    finally:
+        if own_tmp:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+# Headless counterpart of the ImageSequencer GUI. Reads a JSON spec, lays out
+# the same ROI grid the GUI would, takes the (frame x ROI) product and bulk
+# inserts the resulting SampleImage rows and their pool memberships. Meant for
+# batch jobs on servers without a display.
+#
+# Example spec (comments only for illustration, JSON has none):
+#
+#   {
+#       "experiment": "exp03",
+#       "start_time": 2.0,          # hours, optional
+#       "end_time": 30.0,           # hours, optional
+#       "stride": 4,
+#       "tile": [256, 256],         # H res, V res
+#       "padding": [256, 256],      # H pad, V pad
+#       "stretch": [1.0, 1.0],      # H grid, V grid
+#       "rois": [0, 3, 7],          # flat cell indices, "all", or
+#       "roi_mask": [[0, 1], ...],  #   a rows x cols 0/1 mask instead
+#       "pool": "pool4",
+#       "bucket": "laboncmosdata"
+#   }
+#
+# Sample images are created without an S3 object (empty s3_key), the same way
+# blank annotations are; their pixels are cut later.
+
+import argparse
+import asyncio
+import json
+import time
+import numpy as np
+import sqlalchemy
+
+from database_models import *
+from database_models import database_handle, through_table, get_experiment_frames
+from roi_grid import RoiGrid
+from pool_stats import increment_pool
+
+def load_spec(path):
+    with open(path) as f:
+        spec = json.load(f)
+    for key in ['experiment', 'tile', 'pool']:
+        if key not in spec:
+            raise ValueError("Sequence spec is missing \"" + key + "\"")
+    return spec
+
+def build_grid(spec, h, v):
+    h_size, v_size = spec['tile']
+    h_pad, v_pad = spec.get('padding', [256, 256])
+    h_stretch, v_stretch = spec.get('stretch', [1, 1])
+    grid = RoiGrid(h, v, h_size, v_size, h_pad, v_pad, h_stretch, v_stretch)
+
+    if 'roi_mask' in spec:
+        grid.select(mask=spec['roi_mask'])
+    elif spec.get('rois', 'all') == 'all':
+        grid.select(mask=np.ones(grid.selected.shape, dtype=bool))
+    else:
+        grid.select(idxs=spec['rois'])
+    return grid
+
+# Vectorized (frame x ROI) product. Like the GUI, every `stride`th frame from
+# the first one is used, and the last frame of the range is not included.
+# Returns (frame index, x1, y1, x2, y2) arrays, frame major.
+def sample_product(num_frames, stride, grid):
+    frame_idxs = np.arange((num_frames - 1) // stride) * stride
+    origins = grid.selected_origins()
+    R = origins.shape[0]
+
+    f = np.repeat(frame_idxs, R)
+    x1 = np.tile(origins[:, 0], len(frame_idxs))
+    y1 = np.tile(origins[:, 1], len(frame_idxs))
+    return f, x1, y1, x1 + grid.h_size, y1 + grid.v_size
+
+async def get_or_create_pool(name):
+    pool = await ImagePool.objects.get_or_none(name=name)
+    if pool is None:
+        pool = await ImagePool(name=name, num_images=0).save()
+    return pool
+
+# Inserts one chunk of sample images with a multi-row INSERT ... RETURNING so
+# the new ids can be linked to the pool without a query per row. SQLite (with
+# SQLAlchemy 1.3) has no RETURNING; there the ids are re-selected as those
+# above the largest id before the insert, which holds because SQLite lets only
+# one transaction write at a time.
+async def insert_chunk(rows, pool):
+    sample_table = SampleImage.Meta.table
+    link_table, sample_col, pool_col = through_table(SampleImage, "memberships")
+
+    async with database_handle.transaction():
+        if database_handle.url.dialect.startswith("postgres"):
+            ids = await database_handle.fetch_all(
+                sample_table.insert().values(rows).returning(sample_table.c.id))
+        else:
+            last_id = await database_handle.fetch_val(
+                sqlalchemy.select([sqlalchemy.func.coalesce(sqlalchemy.func.max(sample_table.c.id), 0)]))
+            await database_handle.execute(sample_table.insert().values(rows))
+            ids = await database_handle.fetch_all(
+                sqlalchemy.select([sample_table.c.id]).where(sample_table.c.id > last_id)
+                                                      .order_by(sample_table.c.id))
+        links = [{sample_col: r[0], pool_col: pool.name} for r in ids]
+        await database_handle.execute(link_table.insert().values(links))
+        await increment_pool(database_handle, ImagePool, pool.name, len(links))
+
+async def generate(spec, chunk_size=1000, dry_run=False):
+    frames = await get_experiment_frames(spec['experiment'], spec.get('start_time'), spec.get('end_time'))
+    if len(frames) < 2:
+        print("Need at least two frames in the requested range, found", len(frames))
+        return 0
+
+    grid = build_grid(spec, frames[0].image_resx, frames[0].image_resy)
+    f, x1, y1, x2, y2 = sample_product(len(frames), int(spec.get('stride', 1)), grid)
+    print('ROIS:', grid.num_selected, '; Source Images:', len(np.unique(f)), '; Sample Images:', len(f))
+    if dry_run or len(f) == 0:
+        return len(f)
+
+    pool = await get_or_create_pool(spec['pool'])
+    bucket = spec.get('bucket', 'laboncmosdata')
+    names = [fr.name for fr in frames]
+    channels = [fr.num_channels for fr in frames]
+
+    t1 = time.perf_counter()
+    for c in range(0, len(f), chunk_size):
+        rows = [{
+                 's3_key': '',
+                 's3_bucket': bucket,
+                 'num_channels': channels[f[i]],
+                 'source_x1': int(x1[i]),
+                 'source_y1': int(y1[i]),
+                 'source_x2': int(x2[i]),
+                 'source_y2': int(y2[i]),
+                 'source_image': names[f[i]],
+                } for i in range(c, min(c + chunk_size, len(f)))]
+        await insert_chunk(rows, pool)
+        print('   ', min(c + chunk_size, len(f)), 'of', len(f),
+              f'sample images inserted in {time.perf_counter() - t1:0.2f} seconds')
+
+    return len(f)
+
+async def main(args):
+    await database_handle.connect()
+    try:
+        for path in args.specs:
+            await generate(load_spec(path), args.chunk_size, args.dry_run)
+    finally:
+        await database_handle.disconnect()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate sample image sequences from spec files")
+    parser.add_argument("specs", nargs="+", help="JSON sequence spec files")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="rows per insert transaction")
+    parser.add_argument("--dry-run", action="store_true", help="only report how many samples would be created")
+    asyncio.run(main(parser.parse_args()))
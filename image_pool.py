@@ -0,0 +1,170 @@
+import os
+import json
+import numpy as np
+
+# On-disk image pool for the active learning loop. A pool is a directory with
+#
+#   images.npy       N x H x W x C pixels, opened as a read-only memmap
+#   metadata.json    list of N per-image metadata dicts
+#   tombstones.bin   append-only int64 indices of removed images
+#   projection.npy   N x d float32 PCA projections (see project())
+#   projected.npy    N bool, set where the row of projection.npy is valid
+#   projection.json  fingerprint of the embedding the projections belong to
+#
+# Removing images only appends their indices to the tombstone file, so taking
+# 50 suggested images out of a 100k image pool is an O(k) write instead of a
+# full rewrite. Pixels of removed images stay on disk until compact() is
+# called. Indices passed to and returned from the pool are always positions
+# among the live (not removed) images.
+
+PROJECTION_FILES = ['projection.npy', 'projected.npy', 'projection.json']
+
+class ImagePoolFile(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.images = np.load(os.path.join(path, 'images.npy'), mmap_mode='r')
+        with open(os.path.join(path, 'metadata.json')) as f:
+            self.metadata = json.load(f)
+        self.load_tombstones()
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, 'images.npy'))
+
+    # Writes a new pool from an array (or anything sliceable with a shape)
+    @classmethod
+    def create(cls, path, X, metadata, chunk_size=1024):
+        assert X.shape[0] == len(metadata)
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        out = np.lib.format.open_memmap(os.path.join(path, 'images.npy') + '.part', mode='w+',
+                                        dtype=X.dtype, shape=X.shape)
+        for s in range(0, X.shape[0], chunk_size):
+            out[s:s+chunk_size] = X[s:s+chunk_size]
+        out.flush()
+        del out
+        os.replace(os.path.join(path, 'images.npy') + '.part', os.path.join(path, 'images.npy'))
+
+        with open(os.path.join(path, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
+        for name in ['tombstones.bin'] + PROJECTION_FILES:
+            if os.path.exists(os.path.join(path, name)):
+                os.remove(os.path.join(path, name))
+
+        return cls(path)
+
+    def load_tombstones(self):
+        removed = np.zeros(self.images.shape[0], dtype=bool)
+        tomb_path = os.path.join(self.path, 'tombstones.bin')
+        if os.path.exists(tomb_path):
+            removed[np.fromfile(tomb_path, dtype=np.int64)] = True
+        self.live = np.flatnonzero(~removed)
+
+    def __len__(self):
+        return len(self.live)
+
+    @property
+    def num_removed(self):
+        return self.images.shape[0] - len(self.live)
+
+    # Live images as an array-like; a plain memmap if nothing was removed
+    def view(self):
+        if self.num_removed == 0:
+            return self.images
+        return LiveImages(self.images, self.live)
+
+    def get_metadata(self, idxs):
+        return [self.metadata[i] for i in self.live[idxs]]
+
+    def remove(self, idxs):
+        physical = np.asarray(self.live[np.asarray(idxs, dtype=np.int64)], dtype=np.int64)
+        with open(os.path.join(self.path, 'tombstones.bin'), 'ab') as f:
+            physical.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        self.load_tombstones()
+
+    # Projections of the live images by `embedding` (a PoolEmbedding), as a
+    # len(pool) x d array. They are stored per physical row, so only rows that
+    # were never projected (by this embedding) are transformed; after the
+    # first round that is none.
+    def project(self, embedding, chunk_size=1024):
+        fingerprint = embedding.fingerprint()
+        proj_path = os.path.join(self.path, 'projection.npy')
+        done_path = os.path.join(self.path, 'projected.npy')
+        info_path = os.path.join(self.path, 'projection.json')
+        N = self.images.shape[0]
+
+        stored = None
+        if all([os.path.exists(os.path.join(self.path, name)) for name in PROJECTION_FILES]):
+            with open(info_path) as f:
+                stored = json.load(f).get('embedding')
+        if stored != fingerprint or np.load(proj_path, mmap_mode='r').shape != (N, embedding.d):
+            np.lib.format.open_memmap(proj_path, mode='w+', dtype=np.float32, shape=(N, embedding.d))
+            np.lib.format.open_memmap(done_path, mode='w+', dtype=bool, shape=(N,))
+            with open(info_path, 'w') as f:
+                json.dump({'embedding': fingerprint}, f)
+
+        X_proj = np.load(proj_path, mmap_mode='r+')
+        done = np.load(done_path, mmap_mode='r+')
+        missing = self.live[~done[self.live]]
+        for s in range(0, len(missing), chunk_size):
+            rows = missing[s:s+chunk_size]
+            X_proj[rows] = embedding.transform_pool(LiveImages(self.images, rows), chunk_size)
+            X_proj.flush()
+            # Flagged only once the projections are on disk
+            done[rows] = True
+            done.flush()
+        return np.asarray(X_proj[self.live])
+
+    # Rewrites the pool without the removed images
+    def compact(self, chunk_size=1024):
+        if self.num_removed == 0:
+            return self
+        live = LiveImages(self.images, self.live)
+        metadata = [self.metadata[i] for i in self.live]
+        tmp_path = self.path.rstrip('/') + '.compact'
+        ImagePoolFile.create(tmp_path, live, metadata, chunk_size)
+        del live
+        self.images = None
+
+        # Stored projections follow their rows
+        if all([os.path.exists(os.path.join(self.path, name)) for name in PROJECTION_FILES]):
+            for name in ['projection.npy', 'projected.npy']:
+                np.save(os.path.join(tmp_path, name), np.load(os.path.join(self.path, name), mmap_mode='r')[self.live])
+            os.replace(os.path.join(self.path, 'projection.json'), os.path.join(tmp_path, 'projection.json'))
+
+        for name in ['images.npy', 'metadata.json'] + PROJECTION_FILES:
+            if not os.path.exists(os.path.join(tmp_path, name)):
+                if os.path.exists(os.path.join(self.path, name)):
+                    os.remove(os.path.join(self.path, name))
+                continue
+            os.replace(os.path.join(tmp_path, name), os.path.join(self.path, name))
+        if os.path.exists(os.path.join(self.path, 'tombstones.bin')):
+            os.remove(os.path.join(self.path, 'tombstones.bin'))
+        os.rmdir(tmp_path)
+
+        self.__init__(self.path)
+        return self
+
+# Array-like over the live rows of a memmap. Slices and index arrays are
+# translated to physical rows, so only the requested images are read.
+class LiveImages(object):
+
+    def __init__(self, images, live):
+        self.images = images
+        self.live = live
+        self.shape = (len(live),) + images.shape[1:]
+        self.dtype = images.dtype
+        self.ndim = images.ndim
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        rows = self.live[idx]
+        if np.isscalar(rows):
+            return np.asarray(self.images[rows])
+        return self.images[rows] # fancy indexing on a memmap reads just these rows
@@ -0,0 +1,349 @@
+import collections
+import contextlib
+import contextvars
+import io
+import json
+import math
+import os
+import threading
+import time
+
+# Per-command instrumentation for the CLI. While it is on, every command run
+# at the prompt gets a span that collects what the command spent its time
+# on: database queries (count and time), S3 requests (count, time and
+# bytes), and the timed sections of the commands themselves (image decode,
+# crops, the annotation tool...). When the command ends its totals go into
+# one histogram per (command, metric), shown by the `stats` command, and the
+# individual calls are kept as trace events that can be written out in the
+# Chrome trace event format (chrome://tracing, ui.perfetto.dev).
+#
+# When it is off nothing is wrapped: the database handle is untouched, and
+# timers and the S3 client only check a flag before doing the plain call.
+#
+# The current span is a context variable, so background jobs (their own
+# asyncio tasks) keep separate spans. Work handed to threads sees the span
+# if it is submitted with contextvars.copy_context().run.
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+BACKGROUND = "(background)" # calls made outside of any command
+
+NULL = contextlib.nullcontext()
+
+DB_METHODS = ["fetch_all", "fetch_one", "fetch_val", "execute", "execute_many"]
+
+# Log scale histogram with BUCKETS_PER_OCTAVE buckets per doubling, so
+# percentiles are exact to within 2**(1/4), about 19%. Memory stays small
+# however many values are added.
+BUCKETS_PER_OCTAVE = 4
+ZERO_BUCKET = -10**6
+
+class Histogram(object):
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        b = int(math.floor(math.log2(value) * BUCKETS_PER_OCTAVE)) if value > 0 else ZERO_BUCKET
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+        self.count = self.count + 1
+        self.total = self.total + value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def mean(self):
+        return self.total / self.count if self.count > 0 else 0.0
+
+    # Upper bound of the bucket holding the p-th percentile, clipped to the
+    # observed range
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for b in sorted(self.buckets):
+            seen = seen + self.buckets[b]
+            if seen >= rank:
+                upper = 0.0 if b == ZERO_BUCKET else 2 ** ((b + 1) / BUCKETS_PER_OCTAVE)
+                return min(max(upper, self.min), self.max)
+        return self.max
+
+class Span(object):
+
+    def __init__(self, span_id, command):
+        self.id = span_id
+        self.command = command
+        self.seconds = {}
+        self.calls = {}
+        self.nbytes = {}
+
+    def add(self, metric, seconds, nbytes=None):
+        self.seconds[metric] = self.seconds.get(metric, 0.0) + seconds
+        self.calls[metric] = self.calls.get(metric, 0) + 1
+        if nbytes is not None:
+            self.nbytes[metric] = self.nbytes.get(metric, 0) + nbytes
+
+class Timer(object):
+
+    def __init__(self, recorder, metric, name, args):
+        self.recorder = recorder
+        self.metric = metric
+        self.name = name
+        self.args = args
+        self.nbytes = None # may be set inside the block
+
+    def __enter__(self):
+        self.t1 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.recorder.record(self.metric, self.t1, time.perf_counter(), self.nbytes, self.name, self.args)
+
+class CommandSpan(object):
+
+    def __init__(self, recorder, command):
+        self.recorder = recorder
+        self.command = command
+
+    def __enter__(self):
+        self.span = self.recorder.new_span(self.command)
+        self.token = current_span.set(self.span)
+        self.t1 = time.perf_counter()
+        return self.span
+
+    def __exit__(self, *exc):
+        t2 = time.perf_counter()
+        current_span.reset(self.token)
+        self.recorder.finish(self.span, self.t1, t2)
+
+# Short description of a query for the trace, without compiling it
+def describe_query(query):
+    if isinstance(query, str):
+        return " ".join(query.split())[:80]
+    table = getattr(query, "table", None)
+    if table is not None:
+        return type(query).__name__ + " " + str(getattr(table, "name", table))
+    froms = [getattr(f, "name", None) for f in getattr(query, "froms", [])]
+    return type(query).__name__ + " " + ", ".join([f for f in froms if f])
+
+class Recorder(object):
+
+    def __init__(self, max_events=200000):
+        self.enabled = False
+        self.histograms = {} # (command, metric, unit) -> Histogram
+        self.runs = {} # command -> number of runs
+        self.events = collections.deque(maxlen=max_events)
+        self.thread_names = {}
+        self.next_span_id = 1
+        self.lock = threading.Lock()
+        self.loop_thread = threading.get_ident()
+        self.origin = time.perf_counter()
+        self.database_handles = []
+
+    #### SWITCHING ####
+
+    def enable(self, database_handle=None):
+        self.enabled = True
+        if database_handle is not None:
+            self.wrap_database(database_handle)
+
+    def disable(self):
+        self.enabled = False
+        for handle in self.database_handles:
+            for name in DB_METHODS:
+                handle.__dict__.pop(name, None)
+        self.database_handles = []
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.runs = {}
+            self.events.clear()
+            self.thread_names = {}
+
+    # Times every query made through the handle. The wrappers shadow the
+    # methods on the instance, so ormar's queries are seen too.
+    def wrap_database(self, handle):
+        if handle in self.database_handles:
+            return
+        for name in DB_METHODS:
+            handle.__dict__[name] = self.query_wrapper(getattr(handle, name), name)
+        self.database_handles.append(handle)
+
+    def query_wrapper(self, method, name):
+        async def wrapper(query, *args, **kwargs):
+            t1 = time.perf_counter()
+            try:
+                return await method(query, *args, **kwargs)
+            finally:
+                self.record("db", t1, time.perf_counter(), None, "db " + describe_query(query), {"method": name})
+        return wrapper
+
+    #### RECORDING ####
+
+    def command(self, name):
+        return CommandSpan(self, name) if self.enabled else NULL
+
+    # Times a block as `metric`. Free when instrumentation is off.
+    def timer(self, metric, name=None, **args):
+        return Timer(self, metric, name or metric, args) if self.enabled else NULL
+
+    def new_span(self, command):
+        with self.lock:
+            span = Span(self.next_span_id, command)
+            self.next_span_id = self.next_span_id + 1
+        return span
+
+    def record(self, metric, t1, t2, nbytes=None, name=None, args=None):
+        span = current_span.get()
+        ident = threading.get_ident()
+        # Calls on the event loop thread are drawn on their command's own
+        # track, so concurrent commands do not overlap in the trace
+        tid = span.id if span is not None and ident == self.loop_thread else ident
+        with self.lock:
+            if span is not None:
+                span.add(metric, t2 - t1, nbytes)
+            else:
+                self.add_value(BACKGROUND, metric, "s", t2 - t1)
+                if nbytes is not None:
+                    self.add_value(BACKGROUND, metric, "bytes", nbytes)
+            if tid not in self.thread_names:
+                self.thread_names[tid] = threading.current_thread().name if tid == ident else \
+                                         "command " + str(span.id) + ": " + span.command
+            event_args = dict(args or {})
+            if nbytes is not None:
+                event_args["bytes"] = nbytes
+            self.events.append((name or metric, metric, t1, t2, tid, event_args))
+
+    def add_value(self, command, metric, unit, value):
+        key = (command, metric, unit)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].add(value)
+
+    def finish(self, span, t1, t2):
+        with self.lock:
+            self.runs[span.command] = self.runs.get(span.command, 0) + 1
+            self.add_value(span.command, "wall", "s", t2 - t1)
+            for metric in span.seconds:
+                self.add_value(span.command, metric, "s", span.seconds[metric])
+                self.add_value(span.command, metric, "calls", span.calls[metric])
+            for metric in span.nbytes:
+                self.add_value(span.command, metric, "bytes", span.nbytes[metric])
+            self.events.append((span.command, "command", t1, t2, span.id, {"span": span.id}))
+            if span.id not in self.thread_names:
+                self.thread_names[span.id] = "command " + str(span.id) + ": " + span.command
+
+    #### REPORTING ####
+
+    def commands(self):
+        return sorted(set([c for c, m, u in self.histograms]))
+
+    def print_report(self, command=None):
+        scale = {"s": (1000, "ms"), "calls": (1, "calls"), "bytes": (1.0 / 1024**2, "MB")}
+        for c in self.commands():
+            if command is not None and c != command:
+                continue
+            runs = self.runs.get(c, 0)
+            print("    " + c + (": " + str(runs) + " runs" if c != BACKGROUND else ": per call"))
+            print("        {:<16} {:>7} {:>11} {:>11} {:>11} {:>11} {:>11}".format(
+                  "metric", "count", "total", "mean", "p50", "p95", "max"))
+            for key in sorted([k for k in self.histograms if k[0] == c], key=lambda k: (k[1] != "wall", k[1], k[2])):
+                h = self.histograms[key]
+                factor, unit = scale[key[2]]
+                print("        {:<16} {:>7} {:>11.2f} {:>11.2f} {:>11.2f} {:>11.2f} {:>11.2f}".format(
+                      key[1] + " " + unit, h.count, h.total * factor, h.mean() * factor,
+                      h.percentile(50) * factor, h.percentile(95) * factor, h.max * factor))
+
+            s3_bytes = self.histograms.get((c, "s3", "bytes"))
+            s3_time = self.histograms.get((c, "s3", "s"))
+            if s3_bytes is not None and s3_time is not None and s3_time.total > 0:
+                print("        s3 throughput: {:.1f} MB/s per request".format(s3_bytes.total / 1024**2 / s3_time.total))
+
+    # Chrome trace event format: complete ("X") events with microsecond
+    # timestamps, plus thread name metadata for the tracks
+    def trace_events(self):
+        pid = os.getpid()
+        with self.lock:
+            events = list(self.events)
+            names = dict(self.thread_names)
+        trace = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                 for tid, name in names.items()]
+        for name, category, t1, t2, tid, args in events:
+            trace.append({"name": name, "cat": category, "ph": "X", "pid": pid, "tid": tid,
+                          "ts": (t1 - self.origin) * 1e6, "dur": (t2 - t1) * 1e6, "args": args})
+        return trace
+
+    def export_trace(self, path):
+        trace = self.trace_events()
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+        return len(trace)
+
+# Proxy for a boto3 S3 client that records the requests the commands make.
+# Everything else is passed through to the client.
+class InstrumentedS3(object):
+
+    def __init__(self, client, recorder):
+        self.client = client
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def record(self, op, key, t1, nbytes):
+        self.recorder.record("s3", t1, time.perf_counter(), nbytes, "s3 " + op, {"key": key})
+
+    def head_object(self, **kwargs):
+        if not self.recorder.enabled:
+            return self.client.head_object(**kwargs)
+        t1 = time.perf_counter()
+        resp = self.client.head_object(**kwargs)
+        self.record("head_object", kwargs.get("Key"), t1, 0)
+        return resp
+
+    # The body is read here, so the time includes the transfer
+    def get_object(self, **kwargs):
+        if not self.recorder.enabled:
+            return self.client.get_object(**kwargs)
+        t1 = time.perf_counter()
+        resp = self.client.get_object(**kwargs)
+        data = resp["Body"].read()
+        resp["Body"] = io.BytesIO(data)
+        self.record("get_object", kwargs.get("Key"), t1, len(data))
+        return resp
+
+    def put_object(self, **kwargs):
+        if not self.recorder.enabled:
+            return self.client.put_object(**kwargs)
+        t1 = time.perf_counter()
+        resp = self.client.put_object(**kwargs)
+        body = kwargs.get("Body")
+        self.record("put_object", kwargs.get("Key"), t1, len(body) if isinstance(body, (bytes, bytearray)) else None)
+        return resp
+
+    def download_fileobj(self, Bucket, Key, Fileobj, **kwargs):
+        if not self.recorder.enabled:
+            return self.client.download_fileobj(Bucket, Key, Fileobj, **kwargs)
+        t1 = time.perf_counter()
+        start = Fileobj.tell()
+        self.client.download_fileobj(Bucket, Key, Fileobj, **kwargs)
+        self.record("download", Key, t1, Fileobj.tell() - start)
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        if not self.recorder.enabled:
+            return self.client.download_file(Bucket, Key, Filename, **kwargs)
+        t1 = time.perf_counter()
+        self.client.download_file(Bucket, Key, Filename, **kwargs)
+        self.record("download", Key, t1, os.path.getsize(Filename))
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        if not self.recorder.enabled:
+            return self.client.upload_file(Filename, Bucket, Key, **kwargs)
+        t1 = time.perf_counter()
+        self.client.upload_file(Filename, Bucket, Key, **kwargs)
+        self.record("upload", Key, t1, os.path.getsize(Filename))
@@ -0,0 +1,94 @@
+import io
+import json
+import struct
+import zlib
+import numpy as np
+from PIL import Image
+
+# Storage format for annotation label masks. 8-bit PNGs wrap once a tile has
+# more than 255 cells; this format keeps 16 and 32-bit instance labels
+# losslessly. A mask object is laid out as:
+#
+#   MAGIC (8 bytes) | header length (uint32 LE) | JSON header | zlib payload
+#
+# The payload is the row major run-length encoding of the labels: all run
+# values (in the smallest unsigned dtype that holds the largest label)
+# followed by all run lengths (uint32). Label masks are mostly background and
+# each cell is a few runs per row, so this is far smaller than the raw array
+# before compression even starts, and a low zlib level is enough after it.
+#
+# read_label_mask() also reads the legacy PNG annotations, so consumers of
+# ImageAnnotation objects can use it regardless of how the mask was stored.
+
+MAGIC = b'CSDMASK1'
+PREFIX_SIZE = len(MAGIC) + 4
+
+# `version` tells uploads of the same annotation apart, so an upload never
+# replaces a mask another annotator's row may already point at
+def mask_key(ann_id, version=None):
+    suffix = "" if version is None else "_" + str(version)
+    return "db/anns/" + str(ann_id) + "/y_" + str(ann_id) + suffix + ".mask"
+
+def label_dtype(max_label):
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if max_label <= np.iinfo(dtype).max:
+            return dtype
+    raise ValueError("Label " + str(max_label) + " does not fit in 32 bits")
+
+def encode_mask(y, level=3):
+    y = np.asarray(y)
+    if y.dtype.kind == 'f':
+        if not np.all(np.mod(y, 1) == 0):
+            raise ValueError("Label masks must hold integer labels")
+        y = y.astype(np.int64)
+    if y.size > 0 and y.min() < 0:
+        raise ValueError("Label masks must not hold negative labels")
+
+    flat = y.ravel()
+    if flat.size > 0:
+        starts = np.flatnonzero(np.concatenate([[True], flat[1:] != flat[:-1]]))
+        lengths = np.diff(np.append(starts, flat.size)).astype(np.uint32)
+        values = flat[starts]
+    else:
+        lengths = np.zeros(0, dtype=np.uint32)
+        values = flat
+    dtype = label_dtype(int(values.max()) if values.size > 0 else 0)
+    values = values.astype(dtype)
+
+    header = json.dumps({
+                         'shape': list(y.shape),
+                         'dtype': np.dtype(dtype).str,
+                         'encoding': 'rle',
+                         'codec': 'zlib',
+                         'runs': int(len(values)),
+                        }).encode('utf-8')
+    payload = zlib.compress(values.tobytes() + lengths.astype('<u4').tobytes(), level)
+    return MAGIC + struct.pack('<I', len(header)) + header + payload
+
+def decode_mask(data):
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a label mask object")
+    header_len = struct.unpack('<I', data[len(MAGIC):PREFIX_SIZE])[0]
+    header = json.loads(data[PREFIX_SIZE:PREFIX_SIZE + header_len].decode('utf-8'))
+    payload = zlib.decompress(data[PREFIX_SIZE + header_len:])
+
+    dtype = np.dtype(header['dtype'])
+    runs = header['runs']
+    values = np.frombuffer(payload, dtype=dtype, count=runs)
+    lengths = np.frombuffer(payload, dtype='<u4', count=runs, offset=runs * dtype.itemsize)
+    return np.repeat(values, lengths).reshape(header['shape'])
+
+# Reads a label mask from a path or bytes, in either this format or a
+# legacy PNG
+def read_label_mask(src):
+    if isinstance(src, (bytes, bytearray)):
+        data = bytes(src)
+    else:
+        with open(src, 'rb') as f:
+            data = f.read()
+
+    if data[:len(MAGIC)] == MAGIC:
+        return decode_mask(data)
+    im = Image.open(io.BytesIO(data))
+    im.load()
+    return np.asarray(im)
@@ -0,0 +1,132 @@
+import datetime
+import contextlib
+import sqlalchemy
+
+from database_models import metadata, engine, SourceImage, ImageAnnotation, SECONDARY_INDEXES
+
+# Versioned schema migrations. The schema_version table records every
+# migration that has been applied; at startup the highest recorded version is
+# compared against MIGRATIONS and only the missing steps run, each in its own
+# transaction together with its schema_version row. Against an up to date
+# database this is a single SELECT.
+#
+# Processes starting at the same time would otherwise both apply a step, so
+# every step runs holding a database wide lock (an advisory lock on postgres,
+# BEGIN IMMEDIATE on SQLite) and re-reads the version under it first.
+#
+# Migrations are never edited once released. To change the schema, change the
+# models and append a migration that brings existing databases along; fresh
+# databases get the full schema from the first migration and the later steps
+# then find nothing left to do, so every step must tolerate that.
+
+schema_version = sqlalchemy.Table("schema_version", sqlalchemy.MetaData(),
+                                  sqlalchemy.Column("version", sqlalchemy.Integer, primary_key=True),
+                                  sqlalchemy.Column("description", sqlalchemy.String(1000)),
+                                  sqlalchemy.Column("applied_on", sqlalchemy.DateTime))
+
+def has_column(conn, table, column):
+    return column in [c["name"] for c in sqlalchemy.inspect(conn).get_columns(table)]
+
+def has_index(conn, table, index):
+    return index in [i["name"] for i in sqlalchemy.inspect(conn).get_indexes(table)]
+
+def add_column(conn, model, name):
+    table = model.Meta.table
+    if has_column(conn, table.name, name):
+        return
+    column = table.c[name]
+    conn.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                 table.name, column.name, column.type.compile(dialect=conn.dialect)))
+
+# Creates the named indexes declared on the model tables that are missing
+def create_indexes(conn, names):
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in names and not has_index(conn, table.name, index.name):
+                index.create(conn)
+
+#### MIGRATIONS ####
+
+def create_tables(conn):
+    metadata.create_all(conn, checkfirst=True)
+
+def add_tiled_images(conn):
+    add_column(conn, SourceImage, "tiled_s3_key")
+
+def add_annotation_leases(conn):
+    add_column(conn, ImageAnnotation, "leased_by")
+    add_column(conn, ImageAnnotation, "lease_expires_at")
+
+def add_frame_index(conn):
+    create_indexes(conn, ["ix_images_experiment_time"])
+
+def add_secondary_indexes(conn):
+    create_indexes(conn, SECONDARY_INDEXES)
+
+def add_pool_stats(conn):
+    import pool_stats
+    pool_stats.create_view(conn)
+
+# (version, description, step). Append only.
+MIGRATIONS = [
+              (1, "create tables", create_tables),
+              (2, "tiled copies of source images", add_tiled_images),
+              (3, "annotation work queue leases", add_annotation_leases),
+              (4, "index source images by experiment and time", add_frame_index),
+              (5, "indexes for annotation, sample and pool queries", add_secondary_indexes),
+              (6, "pool statistics view", add_pool_stats),
+             ]
+
+LATEST = MIGRATIONS[-1][0]
+LOCK_KEY = 0x6d696772 # "migr", the pg_advisory_xact_lock key of migrations
+
+# A connection in a transaction that holds the migration lock until it ends
+@contextlib.contextmanager
+def locked_transaction(engine):
+    with engine.connect() as conn:
+        if conn.dialect.name.startswith("postgres"):
+            with conn.begin():
+                conn.execute(sqlalchemy.text("SELECT pg_advisory_xact_lock(:key)"), key=LOCK_KEY)
+                yield conn
+            return
+
+        # pysqlite only opens transactions (deferred ones) before DML by
+        # itself; with that turned off, BEGIN IMMEDIATE takes the write lock
+        # up front and the DDL of the step is part of the transaction
+        dbapi_conn = conn.connection.connection
+        isolation_level = dbapi_conn.isolation_level
+        dbapi_conn.isolation_level = None
+        try:
+            with conn.begin():
+                conn.execute("BEGIN IMMEDIATE")
+                yield conn
+        finally:
+            dbapi_conn.isolation_level = isolation_level
+
+async def current_version(database_handle):
+    try:
+        return await database_handle.fetch_val(sqlalchemy.select([sqlalchemy.func.max(schema_version.c.version)])) or 0
+    except Exception:
+        return 0 # no schema_version table yet
+
+# Brings the database up to the latest version. Returns (old, new) version.
+async def migrate(database_handle, verbose=True):
+    version = await current_version(database_handle)
+    if version >= LATEST:
+        return version, version
+
+    # DDL goes through the synchronous engine; the steps are rare and short
+    for number, description, step in MIGRATIONS:
+        if number <= version:
+            continue
+        with locked_transaction(engine) as conn:
+            schema_version.create(conn, checkfirst=True)
+            applied = conn.execute(sqlalchemy.select([sqlalchemy.func.max(schema_version.c.version)])).scalar()
+            if number <= (applied or 0):
+                continue # applied by another process meanwhile
+            if verbose:
+                print("Migrating the database to version " + str(number) + ": " + description)
+            step(conn)
+            conn.execute(schema_version.insert().values(version=number, description=description,
+                                                        applied_on=datetime.datetime.now()))
+    return version, LATEST
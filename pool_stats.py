@@ -0,0 +1,132 @@
+import datetime
+import sqlalchemy
+
+from database_models import ImageAnnotation, SampleImage, SourceImage, through_table
+
+# Pool statistics. Counting pool members on demand means joining the link
+# tables against annotations and images, so the counts live in a pool_stats
+# view instead: one row per (kind, pool, experiment) with the number of
+# members and how many of them are finished, refreshed periodically. Reading
+# it costs the same however big the pools get.
+#
+# On postgres pool_stats is a materialized view refreshed CONCURRENTLY, so
+# readers are never blocked. SQLite has no materialized views; there it is a
+# plain table rebuilt in one transaction.
+#
+# Every open CLI refreshes the view in the background, but a refresh is
+# skipped while the view is younger than the refresh interval, and on postgres
+# only the session holding the advisory lock refreshes at all, so N sessions
+# still mean one refresh per interval.
+#
+# The num_images counters on the pool rows are still kept for compatibility.
+# They are only ever changed with atomic SQL increments (increment_pool); a
+# refresh does not touch them, so it can not overwrite a concurrent increment.
+
+VIEW = "pool_stats"
+LOCK_KEY = 0x706f6f6c # "pool", the pg_try_advisory_xact_lock key of refreshes
+
+def is_postgres(dialect):
+    return dialect.name.startswith("postgres")
+
+# Atomically adds `n` to the num_images counter of a LabeledPool or ImagePool
+async def increment_pool(database_handle, model, name, n):
+    table = model.Meta.table
+    await database_handle.execute(table.update()
+                                       .where(table.c.name == name)
+                                       .values(num_images=table.c.num_images + n))
+
+def count_if(condition):
+    return sqlalchemy.func.sum(sqlalchemy.case([(condition, 1)], else_=0))
+
+def stats_query():
+    anns = ImageAnnotation.Meta.table
+    samples = SampleImage.Meta.table
+    images = SourceImage.Meta.table
+    ann_links, ann_col, labeled_col = through_table(ImageAnnotation, "memberships")
+    sample_links, sample_col, pool_col = through_table(SampleImage, "memberships")
+    now = sqlalchemy.func.current_timestamp()
+
+    labeled = sqlalchemy.select([sqlalchemy.literal("labeled").label("kind"),
+                                 ann_links.c[labeled_col].label("pool"),
+                                 sqlalchemy.func.coalesce(images.c.experiment, "").label("experiment"),
+                                 sqlalchemy.func.count().label("num_images"),
+                                 count_if(anns.c.finished == True).label("finished"),
+                                 count_if(sqlalchemy.and_(anns.c.in_progress == True,
+                                                          anns.c.finished == False)).label("in_progress"),
+                                 now.label("refreshed_at")]) \
+                        .select_from(ann_links.join(anns, anns.c.id == ann_links.c[ann_col])
+                                              .join(images, images.c.name == anns.c.source_image)) \
+                        .group_by(ann_links.c[labeled_col], images.c.experiment)
+
+    # A sample image counts as finished once its annotation is
+    image = sqlalchemy.select([sqlalchemy.literal("image").label("kind"),
+                               sample_links.c[pool_col].label("pool"),
+                               sqlalchemy.func.coalesce(images.c.experiment, "").label("experiment"),
+                               sqlalchemy.func.count().label("num_images"),
+                               count_if(anns.c.finished == True).label("finished"),
+                               count_if(sqlalchemy.and_(anns.c.in_progress == True,
+                                                        anns.c.finished == False)).label("in_progress"),
+                               now.label("refreshed_at")]) \
+                      .select_from(sample_links.join(samples, samples.c.id == sample_links.c[sample_col])
+                                               .join(images, images.c.name == samples.c.source_image)
+                                               .outerjoin(anns, anns.c.id == samples.c.annotation)) \
+                      .group_by(sample_links.c[pool_col], images.c.experiment)
+
+    return sqlalchemy.union_all(labeled, image)
+
+def stats_sql(dialect):
+    return str(stats_query().compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+
+# Migration step: creates the view (and its unique index, which a
+# concurrent refresh needs)
+def create_view(conn):
+    if is_postgres(conn.dialect):
+        conn.execute("CREATE MATERIALIZED VIEW IF NOT EXISTS " + VIEW + " AS " + stats_sql(conn.dialect))
+    else:
+        conn.execute("CREATE TABLE IF NOT EXISTS " + VIEW + " AS " + stats_sql(conn.dialect))
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_" + VIEW + "_key ON " + VIEW + " (kind, pool, experiment)")
+
+# Seconds since the last refresh by the database clock, None if never
+async def age(database_handle):
+    row = await database_handle.fetch_one("SELECT MAX(refreshed_at) AS refreshed_at, "
+                                          "CURRENT_TIMESTAMP AS now FROM " + VIEW)
+    if row is None or row["refreshed_at"] is None:
+        return None
+    refreshed_at, now = row["refreshed_at"], row["now"]
+    if isinstance(refreshed_at, str): # SQLite returns text
+        refreshed_at = datetime.datetime.fromisoformat(refreshed_at)
+        now = datetime.datetime.fromisoformat(now)
+    return (now - refreshed_at).total_seconds()
+
+# Refreshes the view, unless another session is refreshing it right now
+# (postgres) or it was refreshed less than `max_age` seconds ago. Returns
+# whether it refreshed.
+async def refresh(database_handle, max_age=None):
+    async with database_handle.transaction():
+        postgres = database_handle.url.dialect.startswith("postgres")
+        if postgres:
+            row = await database_handle.fetch_one("SELECT pg_try_advisory_xact_lock(:key) AS locked",
+                                                  {"key": LOCK_KEY})
+            if not row["locked"]:
+                return False
+        if max_age is not None:
+            seconds = await age(database_handle)
+            if seconds is not None and seconds < max_age:
+                return False
+
+        if postgres:
+            await database_handle.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY " + VIEW)
+        else:
+            from sqlalchemy.dialects import sqlite
+            await database_handle.execute("DELETE FROM " + VIEW)
+            await database_handle.execute("INSERT INTO " + VIEW + " " + stats_sql(sqlite.dialect()))
+    return True
+
+# Rows of the view, optionally of one pool
+async def read(database_handle, pool=None):
+    query = "SELECT kind, pool, experiment, num_images, finished, in_progress, refreshed_at FROM " + VIEW
+    values = {}
+    if pool is not None:
+        query = query + " WHERE pool = :pool"
+        values["pool"] = pool
+    return await database_handle.fetch_all(query + " ORDER BY kind, pool, experiment", values)
@@ -1,124 +1,220 @@
 import database_models
-from database_models import * 
-from database_models import database_handle, metadata, engine
+from database_models import *
+from database_models import database_handle, metadata, engine, through_table
+import migrations
+from pool_stats import increment_pool
 import sqlalchemy
 import asyncio
+import argparse
 import datetime
-
-# Connect to the database and make sure that all of our tables are created
-
-# Open up our old database, get the dictionary
-import database
-
-async def main():
-    await database_handle.connect()
-    metadata.create_all(engine)
-    db = database.Database()
-    db_dict = db.get_dict()
-
-    image_dt = await DataType(typename="SourceImage").save()
-    cap_dt = await DataType(typename="CapacitanceTrace").save()
-    exp_dt_list = [image_dt, cap_dt]
+import time
+
+# The import runs in chunks of source images. Each chunk (its images,
+# annotations, sample images, pool links and pool counts) is written in one
+# transaction with multi-row inserts, so an interrupted import can simply be run
+# again: images that already made it into the database are skipped.
+
+BUCKET = "laboncmosdata"
+CREATOR = "Nathan Renegar"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Import the legacy JSON database into postgres")
+    parser.add_argument("--chunk-size", type=int, default=500,
+                        help="number of source images written per transaction")
+    parser.add_argument("--min-images", type=int, default=100,
+                        help="skip experiments with this many images or fewer")
+    return parser.parse_args()
+
+async def get_or_create_datatypes(names):
+    existing = await DataType.objects.filter(typename__in=names).all()
+    existing = {d.typename: d for d in existing}
+    for n in names:
+        if n not in existing:
+            existing[n] = await DataType(typename=n).save()
+    return [existing[n] for n in names]
+
+async def get_or_create_pools(tags):
+    existing = await LabeledPool.objects.filter(name__in=list(tags)).all()
+    existing = {p.name: p for p in existing}
+    new_pools = [LabeledPool(name=t, num_images=0) for t in tags if t not in existing]
+    if len(new_pools) > 0:
+        await LabeledPool.objects.bulk_create(new_pools)
+    for p in new_pools:
+        existing[p.name] = p
+    return existing
+
+# Multi-row INSERT ... VALUES, kept under the bind parameter limits (SQLite
+# allows 32766 per statement)
+async def insert_rows(table, rows, max_params=30000):
+    per_statement = max(1, max_params // len(rows[0]))
+    for c in range(0, len(rows), per_statement):
+        await database_handle.execute(table.insert().values(rows[c:c+per_statement]))
+
+async def import_chunk(chunk, anns_by_id, labeled_sets, now):
+    images = []
+    annotations = []
+    samples = []
+    links = []
+    pool_counts = {}
+
+    ann_table, ann_col, pool_col = through_table(ImageAnnotation, "memberships")
+
+    for exp, db_exp, image in chunk:
+        path = image["path"]
+        if path == "":
+            path = "db/exps/" + exp + "/images/" + image["name"]
+
+        images.append({"name": image["name"],
+                       "time": image["time"],
+                       "s3_key": path,
+                       "s3_bucket": BUCKET,
+                       "num_channels": 3,
+                       "image_resx": image["resolution"][0],
+                       "image_resy": image["resolution"][1],
+                       "experiment": db_exp.name})
+
+        for ann in image["annotations"]:
+            ann_id = ann[0]
+            x1, y1 = ann[1]
+            x2, y2 = ann[2]
+            ann_alt = anns_by_id[ann_id]
+
+            # The legacy tool wrote y_<id>.png and X_<id>.jpg for finished
+            # annotations without a stored path. Other samples get no key, so
+            # materialize-samples cuts them instead of readers chasing objects
+            # that were never written.
+            path = ann_alt["y"]["path"]
+            finished = ann_alt["valid"]
+            sample_path = ""
+            if path == "" and finished:
+                path = "db/anns/" + str(ann_id) + "/y_" + str(ann_id) + ".png"
+                sample_path = "db/anns/" + str(ann_id) + "/X_" + str(ann_id) + ".jpg"
+
+            # ann_id+1 since primary key must be > 0
+            annotations.append({"id": ann_id+1,
+                                "s3_key": path,
+                                "s3_bucket": BUCKET,
+                                "in_progress": False,
+                                "finished": finished,
+                                "created_by": CREATOR,
+                                "created_on": now,
+                                "updated_by": CREATOR,
+                                "updated_on": now,
+                                "started_at": now,
+                                "finished_at": now,
+                                "source_x1": x1,
+                                "source_x2": x2,
+                                "source_y1": y1,
+                                "source_y2": y2,
+                                "cell_count": 0,
+                                "cell_morphology": "balled",
+                                "source_image": image["name"]})
+
+            samples.append({"id": ann_id+1,
+                            "s3_key": sample_path,
+                            "s3_bucket": BUCKET,
+                            "num_channels": 3,
+                            "source_x1": x1,
+                            "source_x2": x2,
+                            "source_y1": y1,
+                            "source_y2": y2,
+                            "source_image": image["name"],
+                            "annotation": ann_id+1})
+
+            for t in set(ann_alt["tags"]):
+                links.append({ann_col: ann_id+1, pool_col: labeled_sets[t].name})
+                pool_counts[t] = pool_counts.get(t, 0) + 1
+
+    # Plain rows and multi-row inserts: no model instances, and one statement
+    # per few thousand rows instead of one per row
+    async with database_handle.transaction():
+        await insert_rows(SourceImage.Meta.table, images)
+        if len(annotations) > 0:
+            await insert_rows(ImageAnnotation.Meta.table, annotations)
+            await insert_rows(SampleImage.Meta.table, samples)
+        if len(links) > 0:
+            await insert_rows(ann_table, links)
+
+        # One atomic increment per pool per chunk instead of one per link
+        for t, n in pool_counts.items():
+            await increment_pool(database_handle, LabeledPool, t, n)
+
+    return len(images), len(annotations), len(links)
+
+# Imports a legacy database dictionary (the output of the old
+# database.Database().get_dict()) into the connected database
+async def import_legacy(db_dict, chunk_size=500, min_images=100, verbose=True):
+    exp_dt_list = await get_or_create_datatypes(["SourceImage", "CapacitanceTrace"])
 
     anns = db_dict["annotations"]["ann_list"]
 
-    # Get all of the annotation tags
-    tags = []
-    for a in anns:
-        for t in a["tags"]:
-            tags.append(t)
+    # Index the legacy annotations once instead of scanning for every image
+    anns_by_id = {a["ann_id"]: a for a in anns}
 
-    tags = set(tags)
-    labeled_sets = {}
-    for t in tags:
-        labeled_sets[t] = await LabeledPool(name=t, num_images=0).save()
+    # Get all of the annotation tags
+    tags = set([t for a in anns for t in a["tags"]])
+    labeled_sets = await get_or_create_pools(tags)
 
     exps = db_dict["data"]["experiments"]
-    exp_list = [e for e in exps if exps[e]["images"]["num_images"] > 100]
-    db_exp_list = []
+    exp_list = [e for e in exps if exps[e]["images"]["num_images"] > min_images]
 
+    existing_exps = await Experiment.objects.filter(name__in=exp_list).all()
+    db_exps = {e.name: e for e in existing_exps}
+    for exp in exp_list:
+        if exp not in db_exps:
+            db_exps[exp] = await Experiment.objects.create(name=exp,
+                                                           chip="rev-1",
+                                                           cell_line="tmp",
+                                                           duration=exps[exp]["duration"],
+                                                           datatypes=exp_dt_list)
+
+    # Resume support: anything already imported is skipped
+    done = await SourceImage.objects.filter(experiment__name__in=exp_list).values_list("name", flatten=True)
+    done = set(done)
+
+    todo = []
     for exp in exp_list:
-        db_exp = await Experiment.objects.create(name=exp, 
-                                                 chip="rev-1",
-                                                 cell_line="tmp",
-                                                 duration=exps[exp]["duration"],
-                                                 datatypes=exp_dt_list)
-        db_exp_list.append(db_exp)
         for image in exps[exp]["images"]["image_array"]:
-            path = image["path"] 
-            if image["path"] == "":
-                path = "db/exps/" + exp + "/images/" + image["name"]
-
-            db_image = await SourceImage.objects.create(name=image["name"],
-                                                        time=image["time"],
-                                                        s3_key=image["path"],
-                                                        s3_bucket="laboncmosdata",
-                                                        num_channels=3,
-                                                        image_resx=image["resolution"][0],
-                                                        image_resy=image["resolution"][1],
-                                                        experiment=db_exp)
-
-            for ann in image["annotations"]:
-                ann_id = ann[0]
-                x1, y1 = ann[1]
-                x2, y2 = ann[2]
-                
-                ann_alt = {}
-                for ann_entry in anns:
-                    if ann_entry["ann_id"] == ann_id:
-                        ann_alt = ann_entry
-                        break
-
-
-                path = ann_alt["y"]["path"] 
-                finished = ann_alt["valid"]
-                if path == "" and finished:
-                    path = "db/anns/" + str(ann_id) + "/y_" + str(ann_id) + ".png"
-                    sample_path = "db/anns/" + str(ann_id) + "/X_" + str(ann_id) + ".jpg"
-                    print(path)
-                    print(sample_path)
-
-                memberships = [labeled_sets[t] for t in ann_alt["tags"]]
-
-
-                # ann_id+1 since primary key must be > 0 
-                ormar_ann = await ImageAnnotation(id=ann_id+1, 
-                                                  s3_key=path,
-                                                  s3_bucket="laboncmosdata",
-                                                  in_progress=False,
-                                                  finished=finished,
-                                                  created_by="Nathan Renegar",
-                                                  created_on=datetime.datetime.now(),
-                                                  updated_by="Nathan Renegar",
-                                                  updated_on=datetime.datetime.now(),
-                                                  started_at=datetime.datetime.now(),
-                                                  finished_at=datetime.datetime.now(),
-                                                  source_x1=x1,
-                                                  source_x2=x2,
-                                                  source_y1=y1,
-                                                  source_y2=y2,
-                                                  cell_count=0,
-                                                  cell_morphology="balled",
-                                                  source_image=db_image).save()
-
-                sample_image = await SampleImage(id=ann_id+1,
-                                                 s3_key=sample_path,
-                                                 s3_bucket="laboncmosdata",
-                                                 num_channels=3,
-                                                 source_x1=x1,
-                                                 source_x2=x2,
-                                                 source_y1=y1,
-                                                 source_y2=y2,
-                                                 source_image=db_image,
-                                                 annotation=ormar_ann).save()
-
-                for m in memberships:
-                    num_images = m.num_images
-                    await ormar_ann.memberships.add(m)
-                    await m.update(num_images=num_images+1)
-
-db_exp_list = asyncio.run(main())
-print(db_exp_list)
+            if image["name"] not in done:
+                todo.append((exp, db_exps[exp], image))
+
+    if verbose:
+        print("Importing", len(todo), "source images (" + str(len(done)) + " already imported)")
+    now = datetime.datetime.now()
+    totals = [0, 0, 0]
+    t1 = time.perf_counter()
+    for c in range(0, len(todo), chunk_size):
+        counts = await import_chunk(todo[c:c+chunk_size], anns_by_id, labeled_sets, now)
+        totals = [a + b for a, b in zip(totals, counts)]
+        t2 = time.perf_counter()
+        if verbose:
+            print("    {} images, {} annotations, {} pool links imported in {:0.2f} seconds".format(
+                  totals[0], totals[1], totals[2], t2 - t1))
+
+    # Ids were inserted explicitly, move the id sequences past them so rows
+    # created later (e.g. by generate_sequences.py) do not collide. SQLite
+    # has no sequences, it always continues after the largest id.
+    if database_handle.url.dialect.startswith("postgres"):
+        for table in [ImageAnnotation.Meta.tablename, SampleImage.Meta.tablename]:
+            await database_handle.execute(
+                "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                "COALESCE((SELECT MAX(id) FROM {0}), 0) + 1, false)".format(table))
+
+    return list(db_exps.values()), totals
+
+async def main(args):
+    # The legacy JSON database, only needed here
+    import database
+
+    await database_handle.connect()
+    await migrations.migrate(database_handle)
+    db = database.Database()
+    db_exps, totals = await import_legacy(db.get_dict(), args.chunk_size, args.min_images)
+    return db_exps
+
+if __name__ == "__main__":
+    db_exp_list = asyncio.run(main(parse_args()))
+    print(db_exp_list)
 
 # Add the experiments to the database
 # Add the images to each experiment
@@ -0,0 +1,61 @@
+import numpy as np
+
+# Grid of candidate ROIs over a source image. Cells are described by their
+# integer start coordinates along each axis plus a boolean selection mask, so
+# hit testing and counting never have to walk matplotlib artists. Cell
+# (row, col) has its top left corner at (h_starts[col], v_starts[row]); flat
+# cell order is row major, matching the order the GUI has always used.
+class RoiGrid(object):
+
+    def __init__(self, h, v, h_size, v_size, h_pad, v_pad, h_stretch=1, v_stretch=1):
+        self.h_size = h_size
+        self.v_size = v_size
+        max_hs = max((h - h_pad - h_size) // int(h_size * h_stretch), 0)
+        max_vs = max((v - v_pad - v_size) // int(v_size * v_stretch), 0)
+        self.h_starts = np.linspace(h_pad, h - h_pad - h_size, max_hs).astype(int)
+        self.v_starts = np.linspace(v_pad, v - v_pad - v_size, max_vs).astype(int)
+        self.selected = np.zeros((max_vs, max_hs), dtype=bool)
+
+    @property
+    def num_cells(self):
+        return self.selected.size
+
+    @property
+    def num_selected(self):
+        return int(np.count_nonzero(self.selected))
+
+    # (num_cells x 2) array of (x, y) cell origins in flat order
+    def origins(self):
+        hh, vv = np.meshgrid(self.h_starts, self.v_starts)
+        return np.stack([hh.ravel(), vv.ravel()], axis=-1)
+
+    def selected_origins(self):
+        return self.origins()[self.selected.ravel()]
+
+    # Index ranges of the cells whose (closed) rectangle contains a point.
+    # Cells only overlap when the padding squeezes them together.
+    def cells_at(self, x, y):
+        cols = slice(np.searchsorted(self.h_starts, x - self.h_size, 'left'),
+                     np.searchsorted(self.h_starts, x, 'right'))
+        rows = slice(np.searchsorted(self.v_starts, y - self.v_size, 'left'),
+                     np.searchsorted(self.v_starts, y, 'right'))
+        return rows, cols
+
+    def toggle(self, x, y):
+        rows, cols = self.cells_at(x, y)
+        self.selected[rows, cols] = ~self.selected[rows, cols]
+
+    def select(self, idxs=None, mask=None):
+        if mask is not None:
+            self.selected = np.asarray(mask, dtype=bool).reshape(self.selected.shape).copy()
+        if idxs is not None:
+            self.selected.ravel()[np.asarray(idxs, dtype=int)] = True
+
+    # Cell rectangles as (num_cells x 4 x 2) vertices, for a PolyCollection
+    def vertices(self):
+        o = self.origins()
+        corners = np.array([[0, 0], [self.h_size, 0], [self.h_size, self.v_size], [0, self.v_size]])
+        return o[:, None, :] + corners[None, :, :]
+
+    def edge_colors(self):
+        return np.where(self.selected.ravel(), 'r', 'g')
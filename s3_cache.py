@@ -0,0 +1,218 @@
+import os
+import hashlib
+import tempfile
+import threading
+import contextlib
+from collections import OrderedDict
+
+# Persistent on-disk cache for S3 objects. Entries are content addressed by
+# (bucket, key, ETag), so an object that changes in S3 gets a new entry and the
+# stale one just ages out. A HEAD request is still made on every lookup to get
+# the current ETag, but that is tiny next to downloading a full source image.
+#
+# Least recently used entries are evicted once the cache goes over its size
+# budget. The entries and their total size are kept in an in-memory LRU index,
+# built from the directory once at startup, so a lookup never walks the cache.
+# Recency is also written to the file mtime on every hit, so several CLI
+# processes can share the same cache directory: when the index says we are
+# over budget the directory is rescanned (picking up what other processes
+# added or removed) and entries are evicted down to `low_water` of the
+# budget, so the scan happens once per that much turnover, not per miss.
+#
+# Downloads go to a temporary file first and are renamed into place, so a
+# reader never sees a partially written entry. Use pin() / pinned() to read an
+# entry later than the lookup, so eviction does not remove it in between.
+
+class S3Cache(object):
+
+    def __init__(self, s3_handle, cache_dir='.cache/s3/', max_bytes=4 * 1024**3, low_water=0.9):
+        self.s3_handle = s3_handle
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.index = OrderedDict() # path -> size, least recently used first
+        self.total = 0
+        self.pins = {} # path -> number of readers
+        self.evicting = False
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.load_index(self.entries())
+
+    def entry_path(self, bucket, key, etag):
+        digest = hashlib.sha256((bucket + '/' + key + '@' + etag).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def get_etag(self, bucket, key):
+        return self.s3_handle.head_object(Bucket=bucket, Key=key)['ETag'].strip('"')
+
+    # Returns a local path holding the object's bytes, downloading on a miss.
+    # With pin=True the entry is pinned as it is looked up (see pin()).
+    def get_path(self, bucket, key, pin=False):
+        etag = self.get_etag(bucket, key)
+        path = self.entry_path(bucket, key, etag)
+
+        try:
+            os.utime(path, None) # mark as recently used
+            with self.lock:
+                # Looked at under the lock, so our eviction cannot remove it
+                # before it is pinned
+                size = os.path.getsize(path)
+                self.hits = self.hits + 1
+                if not self.use(path): # written by another process
+                    self.index[path] = size
+                    self.total = self.total + size
+                if pin:
+                    self.pins[path] = self.pins.get(path, 0) + 1
+            return path
+        except FileNotFoundError:
+            pass
+
+        entry_dir = os.path.dirname(path)
+        if not os.path.exists(entry_dir):
+            os.makedirs(entry_dir, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=entry_dir, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                self.s3_handle.download_fileobj(bucket, key, f)
+                size = f.tell()
+            # Indexed (as most recently used) and pinned before it becomes visible
+            self.add(path, size, pin)
+            try:
+                os.replace(tmp_path, path)
+            except BaseException:
+                if pin:
+                    self.unpin(path)
+                raise
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        with self.lock:
+            self.misses = self.misses + 1
+        self.evict()
+        return path
+
+    # Returns the path of the object and pins it: it is not evicted (by this
+    # process) until unpin(path)
+    def pin(self, bucket, key):
+        return self.get_path(bucket, key, pin=True)
+
+    # pin() for the duration of a block
+    @contextlib.contextmanager
+    def pinned(self, bucket, key):
+        path = self.pin(bucket, key)
+        try:
+            yield path
+        finally:
+            self.unpin(path)
+
+    def unpin(self, path):
+        with self.lock:
+            self.pins[path] = self.pins[path] - 1
+            if self.pins[path] == 0:
+                del self.pins[path]
+
+    #### INDEX ####
+
+    # Moves a known entry to the most recently used end. Call with the lock.
+    def use(self, path):
+        if path in self.index:
+            self.index.move_to_end(path)
+            return True
+        return False
+
+    def add(self, path, size, pin=False):
+        with self.lock:
+            if not self.use(path):
+                self.index[path] = size
+                self.total = self.total + size
+            if pin:
+                self.pins[path] = self.pins.get(path, 0) + 1
+
+    def load_index(self, entries):
+        entries.sort()
+        self.index = OrderedDict([(path, size) for mtime, size, path in entries])
+        self.total = sum([size for mtime, size, path in entries])
+
+    def get_bytes(self, bucket, key):
+        with open(self.get_path(bucket, key), 'rb') as f:
+            return f.read()
+
+    def entries(self):
+        entries = []
+        for root, dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.part'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError: # evicted by another process
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def size(self):
+        return self.total
+
+    # Once over budget, drop least recently used entries (skipping pinned
+    # ones) until we are under the low water mark
+    def evict(self):
+        with self.lock:
+            if self.total <= self.max_bytes or self.evicting:
+                return
+            self.evicting = True
+        try:
+            entries = self.entries() # other processes share the directory
+            with self.lock:
+                # Keep what was added while the directory was being walked
+                added = [(path, size) for path, size in self.index.items()]
+                self.load_index(entries)
+                for path, size in added:
+                    if path not in self.index and os.path.exists(path):
+                        self.index[path] = size
+                        self.total = self.total + size
+                target = self.max_bytes * self.low_water
+                for path in list(self.index):
+                    if self.total <= target:
+                        break
+                    if path in self.pins:
+                        continue
+                    self.total = self.total - self.index.pop(path)
+                    try:
+                        os.remove(path)
+                        self.evictions = self.evictions + 1
+                    except FileNotFoundError:
+                        pass
+        finally:
+            self.evicting = False
+
+    def clear(self):
+        entries = self.entries()
+        with self.lock:
+            for mtime, size, path in entries:
+                if path in self.pins:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self.load_index([e for e in entries if e[2] in self.pins])
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits / lookups) if lookups > 0 else 0.0,
+                'size_bytes': self.size(),
+                'max_bytes': self.max_bytes,
+               }
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import random
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError, BotoCoreError
+
+# Bulk S3 transfers. Objects are moved by a bounded pool of threads sharing
+# one client (boto3 clients are thread safe), each transfer is retried with
+# exponential backoff, and every batch reports its throughput.
+#
+# Point S3_ENDPOINT_URL at a local S3 stand-in (moto server, minio) to run
+# everything without touching AWS.
+
+# Source images are a few MB and annotations are small, so only go multipart
+# for genuinely large objects and keep parts big enough to be efficient
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=16 * 1024**2,
+                                 multipart_chunksize=16 * 1024**2,
+                                 max_concurrency=4,
+                                 use_threads=True)
+
+def make_s3_client(endpoint_url=None):
+    endpoint_url = endpoint_url or os.environ.get('S3_ENDPOINT_URL')
+    return boto3.client('s3', endpoint_url=endpoint_url)
+
+def is_retryable(e):
+    if isinstance(e, ClientError):
+        code = e.response.get('Error', {}).get('Code', '')
+        status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return code in ('SlowDown', 'RequestTimeout', 'InternalError', 'Throttling') or status >= 500
+    return isinstance(e, (BotoCoreError, ConnectionError, TimeoutError))
+
+def is_not_found(e):
+    if isinstance(e, ClientError):
+        code = e.response.get('Error', {}).get('Code', '')
+        status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return code in ('404', 'NoSuchKey', 'NotFound') or status == 404
+    return False
+
+class TransferReport(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.bytes = 0
+        self.retries = 0
+        self.failures = []
+        self.seconds = 0.0
+
+    def throughput(self):
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        return "{}: {} objects, {:.1f} MB in {:.2f} s ({:.1f} MB/s), {} retries, {} failed".format(
+               self.name, self.count, self.bytes / 1024**2, self.seconds,
+               self.throughput() / 1024**2, self.retries, len(self.failures))
+
+class S3TransferEngine(object):
+
+    def __init__(self, s3_handle, max_workers=16, max_retries=5, backoff=0.5,
+                 transfer_config=TRANSFER_CONFIG):
+        self.s3_handle = s3_handle
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.transfer_config = transfer_config
+        self.lock = threading.Lock()
+
+    def with_retries(self, fn, report):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return fn()
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    raise
+                with self.lock:
+                    report.retries = report.retries + 1
+                time.sleep(self.backoff * (2 ** attempt) * (0.5 + random.random()))
+
+    # Runs `fn(item)` for every item on the worker pool. `fn` returns the
+    # number of bytes it moved. Failed items are collected, not raised. Items
+    # run in a copy of the caller's context (see instrumentation.py).
+    def run(self, name, fn, items, verbose=True):
+        report = TransferReport(name)
+        t1 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = dict([(pool.submit(contextvars.copy_context().run, self.with_retries,
+                                         (lambda it=it: fn(it)), report), it) for it in items])
+            for fut in as_completed(futures):
+                try:
+                    nbytes = fut.result()
+                    report.count = report.count + 1
+                    report.bytes = report.bytes + (nbytes or 0)
+                except Exception as e:
+                    report.failures.append((futures[fut], e))
+                if verbose and (report.count + len(report.failures)) % 100 == 0:
+                    print("    " + str(report.count + len(report.failures)) + "/" + str(len(items)) + " done...")
+        report.seconds = time.perf_counter() - t1
+        if verbose:
+            print("    " + str(report))
+        return report
+
+    def download_one(self, bucket, key, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.s3_handle.download_file(bucket, key, path, Config=self.transfer_config)
+        return os.path.getsize(path)
+
+    def upload_one(self, path, bucket, key):
+        self.s3_handle.upload_file(path, bucket, key, Config=self.transfer_config)
+        return os.path.getsize(path)
+
+    def put_one(self, bucket, key, data):
+        self.s3_handle.put_object(Bucket=bucket, Key=key, Body=data)
+        return len(data)
+
+    # items: (bucket, key, local path)
+    def download_many(self, items, verbose=True):
+        return self.run("download", lambda it: self.download_one(*it), items, verbose)
+
+    # items: (local path, bucket, key)
+    def upload_many(self, items, verbose=True):
+        return self.run("upload", lambda it: self.upload_one(*it), items, verbose)
+
+    # items: (bucket, key, bytes), for objects built in memory
+    def put_many(self, items, verbose=True):
+        return self.run("put", lambda it: self.put_one(*it), items, verbose)
+
+    # Pulls (bucket, key) pairs into an S3Cache concurrently
+    def prefetch(self, cache, items, verbose=True):
+        return self.run("prefetch", lambda it: os.path.getsize(cache.get_path(*it)), items, verbose)
+
+# Finished work waiting to be uploaded. Each entry is a file plus a JSON
+# sidecar naming its destination, so uploads that fail (or happen while
+# offline) can be pushed later in bulk.
+class Outbox(object):
+
+    def __init__(self, path='.outbox/'):
+        self.path = path
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def add(self, name, data, bucket, key, **info):
+        data_path = os.path.join(self.path, name)
+        with open(data_path + '.part', 'wb') as f:
+            f.write(data)
+        os.replace(data_path + '.part', data_path)
+        info.update({'bucket': bucket, 'key': key})
+        with open(data_path + '.json', 'w') as f:
+            json.dump(info, f)
+        return data_path
+
+    def entries(self):
+        entries = []
+        for name in sorted(os.listdir(self.path)):
+            if not name.endswith('.json'):
+                continue
+            data_path = os.path.join(self.path, name[:-len('.json')])
+            with open(data_path + '.json') as f:
+                entries.append((data_path, json.load(f)))
+        return entries
+
+    def remove(self, data_path):
+        for p in [data_path, data_path + '.json']:
+            if os.path.exists(p):
+                os.remove(p)
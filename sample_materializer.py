@@ -0,0 +1,102 @@
+import io
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Cuts the S3 objects of SampleImage rows that do not have one yet. Samples
+# are handled per source image: the source is downloaded and decoded once and
+# all of its crops are gathered in one vectorized pass, then encoded and
+# uploaded concurrently. The database side lives in database_remote_commands.py.
+
+# Objects under this prefix were cut by materialize-samples and can be
+# trusted to hold the exact (lossless) pixels of their rectangle
+SAMPLE_PREFIX = "db/samples/"
+
+def sample_key(sample_id):
+    return SAMPLE_PREFIX + str(sample_id) + "/X_" + str(sample_id) + ".png"
+
+# Crops of one size h x w at rows x1 and columns y1 of `im`, as one
+# n x h x w (x C) array. The sliding window view is free, so the only copy
+# is the final gather.
+def crop_many(im, x1, y1, h, w):
+    windows = sliding_window_view(im, (h, w), axis=(0, 1))
+    crops = windows[np.asarray(x1), np.asarray(y1)]
+    if im.ndim == 3:
+        crops = np.moveaxis(crops, 1, -1) # n x C x h x w -> n x h x w x C
+    return crops
+
+# samples: list of (sample id, ((x1, y1), (x2, y2))). Crops of the same size
+# that lie inside the image share one gather. Crops running past the bottom or
+# right edge are truncated, like crop_image does; ones starting outside the
+# image fail on their own. Returns the (sample id, crop) pairs and the
+# (sample id, error) failures.
+def cut_samples(im, samples):
+    rows, cols = im.shape[0], im.shape[1]
+    by_size = {}
+    out = []
+    failures = []
+    for sample_id, ((x1, y1), (x2, y2)) in samples:
+        if x1 < 0 or y1 < 0 or x1 >= min(x2, rows) or y1 >= min(y2, cols):
+            failures.append((sample_id, ValueError("Crop " + str(((x1, y1), (x2, y2))) +
+                                                   " is outside the " + str(im.shape[:2]) + " source image")))
+        elif x2 > rows or y2 > cols:
+            out.append((sample_id, im[x1:x2, y1:y2]))
+        else:
+            by_size.setdefault((x2 - x1, y2 - y1), []).append((sample_id, x1, y1))
+
+    for (h, w), group in by_size.items():
+        ids, x1, y1 = zip(*group)
+        out.extend(zip(ids, crop_many(im, x1, y1, h, w)))
+    return out, failures
+
+def encode_png(im):
+    buf = io.BytesIO()
+    Image.fromarray(np.ascontiguousarray(im)).save(buf, format="PNG")
+    return buf.getvalue()
+
+# One source image: decode, cut, encode. Returns the (sample id, bucket, key,
+# bytes) items and the (sample key, error) failures.
+def materialize_source(cache, src_bucket, src_key, samples):
+    with cache.pinned(src_bucket, src_key) as path:
+        im = Image.open(path)
+        im.load()
+    im = np.asarray(im)
+    buckets = dict([(s[0], s[1]) for s in samples])
+    crops, failures = cut_samples(im, [(s[0], s[2]) for s in samples])
+    return [(i, buckets[i], sample_key(i), encode_png(c)) for i, c in crops], \
+           [(sample_key(i), e) for i, e in failures]
+
+# Materializes one batch of sources. `batch` is a list of (source bucket,
+# source key, [(sample id, sample bucket, crop)]). Returns the (sample id, key)
+# pairs that were uploaded and the failures.
+def materialize_batch(batch, cache, transfer, verbose=True):
+    t1 = time.perf_counter()
+    transfer.prefetch(cache, [(b, k) for b, k, s in batch], verbose=False)
+
+    items = []
+    failures = []
+    # PIL releases the GIL while decoding and encoding, so threads are enough
+    with ThreadPoolExecutor(max_workers=transfer.max_workers) as pool:
+        futures = [(src_key, pool.submit(contextvars.copy_context().run, materialize_source, cache, b, src_key, s))
+                   for b, src_key, s in batch]
+        for src_key, fut in futures:
+            try:
+                source_items, source_failures = fut.result()
+                items.extend(source_items)
+                failures.extend(source_failures)
+            except Exception as e:
+                failures.append((src_key, e))
+    t2 = time.perf_counter()
+
+    report = transfer.put_many([(b, k, data) for i, b, k, data in items], verbose=False)
+    failed_keys = set([it[1] for it, e in report.failures])
+    failures.extend([(it[1], e) for it, e in report.failures])
+    done = [(i, k) for i, b, k, data in items if k not in failed_keys]
+
+    if verbose:
+        print("    {} sources -> {} samples: cut in {:0.2f} s, uploaded {:.1f} MB in {:0.2f} s".format(
+              len(batch), len(done), t2 - t1, report.bytes / 1024**2, report.seconds))
+    return done, failures
@@ -2,34 +2,143 @@ from imagetypes import SubImage
 
 import numpy as np
 import cv2
+import asyncio
+import threading
+from collections import OrderedDict, deque
 
 import matplotlib.pyplot as plt
 from matplotlib.widgets import RectangleSelector, Slider, Button, RadioButtons, TextBox
-import matplotlib.patches as patches
+from matplotlib.collections import PolyCollection
 from matplotlib.backend_bases import MouseEvent
 
-# This class takes in a Database object and presents a gui that allows the user
-# to generate sequences of images
+from database_models import Experiment, database_handle, get_experiment_frames
+from roi_grid import RoiGrid
+
+# This class reads experiments and source images from the database and
+# presents a gui that allows the user to generate sequences of images
 
 # WARNING: This implementation makes some assumptions about the structure of
 # the database. If this tool is generalized to other datasets than the one it
 # was built on, this will probably need to change
 
-# Inputs: Database object with get_dict method
+# Inputs: S3Cache used to fetch source images
 # Outputs: list of subimage metadata
 
+# Bounded LRU cache of decoded (and optionally downsampled) frames. A
+# background thread decodes frames near the current slider positions so that
+# scrubbing mostly hits the cache. Only the most recent prefetch request is
+# honored, stale ones are dropped.
+class FrameCache(object):
+
+    def __init__(self, max_frames=64, downsample=1, resolve=None):
+        self.max_frames = max_frames
+        self.resolve = resolve # maps a frame key to a local file path
+        self.downsample = downsample
+        self.frames = OrderedDict()
+        self.wanted = deque()
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.hits = 0
+        self.misses = 0
+
+        self.thread = threading.Thread(target=self.prefetch_loop, daemon=True)
+        self.thread.start()
+
+    def decode(self, key):
+        path = self.resolve(key) if self.resolve is not None else key
+        im = cv2.imread(path)
+        im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+        if self.downsample > 1:
+            im = cv2.resize(im, (im.shape[1] // self.downsample, im.shape[0] // self.downsample),
+                            interpolation=cv2.INTER_AREA)
+        return im
+
+    def insert(self, path, im):
+        # must hold self.lock
+        self.frames[path] = im
+        self.frames.move_to_end(path)
+        while len(self.frames) > self.max_frames:
+            self.frames.popitem(last=False)
+
+    def get(self, path):
+        with self.lock:
+            if path in self.frames:
+                self.frames.move_to_end(path)
+                self.hits = self.hits + 1
+                return self.frames[path]
+            self.misses = self.misses + 1
+
+        im = self.decode(path)
+        with self.lock:
+            self.insert(path, im)
+        return im
+
+    # Replaces any pending prefetches, nearest frames should come first
+    def prefetch(self, paths):
+        with self.cond:
+            self.wanted.clear()
+            self.wanted.extend(paths[:self.max_frames // 2])
+            self.cond.notify()
+
+    def prefetch_loop(self):
+        while True:
+            with self.cond:
+                while len(self.wanted) == 0:
+                    self.cond.wait()
+                path = self.wanted.popleft()
+                if path in self.frames:
+                    continue
+            try:
+                im = self.decode(path)
+            except Exception: # a failed prefetch is retried by get()
+                continue
+            with self.lock:
+                self.insert(path, im)
+
+# Index and value of the entry of the sorted array `times` closest to `val`
+def closest_time_idx(times, val):
+    idx = int(np.searchsorted(times, val))
+    if idx == len(times) or (idx > 0 and abs(val - times[idx - 1]) <= abs(times[idx] - val)):
+        idx = idx - 1
+    return idx, times[idx]
+
+# Frame indices ordered by distance from `idxs`, up to `radius` frames away
+def frames_near(idxs, radius, num_frames):
+    near = []
+    for r in range(radius + 1):
+        for idx in idxs:
+            for i in ([idx] if r == 0 else [idx + r, idx - r]):
+                if 0 <= i < num_frames and i not in near:
+                    near.append(i)
+    return near
+
 class ImageSequencer(object):
 
-    def __init__(self, database):
-        # get_dict returns a deep copy of the dictionary, so we can modify
-        # however we need 
-        self.redef_data(database)
+    def __init__(self, s3_cache, cache_frames=64, downsample=1, prefetch_radius=4):
+        self.s3_cache = s3_cache
+        self.frame_cache = FrameCache(cache_frames, downsample,
+                                      resolve=lambda key: s3_cache.get_path(key[0], key[1]))
+        self.prefetch_radius = prefetch_radius
 
-    def redef_data(self, database):
-        self.image_dict = database.get_dict()['data']['experiments']
+        # The GUI is synchronous, so database queries run on a private loop
+        self.loop = asyncio.new_event_loop()
+        if not database_handle.is_connected:
+            self.run(database_handle.connect())
+        self.redef_data()
 
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
 
-    def get_sequence(self):
+    # Only experiment level metadata is loaded up front; frames are queried per
+    # experiment and time range when a sequence is requested
+    def redef_data(self):
+        exps = self.run(Experiment.objects.all())
+        self.experiments = dict([(e.name, e) for e in exps])
+
+    def get_frames(self, exp, start_time=None, end_time=None):
+        return self.run(get_experiment_frames(exp, start_time, end_time))
+
+    def get_sequence(self, start_time=None, end_time=None):
 
         # This gets the experiment number 
         valid_exp = False
@@ -38,31 +147,42 @@ class ImageSequencer(object):
             try:
                 exp = int(input("Please enter desired experiment number: "))
                 exp = 'exp' + ('0' + str(exp) if exp < 10 else str(exp))
-                exp_images = self.image_dict[exp]['images']['image_array']
-                num_exp_images = self.image_dict[exp]['images']['num_images']
-                duration = self.image_dict[exp]['duration'] 
-                h, v = exp_images[0]['resolution']
-                print(exp, "has", self.image_dict[exp]['duration'], 
-                        "hours of data, consisting of", num_exp_images, "images.")
+                duration = self.experiments[exp].duration
+                exp_images = self.get_frames(exp, start_time, end_time)
+                num_exp_images = len(exp_images)
+                h, v = exp_images[0].image_resx, exp_images[0].image_resy
+                print(exp, "has", duration, 
+                        "hours of data, consisting of", num_exp_images, "images in the selected range.")
                 valid_exp = True
-            except (KeyError, ValueError) as e:
-                print("You entered an invalid experiment number. Valid numbers are:")
-                exp_strings = list(self.image_dict.keys())
+            except (KeyError, ValueError, IndexError) as e:
+                print("You entered an invalid experiment number (or it has no images in range). Valid numbers are:")
+                exp_strings = list(self.experiments.keys())
                 exp_strings = [int(x.split('exp')[1]) for x in exp_strings]
                 print(str(exp_strings))
 
-        # Get start and ending hours
-        times = [img['time'] for img in exp_images]
+        # Start and ending hours; the query returns frames sorted by time so
+        # lookups can bisect
+        times = np.array([img.time for img in exp_images])
+        paths = [(img.s3_bucket, img.s3_key) for img in exp_images]
+        cache = self.frame_cache
+
+        # Frames may be downsampled, so always draw them in full resolution
+        # pixel coordinates
+        extent = (-0.5, h - 0.5, v - 0.5, -0.5)
+
+        def get_frame(idx):
+            return cache.get(paths[idx])
+
+        def prefetch_near(*idxs):
+            cache.prefetch([paths[i] for i in frames_near(idxs, self.prefetch_radius, len(paths))])
 
         fig,ax = plt.subplots(ncols=2, nrows=1, sharey=True, sharex=True)
         ax = ax.ravel()
-        im0 = cv2.imread(exp_images[0]['path']) 
-        im0 = cv2.cvtColor(im0, cv2.COLOR_BGR2RGB)
-        im1 = cv2.imread(exp_images[-1]['path']) 
-        im1 = cv2.cvtColor(im1, cv2.COLOR_BGR2RGB)
-        artist_0 = ax[0].imshow(im0)
+        im0 = get_frame(0)
+        im1 = get_frame(-1)
+        artist_0 = ax[0].imshow(im0, extent=extent)
         ax[0].set_title('First image at time = ' + str(times[0]) + " hours")
-        artist_1 = ax[1].imshow(im1)
+        artist_1 = ax[1].imshow(im1, extent=extent)
         ax[1].set_title('Last image at time = ' + str(times[-1]) + " hours")
     
         axcolor = 'lightgoldenrodyellow'
@@ -76,26 +196,22 @@ class ImageSequencer(object):
         update = Button(update_ax, 'Update', color=axcolor, hovercolor='0.975')
         next_button = Button(next_ax, 'Next', color=axcolor, hovercolor='0.975')
 
+        def get_closest_time_idx(val):
+            return closest_time_idx(times, val)
+
         def update_start(val):
             ts = s_start.val
             te = s_end.val
             if ts > te:
                 s_end.set_val(ts)
+            prefetch_near(get_closest_time_idx(s_start.val)[0], get_closest_time_idx(s_end.val)[0])
                 
         def update_end(val):
             ts = s_start.val
             te = s_end.val
             if te < ts:
                 s_start.set_val(te)
-                
-        def get_closest_time_idx(val):
-            cl_time, cl_idx = 0, 0
-            for idx, time in list(enumerate(times)):
-                if (abs(val - time) < abs(cl_time - time)):
-                    cl_time = time
-                    cl_idx = idx
-
-            return cl_idx, cl_time
+            prefetch_near(get_closest_time_idx(s_end.val)[0], get_closest_time_idx(s_start.val)[0])
 
         def update_images(event):
             s_idx, st = get_closest_time_idx(s_start.val)
@@ -103,10 +219,8 @@ class ImageSequencer(object):
             s_start.set_val(st)
             s_end.set_val(et)
 
-            im0 = cv2.imread(exp_images[s_idx]['path']) 
-            im0 = cv2.cvtColor(im0, cv2.COLOR_BGR2RGB)
-            im1 = cv2.imread(exp_images[e_idx]['path']) 
-            im1 = cv2.cvtColor(im1, cv2.COLOR_BGR2RGB)
+            im0 = get_frame(s_idx)
+            im1 = get_frame(e_idx)
             artist_0.set_data(im0)
             ax[0].set_title('First image at time = ' + str(st) + " hours")
             artist_1.set_data(im1) 
@@ -133,13 +247,11 @@ class ImageSequencer(object):
         # Set up figure for ROI settings
         fig,ax = plt.subplots(ncols=2, nrows=1, sharey=True, sharex=True)
         ax = ax.ravel()
-        im0 = cv2.imread(exp_images[start_idx]['path']) 
-        im0 = cv2.cvtColor(im0, cv2.COLOR_BGR2RGB)
-        im1 = cv2.imread(exp_images[end_idx]['path']) 
-        im1 = cv2.cvtColor(im1, cv2.COLOR_BGR2RGB)
-        artist_0 = ax[0].imshow(im0)
+        im0 = get_frame(start_idx)
+        im1 = get_frame(end_idx)
+        artist_0 = ax[0].imshow(im0, extent=extent)
         ax[0].set_title('First image at time = ' + str(start_hr) + " hours")
-        artist_1 = ax[1].imshow(im1)
+        artist_1 = ax[1].imshow(im1, extent=extent)
         ax[1].set_title('Last image at time = ' + str(end_hr) + " hours")
 
         # set up new axes, sliders, and buttons for annotations
@@ -163,48 +275,36 @@ class ImageSequencer(object):
 
         # radio buttons to toggle between two modes
 
-        def draw_grid():
-            for a in ax:
-                for p in a.patches:
-                    p.set_visible(True)
+        # One collection per axis holds the whole grid; the selection lives in
+        # the RoiGrid mask
+        grid = [None]
+        grid_artists = []
 
+        def draw_grid():
+            for c in grid_artists:
+                c.set_visible(True)
             fig.canvas.draw()
 
         def clear_grid():
-            for a in ax:
-                for p in a.patches:
-                    p.set_visible(False)
+            for c in grid_artists:
+                c.set_visible(False)
             fig.canvas.draw()
 
         def reset_grid():
-            for a in ax:
-                a.patches = []
+            for c in grid_artists:
+                c.remove()
+            del grid_artists[:]
 
         def get_num_rois():
-            num_rois = 0
-            for rect in ax[0].patches:
-                if rect.get_edgecolor() == (1.0, 0.0, 0.0, 1):
-                    num_rois = num_rois + 1
-            return num_rois
+            return grid[0].num_selected
 
         def click_roi(event):
-            if type(event) == MouseEvent:
+            if type(event) == MouseEvent and event.inaxes in ax:
                 try:
-                    click_x, click_y = event.xdata, event.ydata
-
-                    for idx, rect in list(enumerate(ax[0].patches)):
-                        xmin, ymin = rect.get_xy()
-                        xmax, ymax = xmin + rect.get_width(), ymin + rect.get_height()
-                        if ((click_x >= xmin and click_x <= xmax) and
-                            (click_y >= ymin and click_y <= ymax)):
-                                color = rect.get_edgecolor()                    
-                                clicked_color = (1.0, 0.0, 0.0, 1)
-                                if color != clicked_color:
-                                    rect.set_edgecolor('r')
-                                    ax[1].patches[idx].set_edgecolor('r')
-                                elif color == clicked_color:
-                                    rect.set_edgecolor('g')
-                                    ax[1].patches[idx].set_edgecolor('g')
+                    grid[0].toggle(event.xdata, event.ydata)
+                    colors = grid[0].edge_colors()
+                    for c in grid_artists:
+                        c.set_edgecolors(colors)
                 except TypeError:
                     pass
       
@@ -225,22 +325,14 @@ class ImageSequencer(object):
             h_pad = int(h_pad_box.text)
             v_pad = int(v_pad_box.text)
 
-            max_hs = (h - h_pad - h_size) // int(h_size * h_strech.val)
-            max_vs = (v - v_pad - v_size) // int(v_size * v_strech.val)
-            h_starts = np.linspace(h_pad, h - h_pad - h_size, max_hs)
-            v_starts = np.linspace(v_pad, v - v_pad - v_size, max_vs) 
-
-            maximum_ts = max_hs * max_vs
-
-            starts = []
-            for i in range(maximum_ts):
-                starts.append((int(h_starts[i % max_hs]), int(v_starts[i // max_hs])))
-
             # Create the grid based on the settings given to us
-            for start in starts:
-                for a in ax:
-                    rect = patches.Rectangle(start,h_size,v_size,linewidth=1,edgecolor='g',facecolor='none')
-                    a.add_patch(rect)
+            grid[0] = RoiGrid(h, v, h_size, v_size, h_pad, v_pad, h_strech.val, v_strech.val)
+            verts = grid[0].vertices()
+            colors = grid[0].edge_colors()
+            for a in ax:
+                c = PolyCollection(verts, facecolors='none', edgecolors=colors, linewidths=1)
+                a.add_collection(c)
+                grid_artists.append(c)
             fig.canvas.draw_idle()
             click_roi(None) # update ROI and image counts
         
@@ -258,12 +350,7 @@ class ImageSequencer(object):
 
         # Construct list of subimages to be appended 
         img_idxs = [(start_idx + i*stride) for i in range((end_idx - start_idx) // stride)] 
-        roi_corners = []
-        for rect in ax[0].patches:
-            color = rect.get_edgecolor()                    
-            clicked_color = (1.0, 0.0, 0.0, 1)
-            if color == clicked_color:
-                roi_corners.append(rect.get_xy())
+        roi_corners = [tuple(o) for o in grid[0].selected_origins().tolist()]
         
         tmp_img = SubImage()
         img_list = []
@@ -272,8 +359,8 @@ class ImageSequencer(object):
                 d = tmp_img.dict
                 d['size'] = (int(h_res.text), int(v_res.text))
                 d['source_offset'] = offset
-                d['source_path'] = exp_images[idx]['path'] 
-                d['source_name'] = exp_images[idx]['name']
+                d['source_path'] = exp_images[idx].s3_key
+                d['source_name'] = exp_images[idx].name
                 img_list.append(tmp_img.get_dict())  
 
         return img_list 
@@ -1,16 +1,18 @@
-import database_models
-from database_models import * 
-from database_models import database_handle, metadata, engine
-import sqlalchemy
+import time
+start = time.perf_counter()
 import asyncio
-import datetime
-import database_remote_commands
 import asyncpg
 
+# The database modules are only imported under the guard: commands like
+# export-training-set start spawn worker processes, which re-import this
+# module, and those workers must not touch the database
+if __name__ == "__main__":
+    from database_models import database_handle, metadata, engine
+    import database_remote_commands
 
-db = database_remote_commands.Database(database_handle, metadata, engine)
-try:
-    db.start_db()
-except asyncpg.exceptions.InvalidPasswordError:
-    print("Incorrect password.")
-
+    db = database_remote_commands.Database(database_handle, metadata, engine)
+    db.startup_times = [("imports", time.perf_counter() - start)]
+    try:
+        db.start_db()
+    except asyncpg.exceptions.InvalidPasswordError:
+        print("Incorrect password.")
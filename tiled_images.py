@@ -0,0 +1,141 @@
+import json
+import struct
+import zlib
+import numpy as np
+
+# Tiled storage for large source images. A tiled image is one S3 object laid
+# out as:
+#
+#   MAGIC (8 bytes) | header length (uint32 LE) | JSON header | tile data
+#
+# The header holds the image shape, dtype, tile size and the byte offset of
+# every tile. Tiles are stored row major and compressed independently, so
+# reading a crop only needs the header plus one ranged GET per tile row that
+# overlaps the crop. A 256x256 crop of a large image then moves kilobytes
+# instead of the whole PNG.
+
+MAGIC = b'CSDTILE1'
+PREFIX_SIZE = len(MAGIC) + 4
+HEADER_GUESS = 16 * 1024 # first read, usually enough to cover the header
+
+# Built from the whole source key, so same-named frames of different
+# experiments get different tiled objects
+def tiled_key(s3_key):
+    return 'db/tiles/' + s3_key + '.tiles'
+
+def encode_tiled(im, tile_size=256, level=6):
+    shape = list(im.shape)
+    if im.ndim == 2:
+        im = np.expand_dims(im, axis=-1)
+    im = np.ascontiguousarray(im)
+    rows, cols = im.shape[0], im.shape[1]
+
+    chunks = []
+    offsets = [0]
+    for r in range(0, rows, tile_size):
+        for c in range(0, cols, tile_size):
+            tile = np.ascontiguousarray(im[r:r+tile_size, c:c+tile_size])
+            chunk = zlib.compress(tile.tobytes(), level)
+            chunks.append(chunk)
+            offsets.append(offsets[-1] + len(chunk))
+
+    header = json.dumps({
+                         'shape': shape,
+                         'dtype': im.dtype.str,
+                         'tile': tile_size,
+                         'codec': 'zlib',
+                         'offsets': offsets,
+                        }).encode('utf-8')
+
+    return MAGIC + struct.pack('<I', len(header)) + header + b''.join(chunks)
+
+class TiledImageReader(object):
+
+    def __init__(self, s3_handle):
+        self.s3_handle = s3_handle
+        self.headers = {} # (bucket, key) -> (header, data offset, etag)
+        self.bytes_read = 0
+        self.requests = 0
+
+    # Returns (bytes, etag) of [start, end)
+    def get_range(self, bucket, key, start, end):
+        resp = self.s3_handle.get_object(Bucket=bucket, Key=key,
+                                         Range='bytes={}-{}'.format(start, end - 1))
+        data = resp['Body'].read()
+        self.bytes_read = self.bytes_read + len(data)
+        self.requests = self.requests + 1
+        return data, resp['ETag'].strip('"')
+
+    # Headers are cached with the ETag of the object they were read from.
+    # Every tile read checks it, so a re-tiled object is noticed (see
+    # read_crop) without an extra request.
+    def get_header(self, bucket, key):
+        if (bucket, key) in self.headers:
+            return self.headers[(bucket, key)]
+
+        data, etag = self.get_range(bucket, key, 0, HEADER_GUESS)
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError(key + " is not a tiled image")
+        header_len = struct.unpack('<I', data[len(MAGIC):PREFIX_SIZE])[0]
+        data_start = PREFIX_SIZE + header_len
+        if len(data) < data_start:
+            rest, rest_etag = self.get_range(bucket, key, len(data), data_start)
+            if rest_etag != etag: # replaced in between, start over
+                return self.get_header(bucket, key)
+            data = data + rest
+
+        header = json.loads(data[PREFIX_SIZE:data_start].decode('utf-8'))
+        self.headers[(bucket, key)] = (header, data_start, etag)
+        return header, data_start, etag
+
+    def forget(self, bucket, key):
+        self.headers.pop((bucket, key), None)
+
+    def get_shape(self, bucket, key):
+        return tuple(self.get_header(bucket, key)[0]['shape'])
+
+    # Same crop convention as crop_image: ((r1, c1), (r2, c2))
+    def read_crop(self, bucket, key, crop, attempts=3):
+        header, data_start, etag = self.get_header(bucket, key)
+        shape = header['shape']
+        rows, cols = shape[0], shape[1]
+        chans = shape[2] if len(shape) == 3 else 1
+        ts = header['tile']
+        dtype = np.dtype(header['dtype'])
+        offsets = header['offsets']
+        tiles_per_row = (cols + ts - 1) // ts
+
+        (r1, c1), (r2, c2) = crop
+        r1, c1 = max(r1, 0), max(c1, 0)
+        r2, c2 = min(r2, rows), min(c2, cols)
+        out = np.zeros((r2 - r1, c2 - c1, chans), dtype=dtype)
+
+        for tr in range(r1 // ts, (r2 - 1) // ts + 1):
+            tc1, tc2 = c1 // ts, (c2 - 1) // ts
+            first = tr * tiles_per_row + tc1
+            last = tr * tiles_per_row + tc2
+
+            # The tiles of a tile row are contiguous, so fetch them in one go
+            blob, blob_etag = self.get_range(bucket, key, data_start + offsets[first],
+                                             data_start + offsets[last + 1])
+            if blob_etag != etag:
+                # Re-tiled since the header was read: its offsets are stale
+                self.forget(bucket, key)
+                if attempts <= 1:
+                    raise ValueError(key + " keeps changing while it is read")
+                return self.read_crop(bucket, key, crop, attempts - 1)
+
+            for tc in range(tc1, tc2 + 1):
+                t = tr * tiles_per_row + tc
+                chunk = blob[offsets[t] - offsets[first]:offsets[t + 1] - offsets[first]]
+                th = min(ts, rows - tr * ts)
+                tw = min(ts, cols - tc * ts)
+                tile = np.frombuffer(zlib.decompress(chunk), dtype=dtype).reshape((th, tw, chans))
+
+                # Intersect the tile with the crop window
+                tr0, tc0 = tr * ts, tc * ts
+                ir1, ir2 = max(r1, tr0), min(r2, tr0 + th)
+                ic1, ic2 = max(c1, tc0), min(c2, tc0 + tw)
+                out[ir1 - r1:ir2 - r1, ic1 - c1:ic2 - c1] = tile[ir1 - tr0:ir2 - tr0, ic1 - tc0:ic2 - tc0]
+
+        return out if len(shape) == 3 else out[:, :, 0]
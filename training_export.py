@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import contextvars
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from PIL import Image
+
+from s3_transfer import TransferReport
+from label_masks import read_label_mask
+
+# Training set export. Finished annotations are grouped by source image so
+# every source is downloaded and decoded once, however many annotations it
+# has. Downloads run on the S3 transfer engine's thread pool and feed a pool
+# of worker processes that decode, cut every annotation into tile x tile
+# (X, y) pairs and write them straight into preallocated shards:
+#
+#   X_00000.npy   n x tile x tile x C   uint8 source pixels
+#   y_00000.npy   n x tile x tile x 1   labels, uint16 unless label_dtype says otherwise
+#   index.json    tile size, shard list and one row per exported tile
+#
+# The shards are plain .npy files, so training code can np.load(..., mmap_mode='r')
+# them without reading the whole set into memory. Workers write disjoint rows,
+# so nothing is copied back to the parent process.
+#
+# This module does not import the database models so worker processes stay
+# light; database_remote_commands.py gathers the annotations.
+
+# Tiles per annotation, in row major order. Annotations are cut into as many
+# whole tiles as fit; ones smaller than a tile are skipped.
+def tile_offsets(size, tile):
+    rows = np.arange(size[0] // tile) * tile
+    cols = np.arange(size[1] // tile) * tile
+    return [(int(r), int(c)) for r in rows for c in cols]
+
+# groups: list of (source bucket, source key, [annotation dicts]), each
+# annotation with id, bucket, key and crop ((x1, y1), (x2, y2)). Assigns every
+# tile a global row, returns (jobs, index rows).
+def plan_export(groups, tile, shard_size):
+    jobs = []
+    rows = []
+    for src_bucket, src_key, anns in groups:
+        tasks = []
+        for ann in anns:
+            (x1, y1), (x2, y2) = ann['crop']
+            for r, c in tile_offsets((x2 - x1, y2 - y1), tile):
+                row = len(rows)
+                tasks.append((row // shard_size, row % shard_size, ann['id'], x1 + r, y1 + c, r, c))
+                rows.append([ann['id'], src_key, x1 + r, y1 + c])
+        if len(tasks) > 0:
+            jobs.append((src_bucket, src_key, anns, tasks))
+    return jobs, rows
+
+def shard_names(shard):
+    return 'X_{:05d}.npy'.format(shard), 'y_{:05d}.npy'.format(shard)
+
+def create_shards(out_dir, num_rows, tile, channels, shard_size, label_dtype):
+    shards = []
+    for s, start in enumerate(range(0, num_rows, shard_size)):
+        n = min(shard_size, num_rows - start)
+        X_name, y_name = shard_names(s)
+        for name, shape, dtype in [(X_name, (n, tile, tile, channels), np.uint8),
+                                   (y_name, (n, tile, tile, 1), label_dtype)]:
+            out = np.lib.format.open_memmap(os.path.join(out_dir, name), mode='w+', dtype=dtype, shape=shape)
+            del out
+        shards.append({'X': X_name, 'y': y_name, 'rows': n})
+    return shards
+
+def load_array(path, mode=None):
+    im = Image.open(path)
+    if mode is not None and im.mode != mode:
+        im = im.convert(mode)
+    im.load()
+    return np.asarray(im)
+
+# Worker process: one source image and all of its annotations
+def export_worker(job):
+    out_dir, tile, channels, src_path, ann_paths, tasks = job
+    t1 = time.perf_counter()
+
+    X_src = load_array(src_path, 'RGB' if channels == 3 else 'L')
+    if X_src.ndim == 2:
+        X_src = X_src[..., None]
+    masks = dict([(ann_id, read_label_mask(path)) for ann_id, path in ann_paths.items()])
+
+    shards = {}
+    for shard, shard_row, ann_id, x, y, r, c in tasks:
+        if shard not in shards:
+            shards[shard] = [np.load(os.path.join(out_dir, name), mmap_mode='r+') for name in shard_names(shard)]
+        X_out, y_out = shards[shard]
+        X_out[shard_row] = X_src[x:x+tile, y:y+tile]
+        mask = masks[ann_id]
+        if mask.size > 0 and mask.max() > np.iinfo(y_out.dtype).max:
+            raise ValueError("Labels of annotation " + str(ann_id) + " do not fit in " + str(y_out.dtype))
+        y_out[shard_row] = mask[r:r+tile, c:c+tile].reshape(tile, tile, 1)
+
+    for X_out, y_out in shards.values():
+        X_out.flush()
+        y_out.flush()
+    return len(tasks), time.perf_counter() - t1
+
+# Runs the export. `cache` is an S3Cache and `transfer` an S3TransferEngine;
+# downloads overlap with the crops of sources that are already local. At most
+# `max_in_flight` sources (default 2 per worker) are being fetched or exported
+# at a time, and their files stay pinned in the cache until the worker is done
+# with them, so downloads never run far ahead of the workers and eviction
+# never removes a file a worker is about to open.
+def export_training_set(groups, out_dir, cache, transfer, tile=256, channels=3,
+                        shard_size=4096, workers=None, label_dtype=np.uint16,
+                        max_in_flight=None, verbose=True):
+    workers = workers or os.cpu_count()
+    max_in_flight = max_in_flight or 2 * workers
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    jobs, rows = plan_export(groups, tile, shard_size)
+    if len(rows) == 0:
+        print("    Nothing to export.")
+        return None
+    shards = create_shards(out_dir, len(rows), tile, channels, shard_size, label_dtype)
+    if verbose:
+        print("    Exporting " + str(len(rows)) + " tiles from " + str(len(jobs)) +
+              " source images into " + str(len(shards)) + " shards...")
+
+    report = TransferReport("export download")
+
+    # Returns the worker's job and the pinned paths to release after it
+    def fetch(job):
+        src_bucket, src_key, anns, tasks = job
+        pinned = []
+        try:
+            src_path = transfer.with_retries(lambda: cache.pin(src_bucket, src_key), report)
+            pinned.append(src_path)
+            ann_paths = {}
+            for a in anns:
+                ann_paths[a['id']] = transfer.with_retries(lambda a=a: cache.pin(a['bucket'], a['key']), report)
+                pinned.append(ann_paths[a['id']])
+        except BaseException:
+            for path in pinned:
+                cache.unpin(path)
+            raise
+        return (out_dir, tile, channels, src_path, ann_paths, tasks), pinned
+
+    # spawn, like the inference workers, so nothing of the parent is inherited.
+    # A worker that dies breaks the pool: its futures raise BrokenProcessPool
+    # instead of waiting forever, and no further sources are started.
+    ctx = multiprocessing.get_context('spawn')
+    t1 = time.perf_counter()
+    done = 0
+    finished = 0
+    failures = []
+    broken = None
+    with ThreadPoolExecutor(max_workers=transfer.max_workers) as io_pool, \
+         ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as cpu_pool:
+        todo = list(reversed(jobs))
+        running = {} # future -> (job, pinned paths); fetches and exports alike
+
+        def release(job, pinned, e=None):
+            for path in pinned:
+                cache.unpin(path)
+            if e is not None:
+                failures.append((job[1], e))
+
+        while len(todo) > 0 or len(running) > 0:
+            # Each fetch runs in a copy of the caller's context, so its S3 calls
+            # count towards the command that started the export
+            while broken is None and len(todo) > 0 and len(running) < max_in_flight:
+                job = todo.pop()
+                running[io_pool.submit(contextvars.copy_context().run, fetch, job)] = (job, None)
+            if broken is not None:
+                for job in reversed(todo):
+                    failures.append((job[1], broken))
+                todo = []
+                if len(running) == 0:
+                    break
+
+            completed, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for fut in completed:
+                job, pinned = running.pop(fut)
+                if pinned is None:
+                    # Fetch finished: hand the local files to a worker
+                    try:
+                        work, pinned = fut.result()
+                    except Exception as e:
+                        failures.append((job[1], e))
+                        continue
+                    try:
+                        running[cpu_pool.submit(export_worker, work)] = (job, pinned)
+                    except BrokenProcessPool as e:
+                        broken = e
+                        release(job, pinned, e)
+                    continue
+                try:
+                    n, _ = fut.result()
+                    done = done + n
+                    release(job, pinned)
+                except BrokenProcessPool as e:
+                    broken = e
+                    release(job, pinned, e)
+                except Exception as e:
+                    release(job, pinned, e)
+                finished = finished + 1
+                if verbose and finished % 100 == 0:
+                    print("    " + str(done) + "/" + str(len(rows)) + " tiles written...")
+
+    if broken is not None and verbose:
+        print("    A worker process died, export stopped: " + str(broken))
+
+    # Rows of sources that failed stay zero; they are flagged in the index
+    failed_keys = set([key for key, e in failures])
+    index = {
+             'tile': tile,
+             'channels': channels,
+             'shard_size': shard_size,
+             'label_dtype': np.dtype(label_dtype).str,
+             'shards': shards,
+             'columns': ['ann_id', 'source_key', 'x', 'y', 'ok'],
+             'rows': [r + [r[1] not in failed_keys] for r in rows],
+            }
+    with open(os.path.join(out_dir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+    if verbose:
+        elapsed = time.perf_counter() - t1
+        print("    {} tiles in {:0.2f} seconds ({:0.1f} tiles/s), {} workers".format(
+              done, elapsed, done / elapsed if elapsed > 0 else 0, workers))
+        for key, e in failures[:10]:
+            print("    Failed: " + key + " (" + str(e) + ")")
+    return index
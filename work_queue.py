@@ -0,0 +1,159 @@
+import datetime
+import sqlalchemy
+
+from database_models import ImageAnnotation, through_table
+
+# Lease based work queue over the annotations table. An annotator claims an
+# unfinished annotation by taking a lease on it: in_progress is set, and
+# leased_by / lease_expires_at record who holds it and until when. The lease
+# is kept alive by a heartbeat while the annotation tool is open, and a lease
+# that expires (a crashed or abandoned session) makes the annotation
+# claimable again.
+#
+# On postgres, claiming the next annotation is a single UPDATE ... RETURNING
+# whose target row is picked with SELECT ... FOR UPDATE SKIP LOCKED, so
+# concurrent claims never block on each other and never get the same row.
+# SQLite serializes writers anyway; SQLAlchemy can not compile RETURNING for
+# it, so there a conditional UPDATE is followed by a check that the lease is
+# ours.
+
+LEASE_SECONDS = 10 * 60
+
+def lease_expiry(now, lease_seconds=LEASE_SECONDS):
+    return now + datetime.timedelta(seconds=lease_seconds)
+
+def is_postgres(database_handle):
+    return database_handle.url.dialect.startswith("postgres")
+
+def lease_is_free(table, now):
+    return sqlalchemy.or_(table.c.in_progress == False,
+                          table.c.leased_by == None,
+                          table.c.lease_expires_at == None,
+                          table.c.lease_expires_at < now)
+
+# Unfinished annotations without a live lease, lowest id first. `pool` limits
+# the queue to one labeled pool.
+def claimable_query(database_handle, now, pool=None, after_id=None, lock=False):
+    table = ImageAnnotation.Meta.table
+    query = sqlalchemy.select([table.c.id]).where(table.c.finished == False).where(lease_is_free(table, now))
+    if pool is not None:
+        link_table, ann_col, pool_col = through_table(ImageAnnotation, "memberships")
+        query = query.where(table.c.id.in_(sqlalchemy.select([link_table.c[ann_col]])
+                                                     .where(link_table.c[pool_col] == pool)))
+    if after_id is not None:
+        query = query.where(table.c.id > after_id)
+    query = query.order_by(table.c.id).limit(1)
+    if lock and is_postgres(database_handle):
+        query = query.with_for_update(skip_locked=True)
+    return query
+
+def lease_values(annotator, now, lease_seconds):
+    return dict(in_progress=True, leased_by=annotator, lease_expires_at=lease_expiry(now, lease_seconds),
+                started_at=now, updated_by=annotator, updated_on=now)
+
+# Runs a lease UPDATE on one annotation, returns True if it took effect
+async def update_lease(database_handle, update, ann_id, annotator, expires):
+    table = ImageAnnotation.Meta.table
+    if is_postgres(database_handle):
+        return await database_handle.fetch_one(update.returning(table.c.id)) is not None
+
+    await database_handle.execute(update)
+    row = await database_handle.fetch_one(
+            sqlalchemy.select([table.c.id])
+                      .where(table.c.id == ann_id)
+                      .where(table.c.leased_by == annotator)
+                      .where(table.c.lease_expires_at == expires))
+    return row is not None
+
+# Claims the next annotation in the queue. Returns its id, or None if the
+# queue is empty.
+async def claim_next(database_handle, annotator, lease_seconds=LEASE_SECONDS, pool=None):
+    table = ImageAnnotation.Meta.table
+    now = datetime.datetime.now()
+    if is_postgres(database_handle):
+        row = await database_handle.fetch_one(
+                table.update()
+                     .where(table.c.id == claimable_query(database_handle, now, pool, lock=True).as_scalar())
+                     .values(**lease_values(annotator, now, lease_seconds))
+                     .returning(table.c.id))
+        return row[0] if row is not None else None
+
+    # Someone else may take the candidate between the two statements, then
+    # just move on to the next one
+    after_id = None
+    while True:
+        ann_id = await peek_next(database_handle, after_id, pool)
+        if ann_id is None or await claim(database_handle, ann_id, annotator, lease_seconds):
+            return ann_id
+        after_id = ann_id
+
+# Claims a specific annotation, unless someone else holds a live lease on it
+# (re-claiming your own lease just renews it). With force the lease is taken
+# over from whoever holds it, whose heartbeat then reports it lost. Returns
+# True on success.
+async def claim(database_handle, ann_id, annotator, lease_seconds=LEASE_SECONDS, force=False):
+    table = ImageAnnotation.Meta.table
+    now = datetime.datetime.now()
+    values = lease_values(annotator, now, lease_seconds)
+    update = table.update().where(table.c.id == ann_id)
+    if not force:
+        update = update.where(sqlalchemy.or_(lease_is_free(table, now), table.c.leased_by == annotator))
+    update = update.values(**values)
+    return await update_lease(database_handle, update, ann_id, annotator, values["lease_expires_at"])
+
+# Extends a lease. Returns False if the lease was lost (it expired and was
+# claimed by someone else).
+async def renew(database_handle, ann_id, annotator, lease_seconds=LEASE_SECONDS):
+    table = ImageAnnotation.Meta.table
+    expires = lease_expiry(datetime.datetime.now(), lease_seconds)
+    update = table.update() \
+                  .where(table.c.id == ann_id) \
+                  .where(table.c.leased_by == annotator) \
+                  .values(lease_expires_at=expires)
+    return await update_lease(database_handle, update, ann_id, annotator, expires)
+
+# Marks an annotation finished with its mask at (bucket, key), but only while
+# `annotator` still holds the lease: one that was lost to someone else (or
+# whose annotation someone finished meanwhile) is left alone. With
+# `released_ok` an annotation nobody holds and nobody finished is taken too,
+# for uploads retried after the lease was given back. Returns True if the
+# annotation was finished.
+async def finish(database_handle, ann_id, annotator, bucket, key, now=None, released_ok=False):
+    table = ImageAnnotation.Meta.table
+    now = now or datetime.datetime.now()
+    held = table.c.leased_by == annotator
+    if released_ok:
+        held = sqlalchemy.or_(held, sqlalchemy.and_(table.c.leased_by == None, table.c.finished == False))
+    update = table.update() \
+                  .where(table.c.id == ann_id) \
+                  .where(held) \
+                  .values(s3_key=key, s3_bucket=bucket, finished=True, in_progress=False,
+                          leased_by=None, lease_expires_at=None, finished_at=now,
+                          updated_by=annotator, updated_on=now)
+    if is_postgres(database_handle):
+        return await database_handle.fetch_one(update.returning(table.c.id)) is not None
+
+    await database_handle.execute(update)
+    row = await database_handle.fetch_one(
+            sqlalchemy.select([table.c.id])
+                      .where(table.c.id == ann_id)
+                      .where(table.c.s3_key == key)
+                      .where(table.c.finished_at == now)
+                      .where(table.c.updated_by == annotator))
+    return row is not None
+
+# Gives a lease back without finishing the annotation
+async def release(database_handle, ann_id, annotator):
+    table = ImageAnnotation.Meta.table
+    await database_handle.execute(
+            table.update()
+                 .where(table.c.id == ann_id)
+                 .where(table.c.leased_by == annotator)
+                 .values(in_progress=False, leased_by=None, lease_expires_at=None))
+
+# The annotation the next claim would most likely get, without claiming it.
+# Used to start prefetching its pixels.
+async def peek_next(database_handle, after_id=None, pool=None):
+    row = await database_handle.fetch_one(
+            claimable_query(database_handle, datetime.datetime.now(), pool, after_id))
+    return row[0] if row is not None else None